@@ -0,0 +1,307 @@
+from typing import Callable, Dict, List
+import argparse
+import json
+import logging
+import os
+import platform
+import random
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import log_config
+from graph_generator import GenerateGraphs
+from main import txt_path
+from pdf_processor import PdfProcessor
+
+logger = log_config.setup_logger(__name__, logging.INFO)
+
+# the vocabulary of the synthetic documents, with the search terms of GenerateGraphs.REGEX_PATTERNS in it
+WORDS = ("the board of directors approved a new gender policy for women in executive roles and sustainability "
+         "targets with esg reporting inclusive culture sustainable growth revenue profit market annual report "
+         "strategy risk governance committee executives boards inclusivity").split()
+# the loggers that are quieted while the stages are measured
+QUIET_LOGGERS = ["pdf_processor", "graph_generator", "chart_renderer", "term_scanner"]
+
+
+def synthetic_line(rng: random.Random, length: int) -> str:
+    """
+    Generates a line of random words
+    :param rng: the random generator
+    :param length: the maximum number of characters of the line
+    :return: the line
+    """
+    words = []
+    while len(" ".join(words)) < length - 12:
+        word = rng.choice(WORDS)
+        words.append(word.capitalize() if rng.random() < 0.1 else word)
+    return " ".join(words) + ("." if rng.random() < 0.2 else "")
+
+
+def synthetic_page(rng: random.Random, columns: int, width: int = 595, height: int = 842) -> bytes:
+    """
+    Generates the content stream of a page with columns of paragraphs of different font sizes
+    :param rng: the random generator
+    :param columns: the number of columns of the page
+    :param width: the width of the page, in points
+    :param height: the height of the page, in points
+    :return: the content stream
+    """
+    operations = []
+    margin = 40
+    column_width = (width - 2 * margin) / columns
+    for column in range(columns):
+        x = margin + column * column_width
+        y = height - 60
+        while y > 60:
+            size = rng.choice([9, 9, 9, 10, 12])
+            for _ in range(rng.randint(1, 8)):
+                line = synthetic_line(rng, int(column_width / (size * 0.6)) - rng.randint(0, 12))
+                line = line.replace("\\", "\\\\").replace("(", "\\(").replace(")", "\\)")
+                operations.append(f"BT /F1 {size} Tf {x:.2f} {y:.2f} Td ({line}) Tj ET")
+                y -= size + 2
+                if y < 60:
+                    break
+            y -= rng.choice([4, 12, 20])
+    return "\n".join(operations).encode("latin-1")
+
+
+def synthetic_pdf(path: str, pages: int, columns: int, seed: int = 0):
+    """
+    Writes a synthetic multi-column PDF, with the standard Helvetica font so that it needs no font file
+    :param path: the path of the PDF file
+    :param pages: the number of pages
+    :param columns: the number of columns of each page
+    :param seed: the seed of the random generator
+    """
+    rng = random.Random(seed)
+    objects = [b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>", None]
+    kids = []
+    for _ in range(pages):
+        stream = synthetic_page(rng, columns)
+        objects.append(b"<< /Length %d >>\nstream\n" % len(stream) + stream + b"\nendstream")
+        objects.append(b"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 595 842] /Resources << /Font << /F1 1 0 R >> >> "
+                       b"/Contents %d 0 R >>" % len(objects))
+        kids.append(len(objects))
+    objects[1] = b"<< /Type /Pages /Kids [%s] /Count %d >>" % (b" ".join(b"%d 0 R" % k for k in kids), len(kids))
+    objects.append(b"<< /Type /Catalog /Pages 2 0 R >>")
+
+    out = bytearray(b"%PDF-1.4\n")
+    offsets = []
+    for number, obj in enumerate(objects, 1):
+        offsets.append(len(out))
+        out += b"%d 0 obj\n" % number + obj + b"\nendobj\n"
+    xref = len(out)
+    out += b"xref\n0 %d\n0000000000 65535 f \n" % (len(objects) + 1)
+    out += b"".join(b"%010d 00000 n \n" % offset for offset in offsets)
+    out += b"trailer\n<< /Size %d /Root %d 0 R >>\nstartxref\n%d\n%%%%EOF\n" % (len(objects) + 1, len(objects), xref)
+    with open(path, "wb") as f:
+        f.write(out)
+
+
+def synthetic_txt(path: str, pages: int, seed: int = 0):
+    """
+    Writes a synthetic decoded txt file, in the format written by PdfProcessor
+    :param path: the path of the txt file
+    :param pages: the number of pages
+    :param seed: the seed of the random generator
+    """
+    rng = random.Random(seed)
+    with open(path, "w", encoding="utf-8") as f:
+        for idx in range(pages):
+            f.write(f"\n==Page{idx + 1}==\n\n")
+            for _ in range(rng.randint(5, 25)):
+                f.write(" ".join(synthetic_line(rng, 80) for _ in range(rng.randint(1, 10))) + "\n")
+
+
+def synthetic_corpus(location: str, companies: int, years: int, pages: int, seed: int = 0) -> List[str]:
+    """
+    Writes the txt files of synthetic companies, named like the real reports, eg. C01-2022.txt
+    :param location: the directory of the txt files
+    :param companies: the number of companies
+    :param years: the number of years per company, the last years of GenerateGraphs.YEARS
+    :param pages: the number of pages per file
+    :param seed: the seed of the random generator
+    :return: the names of the companies
+    """
+    os.makedirs(location, exist_ok=True)
+    names = [f"C{company:02d}" for company in range(companies)]
+    for number, name in enumerate(names):
+        for year in GenerateGraphs.YEARS[-years:]:
+            synthetic_txt(f"{location}/{name}-{year}.txt", pages, seed * 100003 + number * 101 + year)
+    return names
+
+
+def measure(stage: str, func: Callable[[], None], repeat: int = 1, memory: bool = True) -> Dict[str, float]:
+    """
+    Measures a stage, the time is the best of the repeats, the peak memory is measured on one more run with tracemalloc
+    so that its overhead is not in the time
+    :param stage: the name of the stage
+    :param func: the function running the stage
+    :param repeat: the number of timed runs
+    :param memory: bool, set to False to not measure the peak memory
+    :return: dict with the seconds and the peak MB
+    """
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    result = {"seconds": best}
+    if memory:
+        tracemalloc.start()
+        try:
+            func()
+            result["peak_mb"] = tracemalloc.get_traced_memory()[1] / 1e6
+        finally:
+            tracemalloc.stop()
+    logger.info(f"{stage}: {best:.3f} seconds" + (f", {result['peak_mb']:.1f} MB peak" if memory else ""))
+    return result
+
+
+def run_benchmark(workdir: str, pages: int = 20, columns: int = 2, companies: int = 3, years: int = 3,
+                  repeat: int = 1, memory: bool = True, seed: int = 0) -> Dict:
+    """
+    Runs all the stages on synthetic data in the work directory
+    :param workdir: the directory where the data and the outputs are written, it is the current directory meanwhile
+    :param pages: the number of pages of the synthetic PDF and txt files
+    :param columns: the number of columns of the synthetic PDF
+    :param companies: the number of synthetic companies
+    :param years: the number of years per company
+    :param repeat: the number of timed runs of each stage
+    :param memory: bool, set to False to not measure the peak memory
+    :param seed: the seed of the random generators
+    :return: the results, with the configuration and the measures of each stage
+    """
+    cwd = os.getcwd()
+    os.makedirs(workdir, exist_ok=True)
+    os.chdir(workdir)
+    try:
+        for directory in ("files", GenerateGraphs.CSV_DIR, GenerateGraphs.DOCS_DIR):
+            os.makedirs(directory, exist_ok=True)
+        pdf = "files/BENCH-2022.pdf"
+        synthetic_pdf(pdf, pages, columns, seed)
+        pdf_mb = os.path.getsize(pdf) / 1e6
+        names = synthetic_corpus("files", companies, years, pages, seed)
+        txt_files = [f for f in os.listdir("files") if f.endswith("txt") and not f.startswith("BENCH")]
+        txt_mb = sum(os.path.getsize(f"files/{f}") for f in txt_files) / 1e6
+        stages = {}
+
+        def process_pages():
+            proc = PdfProcessor(pdf)
+            try:
+                for page in proc.pages:
+                    proc.process_page(page)
+            finally:
+                proc.close()
+
+        stages["process_page"] = measure("process_page", process_pages, repeat, memory)
+        stages["process_page"]["pages_per_second"] = pages / stages["process_page"]["seconds"]
+
+        stages["process_file"] = measure("process_file", lambda: PdfProcessor(pdf).process_file(streaming=True),
+                                         repeat, memory)
+        stages["process_file"]["pages_per_second"] = pages / stages["process_file"]["seconds"]
+        stages["process_file"]["mb_per_second"] = pdf_mb / stages["process_file"]["seconds"]
+        os.remove(txt_path(pdf))
+
+        graphs = GenerateGraphs("files")
+
+        def extract_values():
+            graphs.counts = {}
+            for f in txt_files:
+                for key in GenerateGraphs.DATAFRAME_COLUMNS:
+                    graphs.extract_values(f, key)
+
+        stages["extract_values"] = measure("extract_values", extract_values, repeat, memory)
+        stages["extract_values"]["mb_per_second"] = txt_mb / stages["extract_values"]["seconds"]
+
+        for name in names:
+            graphs.generate_csvs_for_company(name, True)
+        graph_count = len(names) * len(GenerateGraphs.DATAFRAME_COLUMNS)
+        stages["generate_graphs"] = measure(
+            "generate_graphs", lambda: [graphs.generate_graphs(name, True) for name in names], repeat, memory)
+        stages["generate_graphs"]["graphs_per_second"] = graph_count / stages["generate_graphs"]["seconds"]
+        stages["generate_doc"] = measure(
+            "generate_doc", lambda: [graphs.generate_doc(name, True) for name in names], repeat, memory)
+        stages["generate_doc"]["docs_per_second"] = len(names) / stages["generate_doc"]["seconds"]
+        stages["generate_aggregated_doc"] = measure(
+            "generate_aggregated_doc", lambda: graphs.generate_aggregated_doc(True), repeat, memory)
+    finally:
+        os.chdir(cwd)
+    return {
+        "config": {"pages": pages, "columns": columns, "companies": companies, "years": years, "repeat": repeat,
+                   "seed": seed},
+        "environment": {"python": platform.python_version(), "platform": platform.platform(),
+                        "cpus": os.cpu_count()},
+        "stages": stages,
+    }
+
+
+def compare(results: Dict, baseline: Dict, tolerance: float = 0.2) -> List[str]:
+    """
+    Compares the results of a run with a baseline
+    :param results: the results of the run, as returned by run_benchmark
+    :param baseline: the baseline, the results of a previous run with the same configuration
+    :param tolerance: the relative slowdown, or growth of the peak memory, that is accepted
+    :return: the list of regressions, empty if there are none
+    """
+    if results["config"] != baseline["config"]:
+        logger.warning(f"The configuration of the baseline {baseline['config']} is different from {results['config']}")
+    regressions = []
+    for stage, measures in results["stages"].items():
+        reference = baseline["stages"].get(stage)
+        if reference is None:
+            logger.info(f"{stage}: not in the baseline")
+            continue
+        for metric in ("seconds", "peak_mb"):
+            if metric not in measures or metric not in reference:
+                continue
+            ratio = measures[metric] / reference[metric] if reference[metric] else 1.0
+            message = f"{stage} {metric}: {measures[metric]:.3f} against {reference[metric]:.3f} ({ratio:.2f}x)"
+            if ratio > 1 + tolerance:
+                logger.error(message)
+                regressions.append(message)
+            else:
+                logger.info(message)
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Measures the decode, analyse and report stages on synthetic data")
+    parser.add_argument("--pages", type=int, default=20, help="the number of pages of each synthetic file")
+    parser.add_argument("--columns", type=int, default=2, help="the number of columns of the synthetic PDF")
+    parser.add_argument("--companies", type=int, default=3, help="the number of synthetic companies")
+    parser.add_argument("--years", type=int, default=3, help="the number of years per company")
+    parser.add_argument("--repeat", type=int, default=1, help="the number of timed runs of each stage")
+    parser.add_argument("--seed", type=int, default=0, help="the seed of the synthetic data")
+    parser.add_argument("--no-memory", action="store_true", help="do not measure the peak memory")
+    parser.add_argument("--workdir", help="where the synthetic data is written, a temporary directory by default")
+    parser.add_argument("--output", help="write the results to this JSON file, eg. to store a new baseline")
+    parser.add_argument("--compare", help="compare the results with this baseline JSON file")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="the accepted relative slowdown")
+    parser.add_argument("--verbose", action="store_true", help="keep the logs of the stages")
+    args = parser.parse_args()
+
+    if not args.verbose:
+        for name in QUIET_LOGGERS:
+            logging.getLogger(name).setLevel(logging.WARNING)
+    workdir = args.workdir or tempfile.mkdtemp(prefix="benchmark-")
+    try:
+        results = run_benchmark(workdir, args.pages, args.columns, args.companies, args.years, args.repeat,
+                                not args.no_memory, args.seed)
+    finally:
+        if args.workdir is None:
+            shutil.rmtree(workdir, ignore_errors=True)
+    if args.output:
+        with open(args.output, "w", encoding="utf8") as f:
+            json.dump(results, f, indent=2)
+        logger.info(f"Wrote the results to {args.output}")
+    if args.compare:
+        with open(args.compare, encoding="utf8") as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        if regressions:
+            logger.error(f"Found {len(regressions)} regressions against {args.compare}")
+            sys.exit(1)
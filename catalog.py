@@ -0,0 +1,148 @@
+from typing import Dict, List, Tuple, Union
+import logging
+import os
+import re
+
+import log_config
+
+logger = log_config.setup_logger(__name__, logging.INFO)
+
+
+class CorpusCatalog:
+    """
+    Class that lists the reports of the corpus once per run and parses their COMPANY-YEAR names, eg. REP-2022.pdf, so
+    that the stages look up the PDF and txt of a company and year, and the paths of the outputs of a company, by key.
+    Matching the names exactly also keeps tickers that contain each other apart, eg. SAN and SANX.
+    The catalog only changes when it is refreshed, or when a stage adds the file it wrote, eg. a decoded txt.
+    """
+    NAME_PATTERN = re.compile(r"(?P<company>[^-]+)-(?P<year>\d{4})\.(?P<extension>pdf|txt)")
+
+    def __init__(self, location: str, csv_dir: str = "csvs", docs_dir: str = "docs"):
+        """
+        Initialize the class and list the location
+        :param location: The location of the PDFs, where they are decoded into txt
+        :param csv_dir: The directory of the CSV files and of the graphs
+        :param docs_dir: The directory of the doc files
+        """
+        self.location = location
+        self.csv_dir = csv_dir
+        self.docs_dir = docs_dir
+        # extension -> (company, year) -> the name of the file
+        self.files: Dict[str, Dict[Tuple[str, int], str]] = {}
+        # company -> year -> the name of the txt file, in the order of the years
+        self.decoded: Dict[str, Dict[int, str]] = {}
+        self.refresh()
+
+    @classmethod
+    def parse(cls, filename: str) -> Union[Tuple[str, int, str], None]:
+        """
+        Parses the name of a report
+        :param filename: The name or the path of the file, eg. files/REP-2022.pdf
+        :return: tuple with the company, the year and the extension, None if the name is not COMPANY-YEAR.pdf or txt
+        """
+        match = cls.NAME_PATTERN.fullmatch(os.path.basename(filename))
+        if match is None:
+            return None
+        return match["company"], int(match["year"]), match["extension"]
+
+    def refresh(self):
+        """
+        Lists the location again, eg. after new PDFs were decoded
+        """
+        files = {"pdf": {}, "txt": {}}
+        for f in sorted(os.listdir(self.location)):
+            parsed = self.parse(f)
+            if parsed is None:
+                if f.endswith(".pdf") or f.endswith(".txt"):
+                    logger.warning(f"Ignoring the file {f}, its name is not COMPANY-YEAR")
+                continue
+            company, year, extension = parsed
+            files[extension][(company, year)] = f
+        self.files = files
+        self.decoded = {}
+        for (company, year), f in sorted(files["txt"].items()):
+            self.decoded.setdefault(company, {})[year] = f
+
+    def add(self, path: str):
+        """
+        Adds a file written by a stage, eg. a decoded txt, without listing the location again
+        :param path: The path of the file
+        """
+        parsed = self.parse(path)
+        if parsed is None:
+            return
+        company, year, extension = parsed
+        self.files[extension][(company, year)] = os.path.basename(path)
+        if extension == "txt":
+            years = self.decoded.setdefault(company, {})
+            years[year] = os.path.basename(path)
+            self.decoded[company] = dict(sorted(years.items()))
+            self.decoded = dict(sorted(self.decoded.items()))
+
+    @property
+    def companies(self) -> List[str]:
+        """
+        Property that returns the companies with at least one decoded report
+        :return: The sorted list of companies
+        """
+        return list(self.decoded)
+
+    def year_files(self, company: str) -> Dict[int, str]:
+        """
+        :param company: The name of the company, eg. REP
+        :return: dict of year -> the name of the txt file of that year, eg. REP-2022.txt
+        """
+        return self.decoded.get(company, {})
+
+    def pdfs(self) -> List[str]:
+        """
+        :return: The paths of all the PDFs, in the order of their names
+        """
+        return [f"{self.location}/{f}" for _, f in sorted(self.files["pdf"].items())]
+
+    def txts(self) -> List[str]:
+        """
+        :return: The paths of all the txt files, in the order of their names
+        """
+        return [f"{self.location}/{f}" for _, f in sorted(self.files["txt"].items())]
+
+    def pdf(self, company: str, year: int) -> Union[str, None]:
+        """
+        :param company: The name of the company, eg. REP
+        :param year: The year of the report
+        :return: The path of the PDF, None if there is none
+        """
+        f = self.files["pdf"].get((company, year))
+        return f"{self.location}/{f}" if f else None
+
+    def txt(self, company: str, year: int) -> Union[str, None]:
+        """
+        :param company: The name of the company, eg. REP
+        :param year: The year of the report
+        :return: The path of the decoded txt, None if there is none
+        """
+        f = self.files["txt"].get((company, year))
+        return f"{self.location}/{f}" if f else None
+
+    def csv(self, company: str, category: str) -> str:
+        """
+        :param company: The name of the company, or all for the aggregate of all the companies
+        :param category: The category of the search terms, eg. gender
+        :return: The path of the CSV file
+        """
+        return f"{self.csv_dir}/{category}-{company}.csv"
+
+    def graph(self, company: str, category: str) -> str:
+        """
+        :param company: The name of the company, or all for the aggregate of all the companies
+        :param category: The category of the search terms, eg. gender
+        :return: The path of the JPG file
+        """
+        return f"{self.csv_dir}/{category}-{company}_graph.jpg"
+
+    def doc(self, company: str) -> str:
+        """
+        :param company: The name of the company, or all for the aggregate of all the companies
+        :return: The path of the doc file
+        """
+        return f"{self.docs_dir}/{company}.docx"
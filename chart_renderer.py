@@ -0,0 +1,91 @@
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, List, Tuple
+import logging
+
+import log_config
+
+logger = log_config.setup_logger(__name__, logging.INFO)
+
+# title, years, column -> values and path of the JPG, the data is plain lists so that it is cheap to send to a worker
+ChartJob = Tuple[str, List[int], Dict[str, List[int]], str]
+
+
+class ChartTemplate:
+    """
+    Class that renders the line charts of the reports on one reused figure.
+    The figure is drawn with the Agg canvas directly, without pyplot, so it does not depend on the default backend.
+    The axes and the lines are only created once, each chart only replaces the data of the lines, the labels and the
+    title, and rescales the axes, which gives the same image as building the figure from scratch.
+    """
+    FIGSIZE = (10, 6)
+
+    def __init__(self):
+        """
+        Initialize the class, creating the figure and its axes.
+        matplotlib is only imported here, by the processes that actually render a chart.
+        """
+        from matplotlib.backends.backend_agg import FigureCanvasAgg
+        from matplotlib.figure import Figure
+
+        self.figure = Figure(figsize=self.FIGSIZE)
+        FigureCanvasAgg(self.figure)
+        self.axes = self.figure.add_subplot()
+        self.axes.set_xlabel('Year')
+        self.axes.set_ylabel('Values')
+        self.axes.grid(True)
+        self.lines = []
+
+    def render(self, title: str, years: List[int], columns: Dict[str, List[int]], path: str):
+        """
+        Renders one chart and saves it
+        :param title: The title of the chart
+        :param years: The values of the x axis
+        :param columns: dict of column name -> the values of the line, in the order of the legend
+        :param path: The path of the JPG file
+        """
+        # the lines keep the colors of the property cycle, so only the missing ones are added
+        while len(self.lines) < len(columns):
+            self.lines.extend(self.axes.plot([], [], marker='o'))
+        for line, (column, values) in zip(self.lines, columns.items()):
+            line.set_data(years, values)
+            line.set_label(column)
+            line.set_visible(True)
+        for line in self.lines[len(columns):]:
+            line.set_visible(False)
+            line.set_label(f"_{line.get_label()}")
+        self.axes.relim(visible_only=True)
+        self.axes.autoscale_view()
+        self.axes.set_title(title)
+        self.axes.legend()
+        self.figure.savefig(path)
+
+
+_template = None
+
+
+def render_chart(job: ChartJob) -> str:
+    """
+    Renders a chart on the template of this process, creating it the first time
+    :param job: tuple with the title, the years, the columns and the path of the JPG
+    :return: the path of the JPG
+    """
+    global _template
+    if _template is None:
+        _template = ChartTemplate()
+    _template.render(*job)
+    return job[3]
+
+
+def render_charts(jobs: List[ChartJob], workers: int = 1) -> List[str]:
+    """
+    Renders a batch of charts, across a pool of processes each with its own template
+    :param jobs: The list of charts to render
+    :param workers: The number of processes, 1 renders them in this process
+    :return: the paths of the JPGs
+    """
+    if workers <= 1 or len(jobs) <= 1:
+        return [render_chart(job) for job in jobs]
+    workers = min(workers, len(jobs))
+    logger.info(f"Rendering {len(jobs)} charts with {workers} processes")
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(render_chart, jobs, chunksize=max(1, len(jobs) // (workers * 4))))
@@ -0,0 +1,164 @@
+from typing import List
+import argparse
+import logging
+import os
+
+import log_config
+from catalog import CorpusCatalog
+from manifest_cache import ManifestCache
+
+logger = log_config.setup_logger(__name__, logging.INFO)
+
+# the stages only import what they need, eg. pdfplumber to decode and pandas, matplotlib or python-docx to generate,
+# so that a status check or a run with nothing to do starts quickly
+
+
+def company_graphs(args: argparse.Namespace, cache: ManifestCache):
+    """
+    Creates the graph generator of the stages working on the companies
+    :param args: The parsed arguments
+    :param cache: The manifest cache
+    :return: the graph generator and the companies to process
+    """
+    from graph_generator import GenerateGraphs
+    from main import pdf_dir
+    from term_index import TermIndex
+
+    graphs = GenerateGraphs(pdf_dir, cache, TermIndex(), render_workers=args.workers)
+    companies = args.company or graphs.companies
+    unknown = [company for company in companies if company not in graphs.companies]
+    if unknown:
+        raise SystemExit(f"Unknown companies {', '.join(unknown)}, the decoded companies are "
+                         f"{', '.join(graphs.companies)}")
+    return graphs, companies
+
+
+def decode(args: argparse.Namespace, cache: ManifestCache):
+    """
+    Decodes the new or changed PDFs and indexes the decoded files
+    :param args: The parsed arguments
+    :param cache: The manifest cache
+    """
+    from main import check_and_decode_new_files, pdf_dir
+    from term_index import TermIndex
+
+    catalog = CorpusCatalog(pdf_dir)
+    summary = check_and_decode_new_files(args.workers, cache, catalog)
+    logger.info("Indexing the decoded files")
+    TermIndex().update(pdf_dir, catalog)
+    if summary["failed"]:
+        raise SystemExit(1)
+
+
+def analyse(args: argparse.Namespace, cache: ManifestCache):
+    """
+    Counts the search terms of the companies and writes their results and CSV files
+    :param args: The parsed arguments
+    :param cache: The manifest cache
+    """
+    graphs, companies = company_graphs(args, cache)
+    generated = [company for company in companies if graphs.generate_csvs_for_company(company, args.force)]
+    graphs.save_results()
+    logger.info(f"Generated the results of {len(generated)} of {len(companies)} companies")
+
+
+def graphs(args: argparse.Namespace, cache: ManifestCache):
+    """
+    Renders the graphs of the companies
+    :param args: The parsed arguments
+    :param cache: The manifest cache
+    """
+    generator, companies = company_graphs(args, cache)
+    generator.generate_graphs_for_companies({company: args.force for company in companies})
+
+
+def docs(args: argparse.Namespace, cache: ManifestCache):
+    """
+    Writes the doc files of the companies
+    :param args: The parsed arguments
+    :param cache: The manifest cache
+    """
+    generator, companies = company_graphs(args, cache)
+    for company in companies:
+        generator.generate_doc(company, args.force)
+
+
+def aggregate(args: argparse.Namespace, cache: ManifestCache):
+    """
+    Writes the CSV files, the graphs and the doc adding the results of all the companies
+    :param args: The parsed arguments
+    :param cache: The manifest cache
+    """
+    generator, _ = company_graphs(args, cache)
+    generator.generate_aggregated_doc(args.force)
+
+
+def status(args: argparse.Namespace, cache: ManifestCache):
+    """
+    Prints the outputs that the next run would generate, without generating anything
+    :param args: The parsed arguments
+    :param cache: The manifest cache
+    """
+    from graph_generator import GenerateGraphs
+    from main import pdf_dir, txt_path
+    from pdf_processor import extraction_config
+
+    graphs = GenerateGraphs(pdf_dir, cache)
+    stale = {"decode": [os.path.basename(pdf) for pdf in graphs.catalog.pdfs()
+                        if not cache.is_decoded(pdf, txt_path(pdf), extraction_config(pdf), restore=False)]}
+    stale.update(graphs.stale_outputs())
+    if not any(stale.values()):
+        print("Everything is up to date")
+        return
+    for stage, targets in stale.items():
+        print(f"{stage}: {len(targets)} stale" + (f" ({', '.join(targets)})" if targets else ""))
+
+
+COMMANDS = {
+    "decode": (decode, "decode the new or changed PDFs and index them"),
+    "analyse": (analyse, "count the search terms and write the results and CSV files"),
+    "graphs": (graphs, "render the graphs of the companies"),
+    "docs": (docs, "write the doc files of the companies"),
+    "aggregate": (aggregate, "write the CSV files, graphs and doc of all the companies together"),
+    "status": (status, "list the outputs that are stale, without generating them"),
+}
+
+
+def parse_args(argv: List[str] = None) -> argparse.Namespace:
+    """
+    Parses the command line
+    :param argv: The arguments, the ones of the process if None
+    :return: the parsed arguments
+    """
+    parser = argparse.ArgumentParser(description="Decodes the integrated reports and generates their results, graphs "
+                                                 "and docs, one stage at a time")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    for name, (_, description) in COMMANDS.items():
+        subparser = subparsers.add_parser(name, help=description, description=description)
+        if name in ("analyse", "graphs", "docs"):
+            subparser.add_argument("--company", action="append",
+                                   help="the company to process, can be repeated, all of them if not set")
+        if name not in ("decode", "status"):
+            subparser.add_argument("--force", action="store_true", help="generate the outputs even if up to date")
+        if name != "status":
+            subparser.add_argument("--workers", type=int, default=1, help="the number of processes")
+    return parser.parse_args(argv)
+
+
+def run(argv: List[str] = None):
+    """
+    Runs the stage of the command line
+    :param argv: The arguments, the ones of the process if None
+    """
+    args = parse_args(argv)
+    # the commands without a company option, eg. aggregate, work on all the companies
+    args.company = getattr(args, "company", None)
+    cache = ManifestCache()
+    try:
+        COMMANDS[args.command][0](args, cache)
+    finally:
+        cache.save()
+
+
+if __name__ == '__main__':
+    run()
@@ -1,18 +1,24 @@
-from copy import deepcopy
-from typing import List, Dict, Union
-import re
+from typing import TYPE_CHECKING, List, Dict, Union
 
 import logging
 import os
 import log_config
-import pandas as pd
-import matplotlib.pyplot as plt
-from docx import Document
-from docx.shared import Inches, Pt
-from docx.enum.text import WD_ALIGN_PARAGRAPH
+from catalog import CorpusCatalog
+from term_scanner import TermScanner
+from manifest_cache import ManifestCache
+from term_index import TermIndex
+from chart_renderer import ChartJob, render_charts
+from instrumentation import profile, recorder
 
+if TYPE_CHECKING:
+    # pandas and python-docx are only imported by the stages that use them, so a run with nothing to generate and the
+    # status of the outputs do not pay for their import
+    import pandas as pd
+    from docx.document import Document
+    from results_store import ResultsStore
 
-logger = log_config.setup_logger(__name__, logging.DEBUG)
+
+logger = log_config.setup_logger(__name__, logging.INFO)
 
 
 class HandleDocument:
@@ -21,27 +27,36 @@ class HandleDocument:
     """
 
     @staticmethod
-    def add_csv_to_doc(filename: str, document: Document):
+    def add_csv_to_doc(filename: str, document: "Document"):
         """
         Add the CSV file contents to the document
         :param filename: The name of the CSV file
         :param document: The document object
         """
+        import pandas as pd
+
         # Read the CSV file into a DataFrame
-        df = pd.read_csv(filename)
+        HandleDocument.add_df_to_doc(pd.read_csv(filename, index_col=0), document)
+
+    @staticmethod
+    def add_df_to_doc(df: "pd.DataFrame", document: "Document"):
+        """
+        Add the table of a category to the document
+        :param df: The table, with the years as index
+        :param document: The document object
+        """
         # Add the DataFrame as a table to the document
-        table = document.add_table(rows=1, cols=len(df.columns))
+        table = document.add_table(rows=1, cols=len(df.columns) + 1)
         hdr_cells = table.rows[0].cells
         # Add header row
-        for i, column_name in enumerate(df.columns):
-            if i == 0:
-                hdr_cells[i].text = 'Year'
-            else:
-                hdr_cells[i].text = str(column_name)
+        hdr_cells[0].text = 'Year'
+        for i, column_name in enumerate(df.columns, 1):
+            hdr_cells[i].text = str(column_name)
         # Add the rest of the data frame
         for index, row in df.iterrows():
             row_cells = table.add_row().cells
-            for i, value in enumerate(row):
+            row_cells[0].text = str(index)
+            for i, value in enumerate(row, 1):
                 row_cells[i].text = str(value)
 
     @staticmethod
@@ -51,12 +66,15 @@ class HandleDocument:
         :param filename: The name of the JPG file
         :param document: The document object
         """
+        from docx.shared import Inches
+
         # Add the JPG file to the document
         document.add_picture(filename, width=Inches(8))  # You can adjust the width
 
 
 class GenerateGraphs:
     CSV_DIR = "csvs"
+    RESULTS_FILE = f"{CSV_DIR}/results.parquet"
     DOCS_DIR = "docs"
     YEARS = list(range(2012, 2023))
     DATAFRAME_COLUMNS = {
@@ -73,16 +91,71 @@ class GenerateGraphs:
         "esg": [r"\besg\b", r"\bboard(s)?\b", r"\bexecutiv[a-z]+"]
     }
 
-    def __init__(self, location: str):
+    def __init__(self, location: str, cache: ManifestCache = None, index: TermIndex = None, export_csvs: bool = True,
+                 render_workers: int = 1, results_file: Union[str, None] = RESULTS_FILE,
+                 catalog: CorpusCatalog = None):
         """
         Initialize the class
         :param location: The location where the pdfs have been decoded into txt
+        :param cache: The manifest cache used to reuse the counts and to find the stale outputs, can be None
+        :param index: The term index used to count the files without scanning their text, can be None
+        :param export_csvs: bool, set to False to only write the results file and not the per company CSV files
+        :param render_workers: The number of processes rendering the graphs, 1 renders them in this process
+        :param results_file: The path of the results file, None to only keep the results in memory
+        :param catalog: The catalog of the files in the location, a new one if None
         """
         self.location = location
-        self._companies = []
-        files = os.listdir(self.location)
-        self.files = [f for f in files if f.endswith("txt")]
-        self.dfs = {}
+        self.cache = cache
+        self.index = index
+        self.catalog = CorpusCatalog(location, self.CSV_DIR, self.DOCS_DIR) if catalog is None else catalog
+        self.export_csvs = export_csvs
+        self.render_workers = render_workers
+        self.results_file = results_file
+        # the results are only read from the results file when they are first needed
+        self._results = None
+        self._file_companies = None
+        self.scanner = TermScanner(self.REGEX_PATTERNS)
+        self.counts = {}
+
+    @property
+    def results(self) -> "ResultsStore":
+        """
+        Property that returns the results of all the companies, read from the results file the first time
+        :return: The results store
+        """
+        if self._results is None:
+            from results_store import ResultsStore
+            self._results = ResultsStore.from_file(self.results_file, self.DATAFRAME_COLUMNS, self.YEARS) \
+                if self.results_file else ResultsStore(self.DATAFRAME_COLUMNS, self.YEARS)
+        return self._results
+
+    @results.setter
+    def results(self, results: "ResultsStore"):
+        self._results = results
+
+    def has_results(self, company_name: str) -> bool:
+        """
+        Checks if the results of the company were generated. Until the results are needed, only the company column of
+        the results file is read, so that finding the companies that are up to date does not load pandas.
+        :param company_name: The name of the company
+        :return: bool, True if the results have the company
+        """
+        if self._results is not None or not self.results_file:
+            return company_name in self.results.companies
+        if self._file_companies is None:
+            self._file_companies = set()
+            if os.path.exists(self.results_file):
+                import pyarrow.parquet as pq
+                # ParquetFile reads the column without going through the datasets, which would import pandas
+                self._file_companies = set(pq.ParquetFile(self.results_file).read(columns=["company"])
+                                           .column("company").unique().to_pylist())
+        return company_name in self._file_companies
+
+    def refresh_files(self):
+        """
+        Lists the txt files in the location again, eg. after new PDFs were decoded
+        """
+        self.catalog.refresh()
 
     @property
     def companies(self) -> List:
@@ -90,11 +163,40 @@ class GenerateGraphs:
         Property that returns the list of companies that have been analysed
         :return: The list of individual companies
         """
-        for f in self.files:
-            company = next(iter(f.split("-")))
-            if company not in self._companies:
-                self._companies.append(company)
-        return self._companies
+        return self.catalog.companies
+
+    def scan_file(self, file: str) -> Dict[str, List[int]]:
+        """
+        Count the search terms of all the categories in the file, reading the file only once
+        :param file: The name of the file containing the PDF decoded into txt format
+        :return: dict of key -> list of values for the company
+        """
+        if file in self.counts:
+            return self.counts[file]
+        if self.cache is None:
+            self.counts[file] = self.count_file(file)
+            return self.counts[file]
+        key = self.cache.counts_key(f"{self.location}/{file}", self.REGEX_PATTERNS)
+        counts = self.cache.get_counts(key)
+        if counts is None:
+            counts = self.count_file(file)
+            self.cache.store_counts(key, counts)
+        self.counts[file] = counts
+        return counts
+
+    def count_file(self, file: str) -> Dict[str, List[int]]:
+        """
+        Count the search terms of all the categories in the file, from the term index if the file is indexed and the
+        index can count the patterns, else by scanning the text
+        :param file: The name of the file containing the PDF decoded into txt format
+        :return: dict of key -> list of values for the company
+        """
+        path = f"{self.location}/{file}"
+        if self.index is not None and self.index.can_count(self.REGEX_PATTERNS) and self.index.is_indexed(path):
+            with recorder.stage("index_count", path):
+                return self.index.count(self.index.name_of(path), self.REGEX_PATTERNS)
+        with recorder.stage("regex_scan", path, bytes_read=os.path.getsize(path)):
+            return self.scanner.scan_file(path)
 
     def extract_values(self, file: str, key: str) -> List:
         """
@@ -103,97 +205,198 @@ class GenerateGraphs:
         :param key: The key for the dataframe determining the search terms
         :return: A list of values for the company
         """
-        values = []
-        for idx in range(3):
-            if len(self.REGEX_PATTERNS[key]) == 4:
-                main_pattern = re.compile(self.REGEX_PATTERNS[key][0], re.IGNORECASE)
-                secondary_pattern = re.compile(self.REGEX_PATTERNS[key][1], re.IGNORECASE)
-                board_pattern = re.compile(self.REGEX_PATTERNS[key][2], re.IGNORECASE)
-                executive_pattern = re.compile(self.REGEX_PATTERNS[key][3], re.IGNORECASE)
+        return list(self.scan_file(file)[key])
+
+    def update_results(self, company: str, year_files: Dict[int, str]):
+        """
+        Updates the results store with the counts of the company, the years without a PDF are set to zero
+        :param company: The name of the company file in the PDF file, eg REP for REPSOL
+        :param year_files: dict of year -> the name of the file containing the PDF of that year decoded into txt format
+        """
+        for year in self.YEARS:
+            if year in year_files:
+                logger.debug("Found data for company %s for year %s", company, year)
             else:
-                main_pattern = re.compile(self.REGEX_PATTERNS[key][0], re.IGNORECASE)
-                secondary_pattern = None
-                board_pattern = re.compile(self.REGEX_PATTERNS[key][1], re.IGNORECASE)
-                executive_pattern = re.compile(self.REGEX_PATTERNS[key][2], re.IGNORECASE)
-
-            with open(f"{self.location}/{file}", encoding="utf8") as f:
-                text = f.read()
-                value = 0
-                for paragraph in text.split("\n"):
-                    if idx == 0:
-                        # first column, just a simple count for the main pattern
-                        value += len(main_pattern.findall(paragraph))
-                    elif idx == 1:
-                        # second column, if secondary pattern is None, then just a simple count for the main + board pattern
-                        # else, count the main + secondary + board pattern
-                        if secondary_pattern is None:
-                            if main_pattern.search(paragraph) and board_pattern.search(paragraph):
-                                value += 1
-                        else:
-                            if (main_pattern.search(paragraph) or secondary_pattern.search(
-                                    paragraph)) and board_pattern.search(paragraph):
-                                value += 1
-                    elif idx == 2:
-                        # third column, if secondary pattern is None, then just a simple count for the main + executive pattern
-                        # else, count the main + secondary + executive pattern
-                        if secondary_pattern is None:
-                            if main_pattern.search(paragraph) and executive_pattern.search(paragraph):
-                                value += 1
-                        else:
-                            if (main_pattern.search(paragraph) or secondary_pattern.search(
-                                    paragraph)) and executive_pattern.search(paragraph):
-                                value += 1
-                values.append(value)
-
-        return values
-
-    def update_df(self, file: Union[str, None], company: str, year: int, add_empty=False):
-        """
-        Updates the dataframe for that particular company with the results
-        :param file: The name of the file containing the PDF decoded into txt format
+                logger.debug("Did not find data for company %s for year %s", company, year)
+        self.results.add_company(company, {year: self.scan_file(file) for year, file in year_files.items()})
+
+    def load_results(self, company: str):
+        """
+        Loads the results of the company from its CSV files, when they were generated before the results file existed
         :param company: The name of the company file in the PDF file, eg REP for REPSOL
-        :param year: The year as coded in the PDF file name
-        :param add_empty: bool to add an empty row of Zeroes if there is no PDF for that company that year
         """
+        import pandas as pd
+
         for key in self.DATAFRAME_COLUMNS:
-            df_id = f"{key}-{company}"
-            if df_id not in self.dfs:
-                self.dfs[df_id] = pd.DataFrame(columns=self.DATAFRAME_COLUMNS[key], index=self.YEARS)
-            if add_empty:
-                self.dfs[df_id].loc[year] = 0
-                continue
-            values = self.extract_values(file, key)
-            self.dfs[df_id].loc[year] = values
-        return
+            self.results.add_frame(key, company, pd.read_csv(self.catalog.csv(company, key), index_col=0))
+        self.save_results()
+
+    def save_results(self):
+        """
+        Writes the results in memory to the results file, if there is one and they were loaded
+        """
+        if self.results_file and self._results is not None:
+            self.results.save(self.results_file)
+
+    def read_results(self, company_name: str) -> Dict[str, "pd.DataFrame"]:
+        """
+        Reads the tables of the company from the results file, only the rows of that company are loaded.
+        The aggregate is built from the results in memory, which already hold all the companies, and so are the tables
+        when there is no results file.
+        :param company_name: The name of the company, or all for the aggregate of all the companies
+        :return: dict of key -> table of the category with the years as index
+        """
+        from results_store import ResultsStore
+
+        if company_name == "all":
+            return {key: self.results.aggregate_frame(key, self.companies) for key in self.DATAFRAME_COLUMNS}
+        results = self.results if not self.results_file else \
+            ResultsStore.from_file(self.results_file, self.DATAFRAME_COLUMNS, self.YEARS, companies=[company_name])
+        return {key: results.company_frame(key, company_name) for key in self.DATAFRAME_COLUMNS}
+
+    def results_outputs(self) -> List[str]:
+        """
+        :return: The results file in a list, empty if the results are only kept in memory
+        """
+        return [self.results_file] if self.results_file else []
+
+    def export_csvs_for_company(self, company_name: str, frames: Dict[str, "pd.DataFrame"]):
+        """
+        Writes the tables of the company to CSV files in the CSV_DIR
+        :param company_name: The name of the company, or all for the aggregate of all the companies
+        :param frames: dict of key -> table of the category, as returned by read_results
+        """
+        for key, df in frames.items():
+            df.to_csv(self.catalog.csv(company_name, key))
+
+    def year_files(self, company_name: str) -> Dict[int, str]:
+        """
+        Finds the decoded file of each year of the company
+        :param company_name: The name of the company
+        :return: dict of year -> the name of the txt file, the years without a file are left out
+        """
+        return {year: file for year, file in self.catalog.year_files(company_name).items() if year in self.YEARS}
+
+    def csv_outputs(self, company_name: str) -> List[str]:
+        """
+        :param company_name: The name of the company, or all for the aggregate of all the companies
+        :return: The CSV files of the company, empty if they are not exported
+        """
+        return [self.catalog.csv(company_name, key) for key in self.DATAFRAME_COLUMNS] if self.export_csvs else []
+
+    def results_fingerprint(self, year_files: Dict[int, str]) -> str:
+        """
+        The fingerprint of the results of a company, that changes if the txt of any year, the patterns or the columns
+        changed. Needs the cache.
+        :param year_files: dict of year -> the name of the txt file, as returned by year_files
+        :return: the fingerprint
+        """
+        return self.cache.fingerprint(self.DATAFRAME_COLUMNS, self.YEARS, {
+            year: self.cache.counts_key(f"{self.location}/{file}", self.REGEX_PATTERNS)
+            for year, file in year_files.items()
+        })
+
+    def is_results_fresh(self, company_name: str, fingerprint: str) -> bool:
+        """
+        Checks if the results and the CSV files of the company were generated from the current txt files. Needs the
+        cache.
+        :param company_name: The name of the company
+        :param fingerprint: The fingerprint of the results, as returned by results_fingerprint
+        :return: bool, True if they are up to date
+        """
+        return self.cache.is_fresh(f"csv:{company_name}", fingerprint,
+                                   self.results_outputs() + self.csv_outputs(company_name)) and \
+            self.has_results(company_name)
 
     def generate_csvs_for_company(self, company_name: str, force_generate: bool = False):
         """
-        Generates the CSV files for the company, based on the self.REGEX_PATTERNS and saves them in the CSV_DIR
+        Counts the search terms for the company, based on the self.REGEX_PATTERNS, and saves them in the results file,
+        and in CSV files in the CSV_DIR if they are exported
         :param company_name: The name of the company
         :param force_generate: bool, set to True to generate the CSV even is found
-        :return:
+        :return: bool, True if the results of the company were generated
         """
-        company_csvs = os.listdir(self.CSV_DIR)
-        company_csvs = [f for f in company_csvs if f.endswith("csv") and company_name in f]
-        if not force_generate and len(company_csvs) == len(self.DATAFRAME_COLUMNS):
-            logger.info(f"The CSV files for company {company_name} are already generated")
-            return
+        year_files = self.year_files(company_name)
+        csvs = self.csv_outputs(company_name)
+        if self.cache is not None:
+            fingerprint = self.results_fingerprint(year_files)
+            if not force_generate and self.is_results_fresh(company_name, fingerprint):
+                logger.info(f"The CSV files for company {company_name} are already generated")
+                return False
+        else:
+            if company_name not in self.results.companies and csvs and all(os.path.exists(f) for f in csvs):
+                self.load_results(company_name)
+            if not force_generate and company_name in self.results.companies and \
+                    all(os.path.exists(f) for f in csvs):
+                logger.info(f"The CSV files for company {company_name} are already generated")
+                return False
         logger.info(f"Generating CSV files for company {company_name}")
-        company_files = [f for f in self.files if company_name in f]
-        for year in self.YEARS:
-            for file in company_files:
-                if str(year) in file:
-                    # found the file for that particular year
-                    logger.debug(f"Found data for company {company_name} for year {year}")
-                    self.update_df(file, company_name, year)
-                    break
-            else:
-                logger.debug(f"Did not find data for company {company_name} for year {year}")
-                self.update_df(None, company_name, year, add_empty=True)
+        self.update_results(company_name, year_files)
+        self.save_results()
+        if self.export_csvs:
+            with recorder.stage("write_csvs", company_name) as counters:
+                frames = {key: self.results.company_frame(key, company_name) for key in self.DATAFRAME_COLUMNS}
+                self.export_csvs_for_company(company_name, frames)
+                counters["bytes_written"] = sum(os.path.getsize(f) for f in csvs)
+        if self.cache is not None:
+            self.cache.record_output(f"csv:{company_name}", fingerprint)
+        return True
+
+    def results_built_from(self, company_name: str) -> Union[str, None]:
+        """
+        The fingerprint of the current results of a company, that its graphs and doc are built from. Needs the cache.
+        :param company_name: The name of the company, or all for the aggregate of all the companies
+        :return: the fingerprint recorded when the results were generated, the one of the aggregate for all
+        """
+        if company_name == "all":
+            return self.aggregate_fingerprint()
+        return self.cache.manifest["outputs"].get(f"csv:{company_name}")
 
-        for df_id in self.dfs:
-            if company_name in df_id:
-                self.dfs[df_id].to_csv(f"{self.CSV_DIR}/{df_id}.csv")
+    def is_built_from_results(self, name: str, company_name: str) -> bool:
+        """
+        Checks if the graphs or the doc of a company were built from its current results, eg. not before the results
+        were generated again by another stage. Always True without the cache, then only the existence of the files is
+        checked.
+        :param name: The name of the output, ie. graphs or doc
+        :param company_name: The name of the company, or all for the aggregate of all the companies
+        :return: bool, True if they were built from the current results
+        """
+        return self.cache is None or \
+            self.cache.manifest["outputs"].get(f"{name}:{company_name}") == self.results_built_from(company_name)
+
+    def record_built_from_results(self, name: str, company_name: str):
+        """
+        Records that the graphs or the doc of a company were built from its current results, if there is a cache
+        :param name: The name of the output, ie. graphs or doc
+        :param company_name: The name of the company, or all for the aggregate of all the companies
+        """
+        if self.cache is not None:
+            self.cache.record_output(f"{name}:{company_name}", self.results_built_from(company_name))
+
+    def graph_jobs(self, company_name: str, force_generate: bool = False) -> List[ChartJob]:
+        """
+        Lists the graphs of the company that need to be rendered, the missing ones, or all of them if they were not
+        built from the current results
+        :param company_name: The name of the company
+        :param force_generate: bool, set to True to generate the graphs even if found
+        :return: the list of charts to render, with their data
+        """
+        jobs = []
+        frames = None
+        fresh = not force_generate and self.is_built_from_results("graphs", company_name)
+        for key in self.DATAFRAME_COLUMNS:
+            graph = self.catalog.graph(company_name, key)
+            if os.path.exists(graph) and fresh:
+                logger.info(f"The graph for company {company_name} based on {key} results is already generated")
+                continue
+            logger.info(f"Generating graph for company {company_name} based on {key} results")
+            # Read the results of the company once, filtered on the company
+            if frames is None:
+                frames = self.read_results(company_name)
+            df = frames[key]
+            jobs.append((f'{company_name} Data Over Years', df.index.tolist(),
+                         {column: df[column].tolist() for column in df.columns}, graph))
+        return jobs
 
     def generate_graphs(self, company_name: str, force_generate: bool = False):
         """
@@ -201,51 +404,64 @@ class GenerateGraphs:
         :param company_name: The name of the company
         :param force_generate: bool, set to True to generate the CSV even is found
         """
-        files = os.listdir(self.CSV_DIR)
-        files = [f for f in files if f.endswith("csv") and company_name in f]
+        self.render_graphs(self.graph_jobs(company_name, force_generate), company_name)
+        self.record_built_from_results("graphs", company_name)
 
-        for file in files:
-            if os.path.exists(f"{self.CSV_DIR}/{file.split('.csv')[0]}_graph.jpg") and not force_generate:
-                logger.info(f"The graph for company {company_name} based on CSV file {file} is already generated")
-                continue
-            logger.info(f"Generating graph for company {company_name} based on CSV file {file}")
-            # Read the CSV file into a DataFrame
-            df = pd.read_csv(f"{self.CSV_DIR}/{file}", index_col=0)
-            # Plotting the graph
-            plt.figure(figsize=(10, 6))  # You can change the figure size as needed
-            # Loop through each column (except the index) and plot
-            for column in df.columns:
-                plt.plot(df.index, df[column], marker='o', label=column)
-            # Adding labels and title
-            plt.xlabel('Year')
-            plt.ylabel('Values')
-            plt.title(f'{company_name} Data Over Years')
-            plt.legend()
-            plt.grid(True)
-            # Save the figure
-            plt.savefig(f"{self.CSV_DIR}/{file.split('.csv')[0]}_graph.jpg")
-            # Close the figure to prevent the warning
-            plt.close()
+    def generate_graphs_for_companies(self, companies: Dict[str, bool]):
+        """
+        Generates the graphs of several companies in a single batch, so that the rendering processes are shared
+        :param companies: dict of company name -> force_generate, True to generate its graphs even if found
+        """
+        jobs = []
+        for company_name, force_generate in companies.items():
+            jobs.extend(self.graph_jobs(company_name, force_generate))
+        self.render_graphs(jobs)
+        for company_name in companies:
+            self.record_built_from_results("graphs", company_name)
+
+    def render_graphs(self, jobs: List[ChartJob], company_name: str = ""):
+        """
+        Renders the graphs, across the rendering processes
+        :param jobs: The list of charts to render, as returned by graph_jobs
+        :param company_name: The name of the company the graphs are for, empty for a batch of several companies
+        """
+        if not jobs:
+            return
+        with recorder.stage("render_graphs", company_name, graphs=len(jobs)) as counters:
+            render_charts(jobs, self.render_workers)
+            counters["bytes_written"] = sum(os.path.getsize(job[3]) for job in jobs)
 
     def generate_doc(self, company_name: str, force_generate: bool = False):
         """"
-        Generates the doc files for the company that includes the graphs and the csv data into a single doc
+        Generates the doc files for the company that includes the graphs and the results tables into a single doc
         :param company_name: The name of the company
         :param force_generate: bool, set to True to generate the CSV even is found
         """
         logger.info(f"Generating the doc file for company {company_name}")
-        if not os.path.exists(f"{self.DOCS_DIR}"):
-            logger.error(f"The directory {self.DOCS_DIR} does not exist, creating it")
-            os.mkdir(self.DOCS_DIR)
+        if not os.path.exists(self.catalog.docs_dir):
+            logger.error(f"The directory {self.catalog.docs_dir} does not exist, creating it")
+            os.mkdir(self.catalog.docs_dir)
 
-        if not force_generate and os.path.exists(f"{self.DOCS_DIR}/{company_name}.docx"):
+        if not force_generate and os.path.exists(self.catalog.doc(company_name)) and \
+                self.is_built_from_results("doc", company_name):
             logger.info(f"The doc file for company {company_name} is already generated")
             return
-        files = os.listdir(self.CSV_DIR)
-        csv_files = [f for f in files if f.endswith("csv") and company_name in f]
-        jpg_files = [f for f in files if f.endswith("jpg") and company_name in f]
-        csv_files.sort()
-        jpg_files.sort()
+        with recorder.stage("write_doc", company_name) as counters:
+            self._write_doc(company_name)
+            counters["bytes_written"] = os.path.getsize(self.catalog.doc(company_name))
+        self.record_built_from_results("doc", company_name)
+        logger.info(f'The Word document has been created with the results and JPG files for {company_name}.')
+
+    def _write_doc(self, company_name: str):
+        """
+        Writes the doc file of the company
+        :param company_name: The name of the company
+        """
+        from docx import Document
+        from docx.shared import Pt
+        from docx.enum.text import WD_ALIGN_PARAGRAPH
+
+        frames = self.read_results(company_name)
 
         # Create a new Document
         doc = Document()
@@ -264,18 +480,17 @@ class GenerateGraphs:
 
         doc.add_paragraph("")
 
-        for csv_file, jpg_file in zip(csv_files, jpg_files):
-            # Add CSV and JPG files to the document
-            pattern = csv_file.split("-")[0].upper()
+        for key in sorted(frames):
+            # Add the results table and JPG file to the document
+            pattern = key.upper()
             doc.add_heading(f'{pattern} COLLECTED DATA TABLE:', level=1)
-            HandleDocument.add_csv_to_doc(f"{self.CSV_DIR}/{csv_file}", doc)
+            HandleDocument.add_df_to_doc(frames[key], doc)
             doc.add_heading(f'{pattern} GRAPH:', level=1)
-            HandleDocument.add_jpg_to_doc(f"{self.CSV_DIR}/{jpg_file}", doc)
-            doc.add_page_break()  # Add a page break after each CSV/jpg content
+            HandleDocument.add_jpg_to_doc(self.catalog.graph(company_name, key), doc)
+            doc.add_page_break()  # Add a page break after each table/jpg content
 
         # Save the document
-        doc.save(f'{self.DOCS_DIR}/{company_name}.docx')
-        logger.info(f'The Word document has been created with the CSV and JPG files for {company_name}.')
+        doc.save(self.catalog.doc(company_name))
 
     def analyse_and_plot_data_for_company(self, company_name: str, force_generate: bool = False):
         """
@@ -286,40 +501,82 @@ class GenerateGraphs:
         4. Populate doc files with these graphs
         :param company_name: String identifing the company, same as in the PDF file, REP for Reposol
         :param force_generate: bool, set to True to generate the CSV even is found
+        :return: bool, True if the outputs of the company were generated
         """
         logger.info(f"Analysing and plotting data for company {company_name}")
-        self.generate_csvs_for_company(company_name, force_generate)
-        self.generate_graphs(company_name, force_generate)
-        self.generate_doc(company_name, force_generate)
+        with profile(company_name):
+            # new CSV files make the existing graphs and doc stale
+            force_generate = self.generate_csvs_for_company(company_name, force_generate) or force_generate
+            self.generate_graphs(company_name, force_generate)
+            self.generate_doc(company_name, force_generate)
+        return force_generate
+
+    def aggregate_fingerprint(self) -> str:
+        """
+        The fingerprint of the aggregate, that changes when the results of any company changed. Needs the cache.
+        :return: the fingerprint
+        """
+        return self.cache.fingerprint(
+            {company: self.cache.manifest["outputs"].get(f"csv:{company}") for company in self.companies})
 
-    def generate_aggregated_doc(self):
+    def aggregate_outputs(self) -> List[str]:
         """
-        Go over all the companies and generate an aggregated doc file with a table and graph adding the existing csvs
+        :return: The CSV files, the graphs and the doc of the aggregate
         """
-        logger.info(f"Generating the aggregated doc file")
-        # create csv files for each of the dataframes
-        for key in self.DATAFRAME_COLUMNS:
-            df_id = f"{key}-all"
-            if df_id not in self.dfs:
-                self.dfs[df_id] = pd.DataFrame(columns=self.DATAFRAME_COLUMNS[key], index=self.YEARS)
-                # set it all to zeroes
-                for year in self.YEARS:
-                    self.dfs[df_id].loc[year] = 0
-            for company in self.companies:
-                company_df = pd.read_csv(f"{self.CSV_DIR}/{key}-{company}.csv", index_col=0)
-                # sum the values for each year
-                for year in self.YEARS:
-                    self.dfs[df_id].loc[year] += company_df.loc[year]
-            # generate the csv file
-            self.dfs[df_id].to_csv(f"{self.CSV_DIR}/{df_id}.csv")
-        self.generate_graphs("all")
-        self.generate_doc("all")
+        return self.csv_outputs("all") + [self.catalog.graph("all", key) for key in self.DATAFRAME_COLUMNS] + \
+            [self.catalog.doc("all")]
+
+    def stale_outputs(self) -> Dict[str, List[str]]:
+        """
+        Finds the outputs that the next run would generate, without generating anything. Needs the cache.
+        The graphs and the doc of a company are stale when they are missing, when its results are stale, or when they
+        were not built from its current results, eg. generated by another stage since.
+        :return: dict of stage, ie. csv, graphs, doc and aggregate -> the stale companies
+        """
+        stale = {"csv": [], "graphs": [], "doc": [], "aggregate": []}
+        for company in self.companies:
+            results_stale = not self.is_results_fresh(company, self.results_fingerprint(self.year_files(company)))
+            if results_stale:
+                stale["csv"].append(company)
+            graphs = [self.catalog.graph(company, key) for key in self.DATAFRAME_COLUMNS]
+            if results_stale or not all(os.path.exists(graph) for graph in graphs) or \
+                    not self.is_built_from_results("graphs", company):
+                stale["graphs"].append(company)
+            if results_stale or not os.path.exists(self.catalog.doc(company)) or \
+                    not self.is_built_from_results("doc", company):
+                stale["doc"].append(company)
+        # the results of the stale companies change the fingerprint of the aggregate once they are generated
+        if stale["csv"] or not self.cache.is_fresh("aggregate", self.aggregate_fingerprint(), self.aggregate_outputs()):
+            stale["aggregate"].append("all")
+        return stale
+
+    def generate_aggregated_doc(self, force_generate: bool = False):
+        """
+        Go over all the companies and generate an aggregated doc file with a table and graph adding their results
+        :param force_generate: bool, set to True to generate the doc even if no company changed
+        """
+        if self.cache is not None:
+            fingerprint = self.aggregate_fingerprint()
+            if not force_generate and self.cache.is_fresh("aggregate", fingerprint, self.aggregate_outputs()):
+                logger.info("The aggregated doc file is already generated")
+                return
+            force_generate = True
+        logger.info("Generating the aggregated doc file")
+        # create csv files for each of the categories, summing all the companies from the results file
+        if self.export_csvs:
+            self.export_csvs_for_company("all", self.read_results("all"))
+        self.generate_graphs("all", force_generate)
+        self.generate_doc("all", force_generate)
+        if self.cache is not None:
+            self.cache.record_output("aggregate", fingerprint)
 
 
 if __name__ == '__main__':
+    # the name Document is the type of the documents, only imported for the annotations
+    from docx import Document as new_document
 
     # testing out the creation of the doc file
-    doc = Document()
+    doc = new_document()
 
     csv_files = os.listdir("csvs")
     csv_files = [f"csvs/{f}" for f in csv_files if f.endswith("csv")]
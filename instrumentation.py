@@ -0,0 +1,212 @@
+from contextlib import contextmanager
+from threading import Event, Lock, Thread
+from typing import Dict, Iterator, List, Tuple
+import json
+import logging
+import os
+import sys
+import threading
+import time
+
+import log_config
+
+logger = log_config.setup_logger(__name__, logging.INFO)
+
+# (stage, file, counters) as sent back by a worker process
+StageRecord = Tuple[str, str, Dict[str, float]]
+
+
+class Recorder:
+    """
+    Class that records the wall time and the counters, eg. pages, words, bytes read and written, of each stage for
+    each file. The worker processes have their own recorder, they drain it and send the records back to the main
+    process, which merges them, so the run report covers all the processes.
+    """
+
+    def __init__(self):
+        """
+        Initialize the class
+        """
+        self.started = time.time()
+        self.records: Dict[Tuple[str, str], Dict[str, float]] = {}
+        self.lock = Lock()
+
+    @contextmanager
+    def stage(self, stage: str, file: str = "", **counters) -> Iterator[Dict[str, float]]:
+        """
+        Measures the wall time of a block
+        :param stage: The name of the stage, eg. extract_words
+        :param file: The file, or company, the stage works on
+        :param counters: The initial counters of the stage, eg. pages=1
+        :return: the dict of the counters, that the block can update, eg. with the number of words
+        """
+        counters = dict(counters)
+        start = time.perf_counter()
+        try:
+            yield counters
+        finally:
+            self.add(stage, file, seconds=time.perf_counter() - start, **counters)
+
+    def add(self, stage: str, file: str = "", calls: int = 1, **counters):
+        """
+        Adds the counters of a stage
+        :param stage: The name of the stage, eg. extract_words
+        :param file: The file, or company, the stage works on
+        :param calls: The number of calls of the stage
+        :param counters: The counters to add, eg. seconds=0.1, words=1000
+        """
+        with self.lock:
+            record = self.records.setdefault((stage, file or ""), {"calls": 0})
+            record["calls"] += calls
+            for name, value in counters.items():
+                record[name] = record.get(name, 0) + value
+
+    def drain(self) -> List[StageRecord]:
+        """
+        Removes the records, eg. to send them from a worker process to the main process
+        :return: the list of records
+        """
+        with self.lock:
+            records, self.records = self.records, {}
+        return [(stage, file, counters) for (stage, file), counters in records.items()]
+
+    def merge(self, records: List[StageRecord]):
+        """
+        Adds the records of another recorder, eg. sent back by a worker process
+        :param records: the records, as returned by drain
+        """
+        for stage, file, counters in records:
+            self.add(stage, file, **counters)
+
+    def report(self) -> Dict:
+        """
+        :return: the run report, with the totals of each stage and the records of each file
+        """
+        with self.lock:
+            records = {key: dict(counters) for key, counters in self.records.items()}
+        stages, files = {}, {}
+        for (stage, file), counters in sorted(records.items()):
+            total = stages.setdefault(stage, {})
+            for name, value in counters.items():
+                total[name] = total.get(name, 0) + value
+            if file:
+                files.setdefault(file, {})[stage] = counters
+        return {"started": self.started, "wall_seconds": time.time() - self.started, "stages": stages, "files": files}
+
+    def write_report(self, path: str):
+        """
+        Writes the run report as JSON
+        :param path: The path of the report
+        """
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        with open(path, "w", encoding="utf8") as f:
+            json.dump(self.report(), f, indent=2)
+        logger.info(f"Wrote the run report to {path}")
+
+
+# the recorder of this process
+recorder = Recorder()
+
+
+class SamplingProfiler:
+    """
+    Class that samples the stack of one thread at a fixed interval from a background thread, and writes the samples
+    in the collapsed stack format of flamegraph.pl and speedscope, one line per stack with its number of samples
+    """
+
+    def __init__(self, thread_id: int = None, interval: float = 0.005):
+        """
+        Initialize the class
+        :param thread_id: The id of the thread to sample, the current thread if None
+        :param interval: The number of seconds between two samples
+        """
+        self.thread_id = threading.get_ident() if thread_id is None else thread_id
+        self.interval = interval
+        self.samples: Dict[str, int] = {}
+        self.stop_event = Event()
+        self.thread = None
+
+    def sample(self):
+        """
+        Records the current stack of the sampled thread
+        """
+        frame = sys._current_frames().get(self.thread_id)
+        stack = []
+        while frame is not None:
+            code = frame.f_code
+            stack.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+            frame = frame.f_back
+        if stack:
+            key = ";".join(reversed(stack))
+            self.samples[key] = self.samples.get(key, 0) + 1
+
+    def run(self):
+        """
+        Samples until stopped
+        """
+        while not self.stop_event.wait(self.interval):
+            self.sample()
+
+    def start(self):
+        """
+        Starts sampling in a background thread
+        """
+        self.thread = Thread(target=self.run, name="sampling-profiler", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        """
+        Stops sampling
+        """
+        self.stop_event.set()
+        if self.thread is not None:
+            self.thread.join()
+
+    def write(self, path: str):
+        """
+        Writes the samples in the collapsed stack format
+        :param path: The path of the file
+        """
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        with open(path, "w", encoding="utf8") as f:
+            for stack, count in sorted(self.samples.items()):
+                f.write(f"{stack} {count}\n")
+
+
+# the companies or files to profile, eg. PROFILE=REP,SAN-2021
+PROFILE_ENV = "PROFILE"
+PROFILE_DIR = "profiles"
+
+
+def should_profile(name: str) -> bool:
+    """
+    Checks if a company or a file was selected for profiling in the PROFILE environment variable
+    :param name: The company, eg. REP, or the file, eg. files/REP-2022.pdf
+    :return: bool, True if it is selected, a company selects all its files
+    """
+    selected = [s.strip() for s in os.environ.get(PROFILE_ENV, "").split(",") if s.strip()]
+    if not selected:
+        return False
+    name = os.path.basename(name).rsplit(".", 1)[0]
+    return name in selected or next(iter(name.split("-"))) in selected
+
+
+@contextmanager
+def profile(name: str) -> Iterator[None]:
+    """
+    Samples the current thread during the block if the company or the file was selected for profiling, the samples are
+    written to PROFILE_DIR/<name>.collapsed
+    :param name: The company, eg. REP, or the file, eg. files/REP-2022.pdf
+    """
+    if not should_profile(name):
+        yield
+        return
+    profiler = SamplingProfiler()
+    profiler.start()
+    try:
+        yield
+    finally:
+        profiler.stop()
+        path = f"{PROFILE_DIR}/{os.path.basename(name).rsplit('.', 1)[0]}.collapsed"
+        profiler.write(path)
+        logger.info(f"Wrote {sum(profiler.samples.values())} profile samples of {name} to {path}")
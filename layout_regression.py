@@ -0,0 +1,337 @@
+from copy import deepcopy
+from typing import TYPE_CHECKING, List, Dict, Tuple
+import argparse
+import logging
+import os
+import random
+import sys
+
+import numpy as np
+
+import log_config
+from pdf_processor import PdfProcessor, PageLayout, WordTable, get_cutoffs
+
+if TYPE_CHECKING:
+    from pdfplumber.page import Page
+
+logger = log_config.setup_logger(__name__, logging.INFO)
+
+
+def reference_extract_columns(words: List[Dict], cutoff_x: float, cutoff_col: float) -> List[List[Dict]]:
+    """
+    The original column detection, with linear scans over the columns, kept as the reference for the regression checks
+    :param words: a list of words, as returned by pdfplumber extract_words
+    :param cutoff_x: the CUTOFF_X of the company
+    :param cutoff_col: the CUTOFF_COL of the company
+    :return: the list of words columns
+    """
+    if not words:
+        return []
+    columns = [[]]
+    prev_word = (deepcopy(words[0]), 0)
+    prev_word[0]['x1'] = words[0]['x0'] - 1
+    for word in words:
+        if word['x0'] - prev_word[0]['x1'] < cutoff_x:
+            # determine the column index of this word:
+            if word['x0'] - prev_word[0]['x1'] > 0:
+                idx = prev_word[1]
+            else:
+                # we are starting from a new line, need to determine the column:
+                for i, c in enumerate(columns):
+                    if not c:
+                        continue
+                    if abs(word['x0'] - c[0]['x0']) < cutoff_col:
+                        idx = i
+                        break
+                else:
+                    # it is a new column, add it
+                    # if it is before existing columns, re-order them
+                    idx = len(columns) - 1  # Default index if no reordering is needed
+                    for i, column in enumerate(columns):
+                        if word['x0'] < column[0]['x0']:
+                            columns.insert(i, [])
+                            idx = i
+                            break
+            columns[idx].append(word)
+        else:
+            # new column, need to match with existing columns first
+            for cindex, c in enumerate(columns):
+                if cindex < prev_word[1]:
+                    continue
+                if abs(word['x0'] - c[0]['x0']) < cutoff_col:
+                    idx = cindex
+                    break
+            else:
+                columns.append([])
+                idx = 0
+                # we added a column in the middle, need to reshuffle
+                for cindex in range(len(columns) - 1, -1, -1):
+                    if columns[cindex - 1][0]['x0'] > word['x0']:
+                        columns[cindex] = columns[cindex - 1]
+                    else:
+                        idx = cindex
+                        break
+                columns[idx] = []
+            columns[idx].append(word)
+        prev_word = (word, idx)
+    return columns
+
+
+def reference_split_paragraphs(columns: List[List[Dict]], cutoff_y: float) -> List[List[Dict]]:
+    """
+    The original paragraph split, with a scan over the words of each column, kept as the reference for the regression
+    checks
+    :param columns: the list of words columns
+    :param cutoff_y: the CUTOFF_Y of the company
+    :return: the list of paragraphs, before the multi-column paragraph merge
+    """
+    paragraphs = []
+    for column in columns:
+        if not column:
+            continue
+        paragraphs.append([])
+        for word in column:
+            if paragraphs[-1] and word["top"] - paragraphs[-1][-1]["bottom"] > cutoff_y:
+                # need to add a new paragraph
+                paragraphs.append([])
+            paragraphs[-1].append(word)
+    return paragraphs
+
+
+def reference_merge_paragraphs(paragraphs: List[List[Dict]], previous_page_paragraphs: List[List[Dict]]) \
+        -> List[List[Dict]]:
+    """
+    The original multi-column paragraph merge, that removes the merged paragraphs from the list it iterates over,
+    kept as the reference for the regression checks
+    :param paragraphs: the paragraphs of the page, as returned by split_paragraphs
+    :param previous_page_paragraphs: the final paragraphs of the previous page
+    :return: the list of paragraphs left on the page
+    """
+    for p in paragraphs:
+        if p[0]['text'].islower():
+            prev_paragraphs = []
+            for pre in paragraphs:
+                if pre == p:
+                    break
+                prev_paragraphs.append(pre)
+            prev_paragraphs = prev_paragraphs[::-1]
+            for parent in prev_paragraphs:
+                if len(parent) > 10 and parent[-1]['text'][-1] not in PdfProcessor.PUNCTUATION and \
+                        abs((parent[-1]["bottom"] - parent[-1]["top"]) - (p[0]["bottom"] - p[0]["top"])) < 0.1:
+                    parent.extend(p)
+                    paragraphs.remove(p)
+                    break
+            else:
+                for prev_p in previous_page_paragraphs[::-1]:
+                    if len(prev_p) > 10 and prev_p[-1]['text'][-1] not in PdfProcessor.PUNCTUATION and \
+                            prev_p[-1]["bottom"] - prev_p[-1]["top"] == p[0]["bottom"] - p[0]["top"]:
+                        prev_p.extend(p)
+                        paragraphs.remove(p)
+                        break
+    return paragraphs
+
+
+def column_assignment(words: List[Dict], columns: List[List[Dict]]) -> List[List[int]]:
+    """
+    Converts columns of words into columns of word positions, so that they can be compared with the word table columns
+    :param words: the list of words of the page
+    :param columns: the columns of these words
+    :return: the list of columns, each a list of positions in words
+    """
+    positions = {id(word): i for i, word in enumerate(words)}
+    return [[positions[id(word)] for word in column] for column in columns]
+
+
+def check_words(proc: PdfProcessor, words: List[Dict]) -> bool:
+    """
+    Checks that the column detection and the paragraph split of the processor give the same columns and paragraphs
+    as the reference on these words, and that the single column test agrees with the column detection
+    :param proc: the processor, with the cutoffs of the company
+    :param words: the list of words of the page
+    :return: bool, True if the columns and paragraphs are the same
+    """
+    reference = reference_extract_columns(words, proc.CUTOFF_X, proc.CUTOFF_COL)
+    expected = column_assignment(words, reference)
+    table = WordTable(words)
+    columns = proc.extract_columns(table)
+    if [column.tolist() for column in columns] != expected:
+        return False
+    # a page without words is triaged before the single column test
+    if words and proc.is_single_column(table) != (expected == [list(range(len(words)))]):
+        return False
+    paragraphs = proc.split_paragraphs(table, columns).paragraphs
+    return [p.tolist() for p in paragraphs] == column_assignment(words, reference_split_paragraphs(reference,
+                                                                                                     proc.CUTOFF_Y))
+
+
+def triaged_columns(proc: PdfProcessor, page: "Page", table: WordTable) -> List[np.ndarray]:
+    """
+    The columns of a page as layout_page finds them, a single column page is not analysed
+    :param proc: the processor, with the cutoffs of the company
+    :param page: the pdf plumber object
+    :param table: the words of the page
+    :return: the list of columns, each an array of word positions
+    """
+    kind = proc.triage_page(page, table)
+    if kind in (proc.EMPTY, proc.IMAGE_ONLY):
+        return []
+    if kind == proc.SINGLE_COLUMN:
+        return [np.arange(len(table), dtype=np.int32)]
+    return proc.extract_columns(table)
+
+
+def check_paragraphs(proc: PdfProcessor, pages: List[Tuple[List[Dict], List[List[int]]]]) -> List[int]:
+    """
+    Checks that the paragraph merge of the processor gives the same paragraphs as the reference on these pages
+    :param proc: the processor, with the cutoffs of the company
+    :param pages: the words of each page, with its paragraphs before the merge as lists of word positions
+    :return: the list of page numbers with different paragraphs
+    """
+    reference_pages, layouts = [], []
+    word_keys, table_pages = {}, {}
+    proc.previous_page_paragraphs = None
+    for number, (words, paragraphs) in enumerate(pages):
+        word_keys.update({id(word): (number, i) for i, word in enumerate(words)})
+        reference_pages.append(reference_merge_paragraphs([[words[i] for i in p] for p in paragraphs],
+                                                          reference_pages[-1] if reference_pages else []))
+        table = WordTable(words)
+        table_pages[id(table)] = number
+        layouts.append(proc.merge_paragraphs(PageLayout(table, [np.array(p, dtype=np.int32) for p in paragraphs])))
+        proc.previous_page_paragraphs = layouts[-1]
+
+    different = []
+    # the pages are only compared at the end, as the merge can extend the previous page as well
+    for number, (reference, layout) in enumerate(zip(reference_pages, layouts), 1):
+        expected = [[word_keys[id(word)] for word in p] for p in reference]
+        merged = []
+        for i, p in enumerate(layout.paragraphs):
+            keys = [(number - 1, position) for position in p.tolist()]
+            for table, positions in layout.continued.get(i, ()):
+                keys.extend((table_pages[id(table)], position) for position in positions.tolist())
+            merged.append(keys)
+        if merged != expected:
+            different.append(number)
+    return different
+
+
+def check_file(filename: str) -> List[int]:
+    """
+    Checks every page of a PDF file, the paragraphs are merged from the ones of the triaged path
+    :param filename: the path of the PDF file
+    :return: the list of page numbers with different columns or paragraphs
+    """
+    proc = PdfProcessor(filename)
+    different = []
+    pages = []
+    try:
+        for number, page in enumerate(proc.pages, 1):
+            words = page.extract_words()
+            if not check_words(proc, words):
+                different.append(number)
+            table = WordTable(words)
+            # the triaged path must give the columns of the column detection
+            columns = triaged_columns(proc, page, table)
+            if [column.tolist() for column in columns] != [column.tolist() for column in proc.extract_columns(table)]:
+                different.append(number)
+            layout = proc.split_paragraphs(table, columns)
+            pages.append((words, [p.tolist() for p in layout.paragraphs]))
+            PdfProcessor.release_page(page)
+    finally:
+        proc.close()
+    return sorted(set(different + check_paragraphs(proc, pages)))
+
+
+def random_words(rng: random.Random, count: int, max_columns: int = 12) -> List[Dict]:
+    """
+    Generates the words of a random multi column page, with lines of varying start, tables and narrow columns
+    :param rng: the random generator
+    :param count: the number of words
+    :param max_columns: the maximum number of column starts, 1 gives pages that are mostly a single column
+    :return: the list of words, in the order pdfplumber returns them: line by line, left to right
+    """
+    words = []
+    column_starts = sorted(rng.uniform(20, 560) for _ in range(rng.randint(1, max_columns)))
+    top = 20.0
+    while len(words) < count:
+        height = rng.choice([8.0, 9.96, 10.0, 12.0])
+        for start in column_starts:
+            x = start + rng.choice([0, 0, 0, rng.uniform(-20, 20)])
+            for _ in range(rng.randint(0, 6)):
+                width = rng.uniform(3, 40)
+                words.append({"text": "w", "x0": x, "x1": x + width, "top": top, "bottom": top + height})
+                x += width + rng.choice([2.5, 3.0, rng.uniform(0, 30)])
+        top += height + rng.uniform(0, 10)
+    return words[:count]
+
+
+def random_paragraphs(rng: random.Random, count: int) -> Tuple[List[Dict], List[List[int]]]:
+    """
+    Generates the paragraphs of a random page, with many short fragments starting in lowercase
+    :param rng: the random generator
+    :param count: the number of paragraphs
+    :return: the words of the page, with its paragraphs as lists of word positions
+    """
+    words, paragraphs = [], []
+    for _ in range(count):
+        paragraph = []
+        for _ in range(rng.choice([1, 2, 3, 5, 11, 12, 20])):
+            height = rng.choice([8.0, 9.96, 10.0, 10.05, 12.0])
+            text = rng.choice(["word", "Word", "end.", "quote\"", "and", "x"])
+            # the position makes every word unique, as on a real page
+            paragraph.append(len(words))
+            words.append({"text": text, "x0": float(len(paragraph)), "x1": len(paragraph) + 1.0,
+                          "top": float(len(paragraphs)), "bottom": len(paragraphs) + height})
+        paragraphs.append(paragraph)
+    return words, paragraphs
+
+
+def fuzz(pages: int, seed: int = 0) -> int:
+    """
+    Checks the column detection, the single column test, the paragraph split and the paragraph merge on random pages,
+    with the cutoffs of every company
+    :param pages: the number of random pages per company
+    :param seed: the seed of the random generator
+    :return: the number of pages with different columns or paragraphs
+    """
+    rng = random.Random(seed)
+    different = 0
+    for company in ("default", "REP", "MTS", "BBVA"):
+        proc = PdfProcessor.__new__(PdfProcessor)
+        cutoffs = get_cutoffs(f"{company}-0000.pdf")
+        proc.CUTOFF_X, proc.CUTOFF_Y, proc.CUTOFF_COL = cutoffs["CUTOFF_X"], cutoffs["CUTOFF_Y"], cutoffs["CUTOFF_COL"]
+        for _ in range(pages):
+            if not check_words(proc, random_words(rng, rng.randint(1, 3000))):
+                different += 1
+            # short pages with one column start, so that the single column test is also true on some of them
+            if not check_words(proc, random_words(rng, rng.randint(1, 60), 1)):
+                different += 1
+        different += len(check_paragraphs(proc, [random_paragraphs(rng, rng.randint(0, 300)) for _ in range(pages)]))
+    return different
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Checks that the column detection and the paragraph merge give the "
+                                                 "same result as the original implementation")
+    parser.add_argument("pdfs", nargs="*", help="the PDF files to check, all the PDFs in files/ by default")
+    parser.add_argument("--fuzz", type=int, default=0, help="also check this many random pages per company")
+    args = parser.parse_args()
+
+    if not args.pdfs and not os.path.isdir("files"):
+        parser.error("no PDF files given and there is no files/ directory")
+    pdfs = args.pdfs or [f"files/{f}" for f in sorted(os.listdir("files")) if f.endswith("pdf")]
+    failed = False
+    for pdf in pdfs:
+        pages = check_file(pdf)
+        if pages:
+            failed = True
+            logger.error(f"The layout of {pdf} is different on pages {pages}")
+        else:
+            logger.info(f"The layout of {pdf} is unchanged")
+    if args.fuzz:
+        different = fuzz(args.fuzz)
+        if different:
+            failed = True
+            logger.error(f"The layout is different on {different} random pages")
+        else:
+            logger.info("The layout is unchanged on all the random pages")
+    sys.exit(1 if failed else 0)
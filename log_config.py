@@ -1,4 +1,11 @@
+from logging.handlers import QueueHandler, QueueListener
+from queue import SimpleQueue
+import atexit
 import logging
+import multiprocessing.util
+import os
+import sys
+import threading
 from colorlog import ColoredFormatter
 
 # Define the formatter
@@ -14,22 +21,104 @@ formatter = ColoredFormatter(
     }
 )
 
+# The levels of the modules, eg. LOG_LEVELS=pdf_processor=DEBUG,graph_generator=WARNING, they replace the levels set in
+# the code so that debug can be enabled for one module without editing it
+LEVELS_VARIABLE = "LOG_LEVELS"
+
+
+def parse_levels(spec: str) -> dict:
+    """
+    Parses the levels of the modules
+    :param spec: The comma separated module=LEVEL pairs, eg. pdf_processor=DEBUG,main=WARNING
+    :return: dict of module -> level
+    """
+    levels = {}
+    for item in spec.split(","):
+        if not item.strip():
+            continue
+        name, _, level = item.partition("=")
+        level = logging.getLevelName(level.strip().upper())
+        if not isinstance(level, int):
+            raise ValueError(f"Invalid level in {LEVELS_VARIABLE}: {item}")
+        levels[name.strip()] = level
+    return levels
+
+
+class _ListenerHandler(QueueHandler):
+    """
+    Handler that puts the records in a queue, the console output is written by a listener thread so that logging does
+    not wait for the terminal.
+    A process forked from the one that started the listener, eg. a worker of a process pool, does not have its thread,
+    so it starts its own on its first record.
+    """
+
+    def __init__(self):
+        super().__init__(SimpleQueue())
+        self.listener = None
+        self.pid = None
+        self.start_lock = threading.Lock()
+
+    def start(self):
+        """
+        Starts the listener thread of this process, if not already started
+        """
+        with self.start_lock:
+            if self.pid == os.getpid():
+                return
+            # the queue and the listener of the parent process are left to it
+            self.queue = SimpleQueue()
+            console_handler = logging.StreamHandler()
+            console_handler.setFormatter(formatter)
+            self.listener = QueueListener(self.queue, console_handler)
+            self.listener.start()
+            self.pid = os.getpid()
+            # a worker process ends without the atexit functions, but runs the multiprocessing finalizers
+            atexit.register(self.stop)
+            multiprocessing.util.Finalize(None, self.stop, exitpriority=100)
+
+    def stop(self):
+        """
+        Writes the records still in the queue and stops the listener thread, nothing is lost at exit
+        """
+        with self.start_lock:
+            if self.pid != os.getpid():
+                return
+            self.listener.stop()
+            self.pid = None
+
+    def enqueue(self, record: logging.LogRecord):
+        if self.pid != os.getpid():
+            self.start()
+        super().enqueue(record)
+
+    def after_fork(self):
+        # the lock may have been held by another thread of the parent process when it was forked
+        self.start_lock = threading.Lock()
+
+
+_handler = _ListenerHandler()
+os.register_at_fork(after_in_child=_handler.after_fork)
+_levels = parse_levels(os.environ.get(LEVELS_VARIABLE, ""))
+
 
 def setup_logger(name, level=logging.INFO) -> logging.Logger:
     """
     Sets up the logger with the proper level and colors.
-    Needed to only enable debug for my code and not the libraries that are used
+    Needed to only enable debug for my code and not the libraries that are used.
+    The records go through a queue to a listener thread that writes them. Setting up a logger again does not add
+    another handler, and the level in the LOG_LEVELS environment variable, if any, replaces the given one.
     :param name: Name of the logger, use __name__
     :param level: The logger level
     :return: the logger class instance
     """
     logger = logging.getLogger(name)
-    logger.setLevel(level)
-
-    # Create a console handler and set the formatter
-    console_handler = logging.StreamHandler()
-    console_handler.setFormatter(formatter)
+    # the module run as a script is named after its file in LOG_LEVELS, eg. main
+    module = name
+    if name == "__main__" and getattr(sys.modules[name], "__file__", None):
+        module = os.path.splitext(os.path.basename(sys.modules[name].__file__))[0]
+    logger.setLevel(_levels.get(module, _levels.get(name, level)))
 
-    # Add the handler to the logger
-    logger.addHandler(console_handler)
+    # Add the queue handler to the logger, once
+    if _handler not in logger.handlers:
+        logger.addHandler(_handler)
     return logger
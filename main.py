@@ -1,7 +1,16 @@
 import os
 import logging
-from pdf_processor import PdfProcessor
+from concurrent.futures import FIRST_COMPLETED, Future, ProcessPoolExecutor, as_completed, wait
+from concurrent.futures.process import BrokenProcessPool
+from typing import Callable, Dict, Iterator, List, Tuple, Union
+from catalog import CorpusCatalog
 from graph_generator import GenerateGraphs
+from pdf_processor import PdfProcessor, extraction_config
+from instrumentation import StageRecord, recorder
+from pipeline import Pipeline
+from manifest_cache import ManifestCache
+from term_index import TermIndex
+from term_scanner import StreamingScanner, TermScanner
 import log_config
 
 logger = log_config.setup_logger(__name__, logging.DEBUG)
@@ -9,33 +18,225 @@ logger = log_config.setup_logger(__name__, logging.DEBUG)
 
 # pdf_file_path = 'files/REP-2022.pdf'
 pdf_dir = "files"
+# number of processes used to decode new PDFs, 1 decodes them one by one in this process
+decode_workers = int(os.environ.get("DECODE_WORKERS", os.cpu_count() or 1))
+# number of companies whose reports are generated at the same time, each in its own process
+report_workers = int(os.environ.get("REPORT_WORKERS", os.cpu_count() or 1))
+# number of processes used to render the graphs rendered in one batch in this process, ie. of all the companies when
+# there is one report worker, and of the aggregate
+render_workers = int(os.environ.get("RENDER_WORKERS", os.cpu_count() or 1))
+# machine-readable report of the time, pages, words and bytes of each stage and file of the run
+run_report = os.environ.get("RUN_REPORT", f"{ManifestCache.CACHE_DIR}/run_report.json")
 
 
-def decoded_file_exists(pdf_file: str) -> bool:
-    txt_file = pdf_file.replace("pdf", "txt")
-    return os.path.exists(txt_file)
+def txt_path(pdf: str) -> str:
+    """
+    :param pdf: The path of the PDF file
+    :return: The path of its txt file, next to the PDF
+    """
+    return pdf.replace("pdf", "txt")
+
+
+# the counts of the search terms of a decoded file, with the sha256 and the size of its text
+Counted = Tuple[Dict[str, List[int]], str, int]
+# the path of the PDF, the error message, the stage records and the counts of the text
+DecodeResult = Tuple[str, Union[str, None], List[StageRecord], Union[Counted, None]]
+
+
+def decode_file(pdf: str, txt: Union[str, None] = None) -> DecodeResult:
+    """
+    Opens and decodes a single PDF, any error is caught so that one bad file does not stop the others.
+    The text of each page is handed to a streaming scanner as soon as it is written, so the search terms are counted
+    while the next pages are decoded, and the counts are ready without reading the txt file back.
+    :param pdf: The path of the PDF file
+    :param txt: The path of the txt file, next to the PDF if None
+    :return: tuple with the path of the PDF, the error message, None if it was decoded successfully, the stage
+    records, that the caller merges back as the file may be decoded in another process, and the counts of the text,
+    None if it failed
+    """
+    try:
+        proc = PdfProcessor(pdf, txt)
+        scanner = StreamingScanner(TermScanner(GenerateGraphs.REGEX_PATTERNS))
+        try:
+            proc.process_file(streaming=True, on_text=scanner.put)
+        finally:
+            # the time the counting takes after the last page is decoded
+            with recorder.stage("stream_count", pdf) as counters:
+                counted = scanner.close()
+                counters["bytes_read"] = counted[2]
+    except Exception as e:
+        return pdf, f"{type(e).__name__}: {e}", recorder.drain(), None
+    return pdf, None, recorder.drain(), counted
+
+
+def store_decoded(pdf: str, counted: Counted, cache: ManifestCache, txt: Union[str, None] = None):
+    """
+    Records the decoded file in the cache, with the hash and the counts of its text computed while it was decoded, so
+    that they are reused without reading the txt file back
+    :param pdf: The path of the PDF file
+    :param counted: The counts, the sha256 and the size of the text, as returned by decode_file
+    :param cache: The manifest cache
+    :param txt: The path of the txt file, next to the PDF if None
+    """
+    txt = txt_path(pdf) if txt is None else txt
+    counts, sha256, size = counted
+    cache.store_hash(txt, sha256, size)
+    cache.store_decoded(pdf, txt, extraction_config(pdf))
+    cache.store_counts(cache.counts_key(txt, GenerateGraphs.REGEX_PATTERNS), counts)
 
 
-def check_and_decode_new_files():
+def _future_result(future: Future, pdf: str) -> DecodeResult:
+    """
+    :param future: The future of decode_file
+    :param pdf: The path of the PDF file
+    :return: the result of decode_file, or a failure if the process decoding the file died
+    """
+    try:
+        return future.result()
+    except Exception as e:
+        # the worker process itself died, eg killed for using too much memory
+        return pdf, f"{type(e).__name__}: {e}", [], None
+
+
+def decode_isolated(pdfs: List[str], workers: int, txt_of: Callable[[str], str] = txt_path) -> Iterator[DecodeResult]:
+    """
+    Decodes each PDF in its own process, at most workers at a time, so that a process that dies only fails its file
+    :param pdfs: The paths of the PDF files
+    :param workers: The number of processes decoding the PDFs at the same time
+    :param txt_of: The function giving the path of the txt file of a PDF
+    :return: the results of decode_file, in the order the files are done
+    """
+    pending = list(pdfs)
+    running = {}
+    while pending or running:
+        while pending and len(running) < workers:
+            pdf = pending.pop(0)
+            executor = ProcessPoolExecutor(max_workers=1)
+            running[executor.submit(decode_file, pdf, txt_of(pdf))] = pdf, executor
+        done, _ = wait(running, return_when=FIRST_COMPLETED)
+        for future in done:
+            pdf, executor = running.pop(future)
+            executor.shutdown()
+            yield _future_result(future, pdf)
+
+
+def decode_in_processes(pdfs: List[str], workers: int,
+                        txt_of: Callable[[str], str] = txt_path) -> Iterator[DecodeResult]:
+    """
+    Decodes the PDFs across a pool of processes. When a process dies, eg. killed for using too much memory, the pool
+    is broken and fails all the files it did not finish, without telling which one killed it, so these files are
+    decoded again each in its own process, and only the file that kills its process again fails.
+    :param pdfs: The paths of the PDF files
+    :param workers: The number of processes decoding the PDFs at the same time
+    :param txt_of: The function giving the path of the txt file of a PDF
+    :return: the results of decode_file, in the order the files are done
+    """
+    unfinished = []
+    with ProcessPoolExecutor(max_workers=min(workers, len(pdfs))) as executor:
+        futures = {executor.submit(decode_file, pdf, txt_of(pdf)): pdf for pdf in pdfs}
+        for future in as_completed(futures):
+            if isinstance(future.exception(), BrokenProcessPool):
+                unfinished.append(futures[future])
+            else:
+                yield _future_result(future, futures[future])
+    if unfinished:
+        logger.error(f"A decoding process died, decoding the {len(unfinished)} files it left unfinished again, each in "
+                     f"its own process")
+        yield from decode_isolated(unfinished, workers, txt_of)
+
+
+def is_decoded(pdf: str, cache: Union[ManifestCache, None], txt: Union[str, None] = None) -> bool:
+    """
+    Checks if the PDF needs to be decoded
+    :param pdf: The path of the PDF file
+    :param cache: The manifest cache, if None only the existence of the txt file is checked
+    :param txt: The path of the txt file, next to the PDF if None
+    :return: bool, True if the txt file is up to date
+    """
+    txt = txt_path(pdf) if txt is None else txt
+    if cache is None:
+        return os.path.exists(txt)
+    return cache.is_decoded(pdf, txt, extraction_config(pdf))
+
+
+def check_and_decode_new_files(workers: int = 1, cache: ManifestCache = None, catalog: CorpusCatalog = None,
+                               pdfs: Union[List[str], None] = None,
+                               txt_of: Callable[[str], str] = txt_path) -> Dict[str, List[str]]:
     """
     Checks is new PDFs have been added, opens and decodes them
+    :param workers: The number of processes decoding the PDFs in parallel, 1 decodes them in this process
+    :param cache: The manifest cache used to also find the PDFs that changed, or were decoded with another config
+    :param catalog: The catalog of the PDF directory, a new one if None, it is refreshed with the decoded files
+    :param pdfs: The PDFs to check, eg. the ones of a shard, all the PDFs of the catalog if None
+    :param txt_of: The function giving the path of the txt file of a PDF, eg. in the directory of a shard
+    :return: dict with the list of PDFs that were decoded, failed and skipped
     """
-    pdfs = os.listdir(pdf_dir)
-    pdfs = [f"{pdf_dir}/{f}" for f in pdfs if f.endswith("pdf")]
-    for pdf in pdfs:
-        if not decoded_file_exists(pdf):
+    summary = {"decoded": [], "failed": [], "skipped": []}
+    catalog = CorpusCatalog(pdf_dir) if catalog is None else catalog
+    new_pdfs = []
+    for pdf in catalog.pdfs() if pdfs is None else pdfs:
+        if is_decoded(pdf, cache, txt_of(pdf)):
+            summary["skipped"].append(pdf)
+        else:
             logger.info(f"Found new file {pdf} that needs to be decoded")
-            proc = PdfProcessor(pdf)
-            proc.process_file()
+            new_pdfs.append(pdf)
+
+    if workers > 1 and len(new_pdfs) > 1:
+        for result in decode_in_processes(new_pdfs, workers, txt_of):
+            _record_decode_result(result, summary, cache, txt_of)
+    else:
+        for pdf in new_pdfs:
+            _record_decode_result(decode_file(pdf, txt_of(pdf)), summary, cache, txt_of)
+
+    logger.info(f"Decoding summary: {len(summary['decoded'])} decoded, {len(summary['failed'])} failed, "
+                f"{len(summary['skipped'])} skipped")
+    triage = recorder.report()["stages"].get("triage")
+    if triage:
+        kinds = [PdfProcessor.EMPTY, PdfProcessor.IMAGE_ONLY, PdfProcessor.SINGLE_COLUMN, PdfProcessor.MULTI_COLUMN]
+        logger.info("Page triage: " + ", ".join(f"{triage.get(kind, 0)} {kind.replace('_', ' ')}" for kind in kinds) +
+                    " pages, only the multi column pages went through the column analysis")
+    # the txt files that were decoded, or restored from the cache, are added to the catalog
+    catalog.refresh()
+    if cache is not None:
+        cache.save()
+    return summary
+
+
+def _record_decode_result(result: DecodeResult, summary: Dict[str, List[str]], cache: Union[ManifestCache, None],
+                          txt_of: Callable[[str], str] = txt_path):
+    """
+    Adds the result of decoding a file to the summary
+    :param result: tuple with the path of the PDF, the error message, the stage records and the counts, as returned by
+    decode_file
+    :param summary: the summary dict that is updated
+    :param cache: The manifest cache where the decoded file and its counts are recorded, can be None
+    :param txt_of: The function giving the path of the txt file of a PDF
+    """
+    pdf, error, records, counted = result
+    recorder.merge(records)
+    if error is None:
+        logger.info(f"Decoded file {pdf}")
+        summary["decoded"].append(pdf)
+        if cache is not None:
+            store_decoded(pdf, counted, cache, txt_of(pdf))
+    else:
+        logger.error(f"Failed to decode file {pdf}: {error}")
+        summary["failed"].append(pdf)
 
 
 if __name__ == '__main__':
+    # the cache finds what changed since the last run, so only the stale files are decoded and generated again
+    cache = ManifestCache()
+    # the files are listed once, and looked up by company and year by all the stages
+    catalog = CorpusCatalog(pdf_dir)
     logger.info("Attempting to find and decode new files (if any)")
-    check_and_decode_new_files()
+    check_and_decode_new_files(decode_workers, cache, catalog)
+
+    logger.info("Indexing the decoded files")
+    index = TermIndex()
+    index.update(pdf_dir, catalog)
 
     logger.info("Generating the graphs per company")
-    graphs = GenerateGraphs(pdf_dir)
-    for company in graphs.companies:
-        graphs.analyse_and_plot_data_for_company(company, force_generate=True)
-    # in the end need to generate the aggregated doc with all the companies
-    graphs.generate_aggregated_doc()
+    # the companies are independent until the aggregated doc, that is built once all of them are done
+    Pipeline(pdf_dir, cache, index, report_workers, catalog=catalog, render_workers=render_workers).run()
+    recorder.write_report(run_report)
@@ -0,0 +1,206 @@
+from typing import Any, Dict, List, Set, Tuple, Union
+import hashlib
+import json
+import logging
+import os
+import shutil
+
+import log_config
+
+logger = log_config.setup_logger(__name__, logging.INFO)
+
+
+class ManifestCache:
+    """
+    Class that keeps track of what has already been computed, keyed by the content hash of the inputs and by the
+    configuration used, so that a rerun only redoes the files and stages whose inputs changed.
+    The manifest is a json file, the decoded text is stored next to it in the text directory.
+    """
+    CACHE_DIR = ".cache"
+    MANIFEST_FILE = "manifest.json"
+
+    def __init__(self, cache_dir: str = CACHE_DIR):
+        """
+        Initialize the class and load the existing manifest, if any
+        :param cache_dir: The directory where the manifest and the decoded text are stored
+        """
+        self.cache_dir = cache_dir
+        self.manifest_path = f"{self.cache_dir}/{self.MANIFEST_FILE}"
+        self.text_dir = f"{self.cache_dir}/text"
+        self.manifest = {"hashes": {}, "decoded": {}, "counts": {}, "outputs": {}}
+        # (section, key) of the entries set since the last take_changes, that a worker process sends back
+        self.changed: Set[Tuple[str, str]] = set()
+        if os.path.exists(self.manifest_path):
+            try:
+                with open(self.manifest_path, encoding="utf8") as f:
+                    self.manifest.update(json.load(f))
+            except (OSError, ValueError) as e:
+                logger.error(f"Could not read the cache manifest {self.manifest_path}, starting from scratch: {e}")
+
+    def save(self):
+        """
+        Writes the manifest to disk, replacing the old one only once the new one is completely written
+        """
+        os.makedirs(self.cache_dir, exist_ok=True)
+        tmp_path = f"{self.manifest_path}.tmp"
+        with open(tmp_path, "w", encoding="utf8") as f:
+            json.dump(self.manifest, f)
+        os.replace(tmp_path, self.manifest_path)
+
+    def _set(self, section: str, key: str, value: Any):
+        """
+        Sets an entry of the manifest and records that it changed
+        :param section: The section of the manifest, eg. counts
+        :param key: The key of the entry
+        :param value: The value of the entry
+        """
+        self.manifest.setdefault(section, {})[key] = value
+        self.changed.add((section, key))
+
+    @staticmethod
+    def fingerprint(*items) -> str:
+        """
+        Computes a stable hash of json serializable items, eg. a configuration dict
+        :param items: the items to hash
+        :return: the hex digest
+        """
+        return hashlib.sha256(json.dumps(items, sort_keys=True).encode("utf8")).hexdigest()
+
+    def file_hash(self, path: str) -> str:
+        """
+        Computes the sha256 of the file content. The hash is only recomputed when the size or the modification time
+        of the file changed since the last time it was hashed.
+        :param path: The path of the file
+        :return: the hex digest
+        """
+        stat = os.stat(path)
+        entry = self.manifest["hashes"].get(path)
+        if entry and entry["size"] == stat.st_size and entry["mtime"] == stat.st_mtime_ns:
+            return entry["sha256"]
+        sha = hashlib.sha256()
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(1 << 20), b""):
+                sha.update(chunk)
+        self._set("hashes", path, {"size": stat.st_size, "mtime": stat.st_mtime_ns, "sha256": sha.hexdigest()})
+        return sha.hexdigest()
+
+    def store_hash(self, path: str, sha256: str, size: int):
+        """
+        Records the hash of a file computed while it was written, eg. the decoded text hashed as it was streamed, so
+        that the file is not read back to be hashed. Nothing is recorded if the file does not have the size of the
+        hashed content, eg. when the newlines were translated.
+        :param path: The path of the file
+        :param sha256: The hex digest of the content
+        :param size: The size of the content in bytes
+        """
+        stat = os.stat(path)
+        if stat.st_size == size:
+            self._set("hashes", path, {"size": stat.st_size, "mtime": stat.st_mtime_ns, "sha256": sha256})
+
+    def decode_key(self, pdf: str, config: Dict) -> str:
+        """
+        The key of the decoded text of a PDF
+        :param pdf: The path of the PDF file
+        :param config: The extraction configuration used to decode the file
+        :return: the key
+        """
+        return self.fingerprint(self.file_hash(pdf), config)
+
+    def is_decoded(self, pdf: str, txt: str, config: Dict, restore: bool = True) -> bool:
+        """
+        Checks if the txt file is the result of decoding the current PDF with the current configuration.
+        If the txt is missing or stale, but this PDF and configuration were decoded before, the text is restored
+        from the cache.
+        :param pdf: The path of the PDF file
+        :param txt: The path where the decoded text is saved
+        :param config: The extraction configuration used to decode the file
+        :param restore: bool, set to False to only check that the text can be restored, without writing the txt file
+        :return: bool, True if the txt file is up to date
+        """
+        key = self.decode_key(pdf, config)
+        entry = self.manifest["decoded"].get(pdf)
+        if entry and entry["key"] == key and os.path.exists(txt) and self.file_hash(txt) == entry["txt_hash"]:
+            return True
+        cached_text = f"{self.text_dir}/{key}.txt"
+        if os.path.exists(cached_text) and not restore:
+            return True
+        if os.path.exists(cached_text):
+            logger.info(f"Restoring the decoded text of {pdf} from the cache")
+            shutil.copyfile(cached_text, txt)
+            self._set("decoded", pdf, {"key": key, "txt_hash": self.file_hash(txt)})
+            return True
+        return False
+
+    def store_decoded(self, pdf: str, txt: str, config: Dict):
+        """
+        Records that the PDF was decoded into the txt file, and keeps a copy of the text in the cache
+        :param pdf: The path of the PDF file
+        :param txt: The path where the decoded text was saved
+        :param config: The extraction configuration used to decode the file
+        """
+        key = self.decode_key(pdf, config)
+        os.makedirs(self.text_dir, exist_ok=True)
+        shutil.copyfile(txt, f"{self.text_dir}/{key}.txt")
+        self._set("decoded", pdf, {"key": key, "txt_hash": self.file_hash(txt)})
+
+    def counts_key(self, txt: str, patterns: Dict) -> str:
+        """
+        The key of the term counts of a decoded file
+        :param txt: The path of the decoded txt file
+        :param patterns: The search patterns used to count the terms
+        :return: the key
+        """
+        return self.fingerprint(self.file_hash(txt), patterns)
+
+    def get_counts(self, key: str) -> Union[Dict[str, List[int]], None]:
+        """
+        :param key: The key of the counts, as returned by counts_key
+        :return: the cached counts, None if they were never computed
+        """
+        return self.manifest["counts"].get(key)
+
+    def store_counts(self, key: str, counts: Dict[str, List[int]]):
+        """
+        :param key: The key of the counts, as returned by counts_key
+        :param counts: The counts to store
+        """
+        self._set("counts", key, counts)
+
+    def is_fresh(self, name: str, fingerprint: str, outputs: List[str]) -> bool:
+        """
+        Checks if the output files of a stage were generated from inputs with the same fingerprint
+        :param name: The name of the stage, eg. csv:REP
+        :param fingerprint: The fingerprint of the inputs of the stage
+        :param outputs: The files generated by the stage
+        :return: bool, True if all the outputs exist and were generated from the same inputs
+        """
+        return self.manifest["outputs"].get(name) == fingerprint and all(os.path.exists(o) for o in outputs)
+
+    def record_output(self, name: str, fingerprint: str):
+        """
+        Records the fingerprint of the inputs of a stage that was just generated
+        :param name: The name of the stage, eg. csv:REP
+        :param fingerprint: The fingerprint of the inputs of the stage
+        """
+        self._set("outputs", name, fingerprint)
+
+    def take_changes(self) -> Dict[str, Dict]:
+        """
+        Returns the entries set since the last call, eg. by a worker process, and starts recording again
+        :return: dict of section -> key -> the new value of the entry
+        """
+        changes = {}
+        for section, key in self.changed:
+            changes.setdefault(section, {})[key] = self.manifest[section][key]
+        self.changed = set()
+        return changes
+
+    def merge(self, changes: Dict[str, Dict]):
+        """
+        Adds the entries changed in another process, as returned by take_changes. Only these entries are replaced, so
+        that the other entries updated here in the meantime, eg. by another worker, are kept.
+        :param changes: dict of section -> key -> the new value of the entry
+        """
+        for section, entries in changes.items():
+            for key, value in entries.items():
+                self._set(section, key, value)
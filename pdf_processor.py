@@ -1,11 +1,21 @@
-from copy import deepcopy
-from typing import List, Dict
-
-import pdfplumber
-from pdfplumber.page import Page
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from bisect import bisect_left, bisect_right
+from heapq import heappop, heappush
+from typing import TYPE_CHECKING, Callable, List, Dict, Iterable, Iterator, TextIO, Tuple, Union
 import logging
 import os
+import pickle
+import sys
+
+import numpy as np
+
 import log_config
+from instrumentation import StageRecord, profile, recorder
+
+if TYPE_CHECKING:
+    # pdfplumber is only imported when a PDF is opened, so checking what needs decoding stays fast
+    from pdfplumber.page import Page
 
 logger = log_config.setup_logger(__name__, logging.WARNING)
 
@@ -19,6 +29,98 @@ CUTOFFS = {
     "BBVA": {"CUTOFF_X": 14, "CUTOFF_Y": 7, "CUTOFF_COL": 14},
     "default": {"CUTOFF_X": 14, "CUTOFF_Y": 5, "CUTOFF_COL": 14},
 }
+# bump this when a change in the layout code changes the decoded text, so that the cached text is not reused
+DECODER_VERSION = 1
+
+
+def get_cutoffs(filename: str) -> Dict[str, int]:
+    """
+    Returns the cutoffs used for the company of the PDF file, based on the company name in the file name
+    :param filename: the path of the PDF file
+    :return: dict with the CUTOFF_X, CUTOFF_Y and CUTOFF_COL values
+    """
+    dict_key = filename.split("/")[-1].split("-")[0]
+    return CUTOFFS.get(dict_key, CUTOFFS["default"])
+
+
+def extraction_config(filename: str) -> Dict:
+    """
+    Returns everything that determines the decoded text of the PDF file, other than the file itself
+    :param filename: the path of the PDF file
+    :return: the configuration dict
+    """
+    return {"version": DECODER_VERSION, "cutoffs": get_cutoffs(filename), "punctuation": PdfProcessor.PUNCTUATION}
+
+
+class WordTable:
+    """
+    The words of a page in columnar form: one numpy array per coordinate and an array of interned texts, instead of
+    one dict per word
+    """
+    __slots__ = ("text", "x0", "x1", "top", "bottom")
+
+    def __init__(self, words: List[Dict]):
+        """
+        :param words: the words of the page, as returned by pdfplumber extract_words
+        """
+        self.text = np.array([sys.intern(w["text"]) for w in words], dtype=object)
+        self.x0 = np.array([w["x0"] for w in words], dtype=np.float64)
+        self.x1 = np.array([w["x1"] for w in words], dtype=np.float64)
+        self.top = np.array([w["top"] for w in words], dtype=np.float64)
+        self.bottom = np.array([w["bottom"] for w in words], dtype=np.float64)
+
+    def __len__(self) -> int:
+        return len(self.text)
+
+
+class PageLayout:
+    """
+    The paragraphs of a page, each an array of word positions in the word table of the page.
+    A paragraph continued on the next page keeps the continuation as (table, positions) of the next page.
+    """
+    __slots__ = ("table", "paragraphs", "continued")
+
+    def __init__(self, table: WordTable, paragraphs: List[np.ndarray]):
+        """
+        :param table: the words of the page
+        :param paragraphs: the arrays of word positions of each paragraph
+        """
+        self.table = table
+        self.paragraphs = paragraphs
+        self.continued = {}
+
+    def __len__(self) -> int:
+        return len(self.paragraphs)
+
+    def paragraph_texts(self) -> Iterator[str]:
+        """
+        :return: generator with the text of each paragraph, including its continuation on the next page
+        """
+        for i, p in enumerate(self.paragraphs):
+            words = self.table.text[p].tolist()
+            for table, positions in self.continued.get(i, ()):
+                words.extend(table.text[positions].tolist())
+            yield " ".join(words)
+
+
+def _layout_page_range(filename: str, start: int, end: int) -> Tuple[List[PageLayout], List[StageRecord]]:
+    """
+    Worker function for the sharded mode, lays out a range of pages of the PDF in a separate process
+    :param filename: the path of the PDF file
+    :param start: index of the first page in the range
+    :param end: index after the last page in the range
+    :return: tuple with the layout of each page, before the multi-column paragraphs are merged, and the stage records
+    of the worker
+    """
+    proc = PdfProcessor(filename)
+    try:
+        result = []
+        for page in proc.pages[start:end]:
+            result.append(proc.layout_page(page))
+            PdfProcessor.release_page(page)
+        return result, recorder.drain()
+    finally:
+        proc.close()
 
 
 class PdfProcessor:
@@ -26,175 +128,550 @@ class PdfProcessor:
     My class that processes multiple column PDF files and extract the text per paragraph
     """
     PUNCTUATION = ".!?\""
+    # number of pages each worker lays out at once in the sharded mode
+    PAGES_PER_SHARD = 16
+    # margin on the binary search of the column anchors, so that rounding never hides a matching column
+    ANCHOR_EPSILON = 1e-6
+    # size of the buffer used when writing the txt file
+    WRITE_BUFFER = 1 << 20
+    # suffixes of the txt file being written and of its checkpoint, the txt file only appears once it is complete
+    PARTIAL_SUFFIX = ".partial"
+    CHECKPOINT_SUFFIX = ".checkpoint"
+    # the kinds of page of the triage, only the multi-column pages need the column analysis
+    EMPTY, IMAGE_ONLY, SINGLE_COLUMN, MULTI_COLUMN = "empty", "image_only", "single_column", "multi_column"
 
-    def __init__(self, filename: str):
+    def __init__(self, filename: str, txt_filename: Union[str, None] = None):
+        """
+        Initialize the class and open the pdf file
+        :param filename: The path of the pdf file
+        :param txt_filename: The path of the txt file, next to the pdf file if None
+        """
         self.extracted_text = ""
         self.filename = filename
+        self.txt_filename = filename.replace('pdf', 'txt') if txt_filename is None else txt_filename
         self.paragraphs = []
-        self.previous_page_paragraphs = []
+        self.previous_page_paragraphs = None
         if not os.path.exists(filename):
             logger.error(f"Invalid file path {filename}")
             raise Exception("File not found")
         try:
-            self.plumber = pdfplumber.open(self.filename)
+            import pdfplumber
+            with recorder.stage("open", self.filename, bytes_read=os.path.getsize(filename)):
+                self.plumber = pdfplumber.open(self.filename)
             logger.info(f"Successfully loaded file {self.filename} with {len(self.plumber.pages)} pages")
         except Exception as e:
             logger.error(e)
             raise e
         else:
             self.pages = self.plumber.pages
-        dict_key = filename.split("/")[-1].split("-")[0]
-        if dict_key in CUTOFFS:
-            self.CUTOFF_X = CUTOFFS[dict_key]["CUTOFF_X"]
-            self.CUTOFF_Y = CUTOFFS[dict_key]["CUTOFF_Y"]
-            self.CUTOFF_COL = CUTOFFS[dict_key]["CUTOFF_COL"]
+        cutoffs = get_cutoffs(filename)
+        self.CUTOFF_X = cutoffs["CUTOFF_X"]
+        self.CUTOFF_Y = cutoffs["CUTOFF_Y"]
+        self.CUTOFF_COL = cutoffs["CUTOFF_COL"]
+
+    def _find_column(self, anchors: List[float], x0: float, start: int = 0) -> Union[int, None]:
+        """
+        Finds the first column, from the start index on, whose first word starts within CUTOFF_COL of x0
+        :param anchors: the sorted x0 of the first word of each column
+        :param x0: the x0 of the word
+        :param start: the index of the first column that can match
+        :return: the index of the column, None if no column matches
+        """
+        # only the columns around x0 can match, the exact test is still the one on the distance
+        i = max(start, bisect_left(anchors, x0 - self.CUTOFF_COL - self.ANCHOR_EPSILON))
+        while i < len(anchors) and anchors[i] <= x0 + self.CUTOFF_COL + self.ANCHOR_EPSILON:
+            if abs(x0 - anchors[i]) < self.CUTOFF_COL:
+                return i
+            i += 1
+        return None
+
+    def extract_columns(self, table: WordTable) -> List[np.ndarray]:
+        """
+        Helper function to extract all the columns from a PDF page.
+        The columns are kept sorted by the x0 of their first word, which never changes once the column exists, so the
+        matching column and the position of a new column are found with a binary search over these anchors.
+        :param table: the words of the page
+        :return: the list of columns, each an array of word positions
+        """
+        if not len(table):
+            return []
+        x0s, x1s = table.x0.tolist(), table.x1.tolist()
+        columns = [[0]]
+        anchors = [x0s[0]]
+        prev_x1, prev_idx = x1s[0], 0
+        for position in range(1, len(x0s)):
+            x0 = x0s[position]
+            if x0 - prev_x1 < self.CUTOFF_X:
+                # determine the column index of this word:
+                if x0 - prev_x1 > 0:
+                    idx = prev_idx
+                else:
+                    # we are starting from a new line, need to determine the column:
+                    idx = self._find_column(anchors, x0)
+                    if idx is None:
+                        # it is a new column, add it before the first column starting after it
+                        # if no column starts after it, the word stays in the last column
+                        idx = bisect_right(anchors, x0)
+                        if idx == len(columns):
+                            idx -= 1
+                        else:
+                            columns.insert(idx, [])
+                            anchors.insert(idx, x0)
+            else:
+                # new column, need to match with the existing columns from the current one on first
+                idx = self._find_column(anchors, x0, prev_idx)
+                if idx is None:
+                    idx = bisect_right(anchors, x0)
+                    columns.insert(idx, [])
+                    anchors.insert(idx, x0)
+            columns[idx].append(position)
+            prev_x1, prev_idx = x1s[position], idx
+        return [np.array(column, dtype=np.int32) for column in columns]
+
+    def is_single_column(self, table: WordTable) -> bool:
+        """
+        Checks with vectorized operations if extract_columns would keep all the words in one column, in their order.
+        With a single column, each word stays in it if it continues the line, if it starts a new line that is not
+        left of the first word by CUTOFF_COL or more, or if it comes after a gap and matches the first word as in
+        _find_column, so the test is exactly the one of extract_columns.
+        :param table: the words of the page
+        :return: bool, True if the page is a single column
+        """
+        if len(table) < 2:
+            return True
+        anchor, x0 = table.x0[0], table.x0[1:]
+        gaps = x0 - table.x1[:-1]
+        aligned = (anchor >= x0 - self.CUTOFF_COL - self.ANCHOR_EPSILON) & \
+                  (anchor <= x0 + self.CUTOFF_COL + self.ANCHOR_EPSILON) & (np.abs(x0 - anchor) < self.CUTOFF_COL)
+        same_column = np.where(gaps < self.CUTOFF_X, (gaps > 0) | aligned | (x0 >= anchor), aligned)
+        return bool(same_column.all())
+
+    def triage_page(self, page: "Page", table: WordTable) -> str:
+        """
+        Classifies a page, so that the column analysis only runs on the pages that need it
+        :param page: the pdf plumber object
+        :param table: the words of the page
+        :return: the kind of page, EMPTY, IMAGE_ONLY, SINGLE_COLUMN or MULTI_COLUMN
+        """
+        if not len(table):
+            return self.IMAGE_ONLY if page.images else self.EMPTY
+        return self.SINGLE_COLUMN if self.is_single_column(table) else self.MULTI_COLUMN
+
+    def split_paragraphs(self, table: WordTable, columns: List[np.ndarray]) -> PageLayout:
+        """
+        Helper function that puts the words in columns into paragraphs, a new paragraph starts when the vertical gap
+        with the previous word of the column is above CUTOFF_Y
+        :param table: the words of the page
+        :param columns: the list of columns that was determined before
+        :return: the layout of the page
+        """
+        # decode columns to paragraphs
+        paragraphs = []
+        for column in columns:
+            if not len(column):
+                continue
+            gaps = table.top[column[1:]] - table.bottom[column[:-1]]
+            paragraphs.extend(np.split(column, np.flatnonzero(gaps > self.CUTOFF_Y) + 1))
+        return PageLayout(table, paragraphs)
+
+    def merge_paragraphs(self, layout: PageLayout) -> PageLayout:
+        """
+        Helper function that joins the paragraphs continuing in another column, or from the previous page,
+        to their parent paragraph.
+        A paragraph starting in lowercase continues the closest paragraph before it that can be continued and has the
+        same word height, on this page first and on the previous page after.
+        Each paragraph is a record identified by its index, with the number of words, the height of its last word
+        and whether its last word ends a sentence, after the merges so far. The possible parents are kept in a heap per
+        word height, so finding the closest one does not walk back over the page. The merges are recorded and the
+        paragraphs are only joined once all the page is done.
+        The paragraph right after a merged one is never checked, as in the original implementation that removed the
+        merged paragraph from the list it was iterating over.
+        :param layout: the layout of the page, as returned by split_paragraphs
+        :return: the layout with the paragraphs left on the page
+        """
+        table, paragraphs = layout.table, layout.paragraphs
+        heights = (table.bottom - table.top).tolist()
+        texts = table.text
+        length = [len(p) for p in paragraphs]
+        last_height = [heights[p[-1]] for p in paragraphs]
+        open_end = [texts[p[-1]][-1] not in PdfProcessor.PUNCTUATION for p in paragraphs]
+        version = [0] * len(paragraphs)
+        # height of the last word -> heap of (-index, version) of the possible parents, outdated versions are skipped
+        parents = {}
+        merged_into = [None] * len(paragraphs)
+        merges = []
+        previous = None
+        previous_merges = []
+
+        def push(heaps: Dict, index: int, lengths: List[int], last_heights: List[float], open_ends: List[bool],
+                 versions: List[int]):
+            if lengths[index] > 10 and open_ends[index]:
+                heappush(heaps.setdefault(last_heights[index], []), (-index, versions[index]))
+
+        def closest(heap: List, versions: List[int]) -> int:
+            while heap and versions[-heap[0][0]] != heap[0][1]:
+                heappop(heap)
+            return -heap[0][0] if heap else -1
+
+        skip = False
+        for i, p in enumerate(paragraphs):
+            first = p[0]
+            if skip:
+                skip = False
+            elif texts[first].islower():
+                logger.debug("Found potential multi-column paragraph starting with: '%s'", texts[first])
+                height = heights[first]
+                parent = max((closest(heap, version) for h, heap in parents.items() if abs(h - height) < 0.1),
+                             default=-1)
+                if parent >= 0:
+                    if logger.isEnabledFor(logging.DEBUG):
+                        logger.debug("Found potential parent paragraph: %s", ' '.join(texts[paragraphs[parent]]))
+                    merged_into[i] = parent
+                    merges.append((parent, i))
+                    length[parent] += length[i]
+                    last_height[parent], open_end[parent] = last_height[i], open_end[i]
+                    version[parent] += 1
+                    push(parents, parent, length, last_height, open_end, version)
+                    skip = True
+                    continue
+                if previous is None:
+                    # the possible parents on the previous page, only needed the first time there is no parent here
+                    previous = {}
+                    prev_layout = self.previous_page_paragraphs
+                    if prev_layout is None:
+                        prev_layout = PageLayout(table, [])
+                    prev_heights = (prev_layout.table.bottom - prev_layout.table.top).tolist()
+                    prev_length = [len(prev_p) for prev_p in prev_layout.paragraphs]
+                    prev_last_height = [prev_heights[prev_p[-1]] for prev_p in prev_layout.paragraphs]
+                    prev_open_end = [prev_layout.table.text[prev_p[-1]][-1] not in PdfProcessor.PUNCTUATION
+                                     for prev_p in prev_layout.paragraphs]
+                    prev_version = [0] * len(prev_layout)
+                    for j in range(len(prev_layout)):
+                        push(previous, j, prev_length, prev_last_height, prev_open_end, prev_version)
+                parent = closest(previous.get(height, []), prev_version)
+                if parent >= 0:
+                    if logger.isEnabledFor(logging.DEBUG):
+                        logger.debug("Found potential parent paragraph on previous page: %s",
+                                     ' '.join(prev_layout.table.text[prev_layout.paragraphs[parent]]))
+                    merged_into[i] = -1
+                    previous_merges.append((parent, i))
+                    prev_length[parent] += length[i]
+                    prev_last_height[parent], prev_open_end[parent] = last_height[i], open_end[i]
+                    prev_version[parent] += 1
+                    push(previous, parent, prev_length, prev_last_height, prev_open_end, prev_version)
+                    skip = True
+                    continue
+                logger.debug("Was not able the identify the parent of this paragraph")
+            push(parents, i, length, last_height, open_end, version)
+
+        # apply the recorded merges, the merged paragraphs never have merges of their own
+        children = {}
+        for parent, child in merges:
+            children.setdefault(parent, [paragraphs[parent]]).append(paragraphs[child])
+        for parent, parts in children.items():
+            paragraphs[parent] = np.concatenate(parts)
+        for parent, child in previous_merges:
+            prev_layout.continued.setdefault(parent, []).append((table, paragraphs[child]))
+        layout.paragraphs = [p for p, merged in zip(paragraphs, merged_into) if merged is None]
+        return layout
+
+    def extract_paragraphs(self, table: WordTable, columns: List[np.ndarray]) -> PageLayout:
+        """
+        Helper function that puts the words in columns into paragraphs
+        :param table: the words of the page
+        :param columns: the list of columns that was determined before
+        :return: the layout of the page
+        """
+        return self.merge_paragraphs(self.split_paragraphs(table, columns))
+
+    def layout_page(self, page: "Page") -> PageLayout:
+        """
+        Extract the words of a pdf page and split them into columns and paragraphs. The paragraphs continuing from
+        another column or page are not merged yet, as this needs the previous page.
+        The page is triaged first: the pages without words are done, and the words of a single column page are in
+        their order, only the multi-column pages go through the column analysis.
+        :param page: the pdf plumber object
+        :return: the layout of the page
+        """
+        # formatted only if the level is enabled, the page is processed for every page
+        logger.info("Processing page %s from %s", page, self.filename)
+        # Extract text from the current page, the word dicts are only kept until they are in the table
+        with recorder.stage("extract_words", self.filename, pages=1) as counters:
+            # a page without characters, eg. a cover or a full page picture, has no words to group
+            table = WordTable(page.extract_words() if page.chars else [])
+            counters["words"] = len(table)
+        with recorder.stage("triage", self.filename) as counters:
+            kind = self.triage_page(page, table)
+            counters[kind] = 1
+        if kind in (self.EMPTY, self.IMAGE_ONLY):
+            return PageLayout(table, [])
+        if kind == self.SINGLE_COLUMN:
+            columns = [np.arange(len(table), dtype=np.int32)]
         else:
-            self.CUTOFF_X = CUTOFFS["default"]["CUTOFF_X"]
-            self.CUTOFF_Y = CUTOFFS["default"]["CUTOFF_Y"]
-            self.CUTOFF_COL = CUTOFFS["default"]["CUTOFF_COL"]
+            with recorder.stage("extract_columns", self.filename):
+                columns = self.extract_columns(table)
+        with recorder.stage("split_paragraphs", self.filename):
+            return self.split_paragraphs(table, columns)
 
-    def process_page(self, page: Page):
+    def process_page(self, page: "Page"):
         """
         Extract the text content of a pdf page, by taking into account the columns as all
         :param page: the pdf plumber object
         :return:
         """
-        def extract_columns(words: List[Dict]) -> List[Dict]:
-            """
-            Helper function to extract all the columns from a PDF page
-            :param words: a list of wor
-            :return: the list of words columns
-            """
-            if not words:
-                return []
-            columns = [[]]
-            prev_word = (deepcopy(words[0]), 0)
-            prev_word[0]['x1'] = words[0]['x0'] - 1
-            for word in words:
-                # if word['text'] == 'prices':
-                #     print("stay")
-                if word['x0'] - prev_word[0]['x1'] < self.CUTOFF_X:
-                    # determine the column index of this word:
-                    if word['x0'] - prev_word[0]['x1'] > 0:
-                        idx = prev_word[1]
-                    else:
-                        # we are starting from a new line, need to determine the column:
-                        for i, c in enumerate(columns):
-                            if not c:
-                                continue
-                            if abs(word['x0'] - c[0]['x0']) < self.CUTOFF_COL:
-                                idx = i
-                                break
-                        else:
-                            # it is a new column, add it
-                            # if it is before existing columns, re-order them
-                            idx = len(columns) - 1  # Default index if no reordering is needed
-                            for i, column in enumerate(columns):
-                                if word['x0'] < column[0]['x0']:
-                                    columns.insert(i, [])
-                                    idx = i
-                                    break
-                    columns[idx].append(word)
-                else:
-                    # new column, need to match with existing columns first
-                    for cindex, c in enumerate(columns):
-                        if cindex < prev_word[1]:
-                            continue
-                        if abs(word['x0'] - c[0]['x0']) < self.CUTOFF_COL:
-                            idx = cindex
-                            break
-                    else:
-                        columns.append([])
-                        idx = 0
-                        # we added a column in the middle, need to reshuffle
-                        for cindex in range(len(columns) - 1, -1, -1):
-                            if columns[cindex - 1][0]['x0'] > word['x0']:
-                                columns[cindex] = columns[cindex - 1]
-                            else:
-                                idx = cindex
-                                break
-                        columns[idx] = []
-                    columns[idx].append(word)
-                prev_word = (word, idx)
-            return columns
-
-        def extract_paragraphs(columns: List[Dict]) -> List[List]:
-            """
-            Helper function that puts the words in columns into paragraphs
-            :param columns: the list of columns that was determined before
-            :return: a list of paragraphs
-            """
-            # decode columns to paragraphs
-            paragraphs = []
-            for column in columns:
-                if not column:
-                    continue
-                paragraphs.append([])
-                for word in column:
-                    if paragraphs[-1] and word["top"] - paragraphs[-1][-1]["bottom"] > self.CUTOFF_Y:
-                        # need to add a new paragraph
-                        paragraphs.append([])
-                    paragraphs[-1].append(word)
-
-            # check if there is a potential multi-column paragraph
-            for p in paragraphs:
-                if p[0]['text'].islower():
-                    logger.debug(f"Found potential multi-column paragraph starting with: '{p[0]['text']}'")
-                    prev_paragraphs = []
-                    for pre in paragraphs:
-                        if pre == p:
-                            break
-                        prev_paragraphs.append(pre)
-                    prev_paragraphs = prev_paragraphs[::-1]
-                    for parent in prev_paragraphs:
-                        if len(parent) > 10 and parent[-1]['text'][-1] not in PdfProcessor.PUNCTUATION and \
-                                abs((parent[-1]["bottom"] - parent[-1]["top"]) - (p[0]["bottom"] - p[0]["top"])) < 0.1:
-                            logger.debug(f"Found potential parent paragraph: {' '.join([w['text'] for w in parent])}")
-                            parent.extend(p)
-                            paragraphs.remove(p)
-                            break
-                    else:
-                        for prev_p in self.previous_page_paragraphs[::-1]:
-                            if len(prev_p) > 10 and prev_p[-1]['text'][-1] not in PdfProcessor.PUNCTUATION and \
-                                    prev_p[-1]["bottom"] - prev_p[-1]["top"] == p[0]["bottom"] - p[0]["top"]:
-                                logger.debug(
-                                    f"Found potential parent paragraph on previous page: {' '.join([w['text'] for w in prev_p])}")
-                                prev_p.extend(p)
-                                paragraphs.remove(p)
-                                break
-                        else:
-                            logger.debug("Was not able the identify the parent of this paragraph")
-            return paragraphs
-
-        logger.info(f"Processing page {str(page)} from {self.filename}")
-        # Extract text from the current page
-        words = page.extract_words()
-        columns = extract_columns(words)
+        layout = self.layout_page(page)
         if self.paragraphs:
             self.previous_page_paragraphs = self.paragraphs[-1]
-        self.paragraphs.append([])
-        self.paragraphs[-1] = extract_paragraphs(columns)
+        with recorder.stage("merge_paragraphs", self.filename):
+            self.paragraphs.append(self.merge_paragraphs(layout))
         # paragraphs_to_text(self.paragraphs)
 
+    @staticmethod
+    def release_page(page: "Page"):
+        """
+        Drops the layout objects that pdfplumber caches on the page, so the memory does not grow with the page count
+        :param page: the pdf plumber object
+        """
+        if hasattr(page, "close"):
+            page.close()
+        else:
+            page.flush_cache()
+
+    def iter_layout(self, workers: int = 1, start: int = 0) -> Iterator[PageLayout]:
+        """
+        Lays out the pages one by one, releasing each page once it is done
+        :param workers: the number of processes laying out ranges of pages in parallel, 1 does it in this process
+        :param start: the index of the first page to lay out, eg. when resuming from a checkpoint
+        :return: generator with the layout of each page, before the multi-column paragraphs are merged
+        """
+        if workers <= 1:
+            for page in self.pages[start:]:
+                yield self.layout_page(page)
+                self.release_page(page)
+            return
+
+        ranges = [(first, min(first + self.PAGES_PER_SHARD, len(self.pages)))
+                  for first in range(start, len(self.pages), self.PAGES_PER_SHARD)]
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            # only keep a few ranges in flight, so that finished ranges do not pile up in memory
+            pending = deque()
+            for first, end in ranges:
+                pending.append(executor.submit(_layout_page_range, self.filename, first, end))
+                if len(pending) >= 2 * workers:
+                    yield from self._merge_worker_result(pending.popleft().result())
+            while pending:
+                yield from self._merge_worker_result(pending.popleft().result())
+
+    @staticmethod
+    def _merge_worker_result(result: Tuple[List[PageLayout], List[StageRecord]]) -> List[PageLayout]:
+        """
+        Adds the stage records of a worker to the recorder of this process
+        :param result: the result of _layout_page_range
+        :return: the layout of each page of the range
+        """
+        layouts, records = result
+        recorder.merge(records)
+        return layouts
+
+    def iter_merged_pages(self, workers: int = 1, start: int = 0, previous: Union[PageLayout, None] = None) \
+            -> Iterator[Tuple[PageLayout, Union[PageLayout, None]]]:
+        """
+        Stitches the laid out pages back together, merging the paragraphs that continue from another column or page.
+        A page is only returned once the next page is merged, as that page can still extend its paragraphs.
+        :param workers: the number of processes laying out ranges of pages in parallel, 1 does it in this process
+        :param start: the index of the first page to lay out, eg. when resuming from a checkpoint
+        :param previous: the layout of the page before start, merged but not returned yet, when resuming
+        :return: generator with the final layout of each page, and the layout of the next page, that is merged but can
+        still be extended, None after the last page
+        """
+        for layout in self.iter_layout(workers, start):
+            self.previous_page_paragraphs = previous
+            with recorder.stage("merge_paragraphs", self.filename):
+                layout = self.merge_paragraphs(layout)
+            if previous is not None:
+                yield previous, layout
+            previous = layout
+        if previous is not None:
+            yield previous, None
+
+    def iter_page_paragraphs(self, workers: int = 1) -> Iterator[PageLayout]:
+        """
+        Stitches the laid out pages back together, merging the paragraphs that continue from another column or page.
+        A page is only returned once the next page is merged, as that page can still extend its paragraphs.
+        :param workers: the number of processes laying out ranges of pages in parallel, 1 does it in this process
+        :return: generator with the final layout of each page
+        """
+        for page_para, _ in self.iter_merged_pages(workers):
+            yield page_para
+
+    @staticmethod
+    def iter_page_text(idx: int, page_para: PageLayout) -> Iterator[str]:
+        """
+        Convert the paragraphs of a single page into plain text, piece by piece
+        :param idx: the index of the page in the file
+        :param page_para: the layout of the page
+        :return: generator with the page header and then the line of each paragraph
+        """
+        yield f"\n==Page{idx+1}==\n\n"
+        for paragraph_text in page_para.paragraph_texts():
+            yield paragraph_text + "\n"
+
+    @staticmethod
+    def page_to_text(idx: int, page_para: PageLayout) -> str:
+        """
+        Convert the paragraphs of a single page into plain text
+        :param idx: the index of the page in the file
+        :param page_para: the layout of the page
+        :return: the text of the page
+        """
+        return "".join(PdfProcessor.iter_page_text(idx, page_para))
+
     def paragraphs_to_text(self):
         """
         Convert the list of Word paragraphs into plain text
         """
         # convert the paragraphs into text paragraphs
-        for idx, page_para in enumerate(self.paragraphs):
-            self.extracted_text += f"\n==Page{idx+1}==\n\n"
-            for p in page_para:
-                words = [w["text"] for w in p]
-                paragraph_text = " ".join(words) + "\n"
-                self.extracted_text += paragraph_text
+        self.extracted_text += "".join(self.page_to_text(idx, page_para)
+                                       for idx, page_para in enumerate(self.paragraphs))
+
+    def write_pages(self, f: TextIO, pages: Iterable[PageLayout]):
+        """
+        Writes the pages to the txt file as they come, without building the text of the whole document
+        :param f: the txt file, opened for writing
+        :param pages: the layout of each page, in order
+        """
+        for idx, page_para in enumerate(pages):
+            f.writelines(self.iter_page_text(idx, page_para))
+
+    def checkpoint_key(self) -> Dict:
+        """
+        :return: what a checkpoint must match to be resumed: the PDF file, its page count and the extraction config
+        """
+        stat = os.stat(self.filename)
+        return {"size": stat.st_size, "mtime": stat.st_mtime_ns, "pages": len(self.pages),
+                "config": extraction_config(self.filename)}
+
+    def load_checkpoint(self) -> Union[Dict, None]:
+        """
+        Reads the checkpoint of a previous decode of the file that did not finish
+        :return: the checkpoint, None if there is none, or if it is for another version of the file or config
+        """
+        path = self.txt_filename + self.CHECKPOINT_SUFFIX
+        partial = self.txt_filename + self.PARTIAL_SUFFIX
+        if not os.path.exists(path) or not os.path.exists(partial):
+            return None
+        try:
+            with open(path, "rb") as f:
+                checkpoint = pickle.load(f)
+        except Exception as e:
+            logger.error(f"Could not read the checkpoint {path}, decoding from the start: {e}")
+            return None
+        if checkpoint["key"] != self.checkpoint_key() or os.path.getsize(partial) < checkpoint["offset"]:
+            logger.info(f"The checkpoint {path} does not match the file, decoding from the start")
+            return None
+        return checkpoint
 
-    def process_file(self):
+    def save_checkpoint(self, checkpoint: Dict):
+        """
+        Writes the checkpoint, replacing the old one only once the new one is completely written
+        :param checkpoint: dict with the key, the number of pages written, the offset in the partial txt file after
+        them, and the pending layout of the next page
+        """
+        path = self.txt_filename + self.CHECKPOINT_SUFFIX
+        with open(f"{path}.tmp", "wb") as f:
+            pickle.dump(checkpoint, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(f"{path}.tmp", path)
+
+    def write_checkpointed(self, workers: int = 1, on_text: Callable[[str], None] = None) -> int:
+        """
+        Writes the pages to a partial txt file as they come, with a checkpoint after each page, holding the offset
+        of the page end in the file and the merged layout of the next page, that the page after it can still extend.
+        A decode that was killed resumes from its last checkpoint, the partial file is cut back to the offset, so the
+        result is the same as decoding in one go. The partial file replaces the txt file once all the pages are done.
+        :param workers: the number of processes laying out ranges of pages in parallel, 1 does it in this process
+        :param on_text: function called with the text of each page once it is written, and first with the text
+        resumed from the checkpoint, so that it is called with the whole content of the txt file
+        :return: the number of pages resumed from the checkpoint
+        """
+        partial = self.txt_filename + self.PARTIAL_SUFFIX
+        checkpoint = self.load_checkpoint()
+        key = checkpoint["key"] if checkpoint else self.checkpoint_key()
+        idx, start, previous = 0, 0, None
+        if checkpoint:
+            idx, previous = checkpoint["pages"], checkpoint["pending"]
+            start = idx + 1
+            logger.info(f"Resuming the decoding of {self.filename} after page {idx}")
+        with open(partial, "r+" if checkpoint else "w", encoding="utf-8", buffering=self.WRITE_BUFFER) as f:
+            if checkpoint:
+                f.seek(checkpoint["offset"])
+                f.truncate()
+                if on_text is not None:
+                    f.seek(0)
+                    on_text(f.read())
+                    f.seek(0, os.SEEK_END)
+            for page_para, pending in self.iter_merged_pages(workers, start, previous):
+                if on_text is None:
+                    f.writelines(self.iter_page_text(idx, page_para))
+                else:
+                    text = self.page_to_text(idx, page_para)
+                    f.write(text)
+                    on_text(text)
+                idx += 1
+                if pending is not None:
+                    f.flush()
+                    self.save_checkpoint({"key": key, "pages": idx, "offset": f.tell(), "pending": pending})
+        os.replace(partial, self.txt_filename)
+        if os.path.exists(self.txt_filename + self.CHECKPOINT_SUFFIX):
+            os.remove(self.txt_filename + self.CHECKPOINT_SUFFIX)
+        return checkpoint["pages"] if checkpoint else 0
+
+    def iter_paragraphs(self, workers: int = 1) -> Iterator[Tuple[int, str]]:
+        """
+        Decodes the pdf file and returns the paragraphs as soon as their page is final, without writing the txt file
+        :param workers: the number of processes laying out ranges of pages in parallel, 1 does it in this process
+        :return: generator with the page number and the text of each paragraph
+        """
+        for idx, page_para in enumerate(self.iter_page_paragraphs(workers)):
+            for paragraph_text in page_para.paragraph_texts():
+                yield idx + 1, paragraph_text
+
+    def process_file(self, streaming: bool = False, workers: int = 1, on_text: Callable[[str], None] = None,
+                     write_txt: bool = True):
         """
         Decodes the entire pdf file and saves the result
+        :param streaming: bool, set to True to write each page as soon as it is done instead of keeping the whole
+        document in memory, with a checkpoint after each page that a killed decode resumes from
+        :param workers: the number of processes laying out ranges of pages in parallel, 1 does it in this process
+        :param on_text: function called with the text of each page as soon as it is final, eg. to count its terms
+        while the next pages are decoded, the pieces make the whole txt file. Implies streaming.
+        :param write_txt: bool, set to False to only hand the text to on_text, without writing the txt file
         """
-        for page in self.pages:
-            self.process_page(page)
-        self.paragraphs_to_text()
+        try:
+            with profile(self.filename), \
+                    recorder.stage("process_file", self.filename, pages=len(self.pages)) as counters:
+                if not write_txt:
+                    for idx, page_para in enumerate(self.iter_page_paragraphs(workers)):
+                        text = self.page_to_text(idx, page_para)
+                        if on_text is not None:
+                            on_text(text)
+                    return
+                if streaming or on_text is not None:
+                    counters["resumed_pages"] = self.write_checkpointed(workers, on_text)
+                else:
+                    if workers > 1:
+                        self.paragraphs = list(self.iter_page_paragraphs(workers))
+                    else:
+                        for page in self.pages:
+                            self.process_page(page)
+
+                    with open(self.txt_filename, "w", encoding="utf-8", buffering=self.WRITE_BUFFER) as f:
+                        self.write_pages(f, self.paragraphs)
+                counters["bytes_written"] = os.path.getsize(self.txt_filename)
+        finally:
+            self.close()
 
-        with open(f"{self.filename.replace('pdf', 'txt')}", "w", encoding="utf-8") as f:
-            f.write(self.extracted_text)
+    def close(self):
+        """
+        Closes the PDF file
+        """
+        self.plumber.close()
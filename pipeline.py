@@ -0,0 +1,167 @@
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from typing import TYPE_CHECKING, Dict, List, Tuple, Union
+import logging
+import time
+
+import log_config
+from catalog import CorpusCatalog
+from graph_generator import GenerateGraphs
+from instrumentation import StageRecord, profile, recorder, should_profile
+from manifest_cache import ManifestCache
+from term_index import TermIndex
+
+if TYPE_CHECKING:
+    from results_store import ResultsStore
+
+logger = log_config.setup_logger(__name__, logging.INFO)
+
+# company, whether its outputs were generated, its results, the cache entries it changed, the elapsed seconds and the
+# stage records of the worker
+CompanyResult = Tuple[str, bool, "ResultsStore", Union[Dict, None], float, List[StageRecord]]
+
+_index = None
+_cache = None
+
+
+def _init_worker(index_dir: Union[str, None], cache: Union[ManifestCache, None]):
+    """
+    Loads the term index and receives the manifest cache once per worker process, instead of with every company
+    :param index_dir: The directory of the term index, None to scan the text
+    :param cache: The manifest cache of the main process, can be None
+    """
+    global _index, _cache
+    _index = TermIndex(index_dir) if index_dir else None
+    _cache = cache
+    if _cache is not None:
+        # only the entries changed by the companies of this worker are sent back
+        _cache.take_changes()
+
+
+def run_company(company: str, location: str, results: "ResultsStore", force_generate: bool, export_csvs: bool,
+                catalog: CorpusCatalog) -> CompanyResult:
+    """
+    Generates the results, CSVs, graphs and doc of one company, in a worker process.
+    The results are only kept in memory and the cache is not saved, the results and the cache entries changed for
+    this company are sent back to the main process.
+    :param company: The name of the company
+    :param location: The location where the pdfs have been decoded into txt
+    :param results: The results of the company from the previous runs, used to find if they are up to date
+    :param force_generate: bool, set to True to generate the outputs even if found
+    :param export_csvs: bool, set to False to not write the per company CSV files
+    :param catalog: The catalog of the main process
+    :return: tuple with the company, whether it was generated, its results, the changed cache entries, the elapsed
+    seconds and the stage records
+    """
+    start = time.time()
+    graphs = GenerateGraphs(location, _cache, _index, export_csvs, results_file=None, catalog=catalog)
+    graphs.results = results
+    with profile(company):
+        generated = graphs.generate_csvs_for_company(company, force_generate)
+        graphs.generate_graphs(company, generated or force_generate)
+        graphs.generate_doc(company, generated or force_generate)
+    return company, generated, graphs.results, _cache.take_changes() if _cache is not None else None, \
+        time.time() - start, recorder.drain()
+
+
+class Pipeline:
+    """
+    Class that generates the reports of all the companies, fanning the companies out across worker processes.
+    Each worker sends back the results of its company, which are merged in the main process, where the results file
+    is written once and the aggregate is built from the results in memory.
+    """
+
+    def __init__(self, location: str, cache: ManifestCache = None, index: TermIndex = None, workers: int = 1,
+                 export_csvs: bool = True, catalog: CorpusCatalog = None, render_workers: int = 1):
+        """
+        Initialize the class
+        :param location: The location where the pdfs have been decoded into txt
+        :param cache: The manifest cache used to reuse the counts and to find the stale outputs, can be None
+        :param index: The term index used to count the files without scanning their text, can be None
+        :param workers: The maximum number of companies processed at the same time, 1 processes them in this process
+        :param export_csvs: bool, set to False to only write the results file and not the per company CSV files
+        :param catalog: The catalog of the files in the location, a new one if None
+        :param render_workers: The number of processes rendering the graphs of the companies processed in this process
+        in one batch, and of the aggregate. The companies processed in the worker processes render their own graphs.
+        """
+        self.location = location
+        self.cache = cache
+        self.index = index
+        self.workers = workers
+        self.graphs = GenerateGraphs(location, cache, index, export_csvs, render_workers=render_workers,
+                                     catalog=catalog)
+
+    def run(self, companies: Union[List[str], None] = None, force_generate: bool = False) -> Dict[str, bool]:
+        """
+        Generates the outputs of the companies, then the aggregated doc
+        :param companies: The companies to process, all of them if None
+        :param force_generate: bool, set to True to generate the outputs even if found
+        :return: dict of company -> bool, True if its outputs were generated, the failed companies are left out
+        """
+        companies = self.graphs.companies if companies is None else companies
+        if self.workers > 1 and len(companies) > 1:
+            generated = self.run_parallel(companies, force_generate)
+        else:
+            generated = self.run_serial(companies, force_generate)
+        self.graphs.save_results()
+        # in the end need to generate the aggregated doc with all the companies
+        self.graphs.generate_aggregated_doc(force_generate)
+        if self.cache is not None:
+            self.cache.save()
+        return generated
+
+    def run_serial(self, companies: List[str], force_generate: bool) -> Dict[str, bool]:
+        """
+        Processes the companies in this process, the graphs of all the companies are rendered in one batch
+        :param companies: The companies to process
+        :param force_generate: bool, set to True to generate the outputs even if found
+        :return: dict of company -> bool, True if its outputs were generated
+        """
+        # the companies selected for profiling are processed on their own, so that the profile only has their stages
+        profiled = [company for company in companies if should_profile(company)]
+        generated = {}
+        for company in profiled:
+            generated[company] = self.graphs.analyse_and_plot_data_for_company(company, force_generate)
+            logger.info(f"Company {company} done and profiled")
+        # new CSV files make the existing graphs and doc of the company stale
+        stale = {company: self.graphs.generate_csvs_for_company(company, force_generate) or force_generate
+                 for company in companies if company not in profiled}
+        self.graphs.generate_graphs_for_companies(stale)
+        for done, (company, force) in enumerate(stale.items(), len(profiled) + 1):
+            self.graphs.generate_doc(company, force)
+            logger.info(f"Company {company} done ({done}/{len(companies)})")
+        generated.update(stale)
+        return generated
+
+    def run_parallel(self, companies: List[str], force_generate: bool) -> Dict[str, bool]:
+        """
+        Processes the companies across the worker processes, at most self.workers at a time
+        :param companies: The companies to process
+        :param force_generate: bool, set to True to generate the outputs even if found
+        :return: dict of company -> bool, True if its outputs were generated, the failed companies are left out
+        """
+        generated = {}
+        index_dir = self.index.index_dir if self.index is not None else None
+        workers = min(self.workers, len(companies))
+        logger.info(f"Processing {len(companies)} companies with {workers} processes")
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                                 initargs=(index_dir, self.cache)) as executor:
+            futures = {
+                executor.submit(run_company, company, self.location, self.graphs.results.subset([company]),
+                                force_generate, self.graphs.export_csvs, self.graphs.catalog): company
+                for company in companies
+            }
+            for done, future in enumerate(as_completed(futures), 1):
+                company = futures[future]
+                try:
+                    company, was_generated, results, changes, elapsed, records = future.result()
+                except Exception as e:
+                    logger.error(f"Company {company} failed ({done}/{len(companies)}): {type(e).__name__}: {e}")
+                    continue
+                recorder.merge(records)
+                self.graphs.results.update(results)
+                if changes is not None:
+                    self.cache.merge(changes)
+                generated[company] = was_generated
+                logger.info(f"Company {company} done ({done}/{len(companies)}) in {elapsed:.1f} seconds, "
+                            f"{'generated' if was_generated else 'already up to date'}")
+        return generated
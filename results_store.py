@@ -0,0 +1,205 @@
+from typing import Dict, List, Union
+import os
+
+import numpy as np
+import pandas as pd
+
+
+class ResultsStore:
+    """
+    Class that keeps all the counts of the corpus in one typed table, indexed by (category, company, year, column).
+    The counts are collected as plain rows and only turned into the table, in bulk, when it is needed.
+    The per company tables and the aggregate of all the companies are derived from it with vectorized operations.
+    The table is stored on disk as a single Parquet file, that can be read back filtered on categories and companies.
+    """
+    INDEX = ["category", "company", "year", "column"]
+
+    def __init__(self, dataframe_columns: Dict[str, List[str]], years: List[int]):
+        """
+        Initialize the class
+        :param dataframe_columns: dict of category -> the names of its columns, as GenerateGraphs.DATAFRAME_COLUMNS
+        :param years: The years of the tables
+        """
+        self.dataframe_columns = dataframe_columns
+        self.years = years
+        self._rows = []
+        self._table = pd.Series(np.zeros(0, dtype=np.int64),
+                                index=pd.MultiIndex.from_tuples([], names=self.INDEX), name="value")
+
+    @classmethod
+    def from_file(cls, path: str, dataframe_columns: Dict[str, List[str]], years: List[int],
+                  categories: Union[List[str], None] = None,
+                  companies: Union[List[str], None] = None) -> "ResultsStore":
+        """
+        Reads a results file, only the row groups and rows of the given categories and companies are loaded
+        :param path: The path of the Parquet file, an empty store is returned if it does not exist
+        :param dataframe_columns: dict of category -> the names of its columns, as GenerateGraphs.DATAFRAME_COLUMNS
+        :param years: The years of the tables
+        :param categories: The categories to read, all of them if None
+        :param companies: The companies to read, all of them if None
+        :return: the store with the counts read from the file
+        """
+        store = cls(dataframe_columns, years)
+        if not os.path.exists(path):
+            return store
+        filters = []
+        if categories is not None:
+            filters.append(("category", "in", list(categories)))
+        if companies is not None:
+            filters.append(("company", "in", list(companies)))
+        df = pd.read_parquet(path, columns=cls.INDEX + ["value"], filters=filters or None)
+        df = df.astype({"category": object, "company": object, "column": object, "year": np.int64, "value": np.int64})
+        store._table = df.set_index(cls.INDEX)["value"]
+        return store
+
+    def save(self, path: str):
+        """
+        Writes all the counts to the results file, replacing it
+        :param path: The path of the Parquet file
+        """
+        tmp_path = f"{path}.tmp"
+        self.table.reset_index().to_parquet(tmp_path, index=False)
+        os.replace(tmp_path, path)
+
+    def add_company(self, company: str, year_counts: Dict[int, Dict[str, List[int]]]):
+        """
+        Adds the counts of a company, replacing the ones it had, the years without counts are set to zero
+        :param company: The name of the company, eg REP for REPSOL
+        :param year_counts: dict of year -> category -> the values of the columns, as returned by TermScanner.scan
+        """
+        self._drop(company)
+        for category, columns in self.dataframe_columns.items():
+            for year in self.years:
+                values = year_counts[year][category] if year in year_counts else [0] * len(columns)
+                self._rows.extend((category, company, year, column, value) for column, value in zip(columns, values))
+
+    def add_year(self, company: str, year: int, counts: Dict[str, List[int]]):
+        """
+        Adds the counts of one year of a company, the other years of the company are kept, eg. in the partial results
+        of a shard that only has some of the years
+        :param company: The name of the company, eg REP for REPSOL
+        :param year: The year of the report
+        :param counts: dict of category -> the values of the columns, as returned by TermScanner.scan
+        """
+        for category, columns in self.dataframe_columns.items():
+            self._rows.extend((category, company, year, column, value)
+                              for column, value in zip(columns, counts[category]))
+
+    def add_frame(self, category: str, company: str, df: pd.DataFrame):
+        """
+        Adds the table of a category for a company, eg. read back from a CSV file
+        :param category: The category, eg. gender
+        :param company: The name of the company, eg REP for REPSOL
+        :param df: The table, with the years as index and the columns of the category
+        """
+        self._rows.extend((category, company, int(year), column, int(value))
+                          for (year, column), value in df.stack().items())
+
+    def subset(self, companies: List[str]) -> "ResultsStore":
+        """
+        :param companies: The companies to keep
+        :return: a new store with only the counts of these companies
+        """
+        store = ResultsStore(self.dataframe_columns, self.years)
+        table = self.table
+        store._table = table[table.index.get_level_values("company").isin(companies)]
+        return store
+
+    def update(self, other: "ResultsStore"):
+        """
+        Adds the counts of another store, replacing the ones of the companies it has
+        :param other: The other store, eg. returned by a worker process
+        """
+        table = other.table
+        for company in other.companies:
+            self._drop(company)
+        self._table = pd.concat([self.table, table])
+
+    def merge(self, partials: List["ResultsStore"]):
+        """
+        Adds the counts of partial stores, eg. written by the shards, that each have some of the years of the companies.
+        Unlike update the companies are not replaced, and the years of a company that no store has are set to zero, as
+        with add_company, so the merged store is the same as if all the years were counted in one place.
+        :param partials: The partial stores
+        :raise ValueError: if several stores have the counts of the same company and year
+        """
+        table = pd.concat([self.table] + [partial.table for partial in partials])
+        duplicated = table.index[table.index.duplicated()]
+        if len(duplicated):
+            _, company, year, _ = duplicated[0]
+            raise ValueError(f"The counts of {company} for {year} are in several partial results")
+        companies = sorted(table.index.get_level_values("company").unique())
+        index = pd.MultiIndex.from_tuples([(category, company, year, column)
+                                           for category, columns in self.dataframe_columns.items()
+                                           for company in companies for year in self.years for column in columns],
+                                          names=self.INDEX)
+        self._table = table.reindex(index, fill_value=0).astype(np.int64)
+
+    def _drop(self, company: str):
+        """
+        Removes the counts of a company
+        :param company: The name of the company
+        """
+        self._rows = [row for row in self._rows if row[1] != company]
+        if company in self._table.index.get_level_values("company"):
+            self._table = self._table.drop(company, level="company")
+
+    @property
+    def table(self) -> pd.Series:
+        """
+        The counts of the whole corpus, the rows added since the last access are appended in bulk
+        :return: Series of int64 counts indexed by (category, company, year, column)
+        """
+        if self._rows:
+            new = pd.DataFrame.from_records(self._rows, columns=self.INDEX + ["value"])
+            new = new.astype({"year": np.int64, "value": np.int64}).set_index(self.INDEX)["value"]
+            self._table = pd.concat([self._table, new])
+            self._table = self._table[~self._table.index.duplicated(keep="last")]
+            self._rows = []
+        return self._table
+
+    @property
+    def companies(self) -> List[str]:
+        """
+        :return: The companies that have counts in the store
+        """
+        companies = {row[1] for row in self._rows}
+        companies.update(self._table.index.get_level_values("company").unique())
+        return sorted(companies)
+
+    def _wide(self, counts: pd.Series, category: str) -> pd.DataFrame:
+        """
+        Turns the counts of one category into a table with the years as index and the category columns
+        :param counts: Series indexed by (year, column)
+        :param category: The category, eg. gender
+        :return: The table, in the same layout as the CSV files
+        """
+        df = counts.unstack("column") if len(counts) else pd.DataFrame()
+        df = df.reindex(index=self.years, columns=self.dataframe_columns[category], fill_value=0).astype(np.int64)
+        df.index.name = None
+        df.columns.name = None
+        return df
+
+    def company_frame(self, category: str, company: str) -> pd.DataFrame:
+        """
+        :param category: The category, eg. gender
+        :param company: The name of the company, eg REP for REPSOL
+        :return: The table of the category for the company, with the years as index
+        """
+        table = self.table
+        mask = (table.index.get_level_values("category") == category) & \
+               (table.index.get_level_values("company") == company)
+        return self._wide(table[mask].droplevel(["category", "company"]), category)
+
+    def aggregate_frame(self, category: str, companies: Union[List[str], None] = None) -> pd.DataFrame:
+        """
+        Sums the tables of the companies for a category
+        :param category: The category, eg. gender
+        :param companies: The companies to add up, all the companies in the store if None
+        :return: The aggregated table, with the years as index
+        """
+        table = self.table
+        table = table[table.index.get_level_values("category") == category]
+        if companies is not None:
+            table = table[table.index.get_level_values("company").isin(companies)]
+        return self._wide(table.groupby(level=["year", "column"]).sum(), category)
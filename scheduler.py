@@ -0,0 +1,340 @@
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
+from threading import Lock
+from typing import Callable, Dict, List
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+
+import log_config
+from chart_renderer import render_chart
+from graph_generator import GenerateGraphs
+from instrumentation import recorder
+from main import decode_file, pdf_dir, store_decoded, txt_path
+from manifest_cache import ManifestCache
+from pdf_processor import extraction_config
+from term_index import TermIndex
+
+logger = log_config.setup_logger(__name__, logging.INFO)
+
+
+class Node:
+    """
+    Class that describes one artifact of the pipeline: the files it is built from, the nodes it depends on, the files
+    it produces and how to build it.
+    """
+
+    def __init__(self, name: str, action: Callable[[], None], inputs: List[str] = (), deps: List[str] = (),
+                 outputs: List[str] = (), config=None):
+        """
+        Initialize the class
+        :param name: The unique name of the node, eg. csv:REP
+        :param action: The function building the node
+        :param inputs: The source files of the node, that are not built by another node
+        :param deps: The names of the nodes it is built from
+        :param outputs: The files it produces, the node is stale if any of them is missing
+        :param config: Any json serializable configuration that changes the result, eg. the search patterns
+        """
+        self.name = name
+        self.action = action
+        self.inputs = list(inputs)
+        self.deps = list(deps)
+        self.outputs = list(outputs)
+        self.config = config
+
+
+class Scheduler:
+    """
+    Class that models the PDF -> txt -> counts -> CSV -> JPG -> DOCX -> aggregate chain as a graph of nodes, and only
+    rebuilds the nodes whose inputs changed, and the nodes downstream of them.
+    The fingerprint of a node is the hash of its configuration, of the content of its source files and of the
+    fingerprints of the nodes it depends on, so it changes whenever anything upstream changes, and it can be computed
+    before anything is built. The fingerprint and the hash of the outputs of each built node are kept in a state file,
+    the hashes are only recomputed for the outputs whose size or modification time changed.
+    The independent nodes are run concurrently by a pool of threads, the decoding and the rendering are sent to a pool
+    of processes.
+    """
+    STATE_FILE = f"{ManifestCache.CACHE_DIR}/scheduler.json"
+
+    def __init__(self, location: str = pdf_dir, cache: ManifestCache = None, index: TermIndex = None,
+                 workers: int = 1, state_file: str = STATE_FILE):
+        """
+        Initialize the class and build the graph of the files in the location
+        :param location: The location of the PDFs, where they are decoded into txt
+        :param cache: The manifest cache used to hash the files and to reuse the counts, a new one if None
+        :param index: The term index used to count the files without scanning their text, can be None
+        :param workers: The number of nodes run at the same time, and the number of decoding and rendering processes
+        :param state_file: The path of the file with the fingerprints of the built nodes
+        """
+        self.location = location
+        self.cache = ManifestCache() if cache is None else cache
+        self.workers = workers
+        self.state_file = state_file
+        self.state = {}
+        if os.path.exists(self.state_file):
+            with open(self.state_file, encoding="utf8") as f:
+                self.state = json.load(f)
+        self.graphs = GenerateGraphs(location, self.cache, index)
+        # the results and the catalog of GenerateGraphs are shared by the nodes
+        self.lock = Lock()
+        self.processes = None
+        self.force = False
+        self.nodes = {}
+        self.build_graph()
+
+    def add(self, node: Node):
+        """
+        Adds a node to the graph
+        :param node: The node
+        """
+        self.nodes[node.name] = node
+
+    def build_graph(self):
+        """
+        Creates the nodes for the PDFs and txt files in the location
+        """
+        catalog = self.graphs.catalog
+        companies = {}
+        for company, year in sorted(set(catalog.files["pdf"]) | set(catalog.files["txt"])):
+            name = f"{company}-{year}"
+            pdf, txt = catalog.pdf(company, year), f"{self.location}/{name}.txt"
+            if pdf is not None:
+                self.add(Node(f"decode:{name}", lambda pdf=pdf: self.decode(pdf), inputs=[pdf], outputs=[txt],
+                              config=extraction_config(pdf)))
+                self.add(Node(f"counts:{name}", lambda name=name: self.count(f"{name}.txt"),
+                              deps=[f"decode:{name}"], config=GenerateGraphs.REGEX_PATTERNS))
+            else:
+                # a txt file without its PDF is a source file
+                self.add(Node(f"counts:{name}", lambda name=name: self.count(f"{name}.txt"),
+                              inputs=[txt], config=GenerateGraphs.REGEX_PATTERNS))
+            companies.setdefault(company, []).append(f"counts:{name}")
+
+        keys = sorted(GenerateGraphs.DATAFRAME_COLUMNS)
+        config = [GenerateGraphs.DATAFRAME_COLUMNS, GenerateGraphs.YEARS]
+        for company, counts in companies.items():
+            csvs = [catalog.csv(company, key) for key in keys] if self.graphs.export_csvs else []
+            self.add(Node(f"csv:{company}", lambda company=company: self.generate_csvs(company), deps=counts,
+                          outputs=csvs, config=config))
+            self.add(Node(f"graphs:{company}", lambda company=company: self.render(company), deps=[f"csv:{company}"],
+                          outputs=[catalog.graph(company, key) for key in keys]))
+            self.add(Node(f"doc:{company}", lambda company=company: self.generate_doc(company),
+                          deps=[f"csv:{company}", f"graphs:{company}"], outputs=[catalog.doc(company)]))
+        self.add(Node("aggregate", self.aggregate, deps=[f"csv:{company}" for company in companies],
+                      outputs=([catalog.csv("all", key) for key in keys] if self.graphs.export_csvs else []) +
+                              [catalog.graph("all", key) for key in keys] + [catalog.doc("all")]))
+
+    def decode(self, pdf: str):
+        """
+        Decodes a PDF in the process pool, unless the cache has its text for the same PDF and configuration
+        :param pdf: The path of the PDF file
+        """
+        txt = txt_path(pdf)
+        if not self.force and self.cache.is_decoded(pdf, txt, extraction_config(pdf)):
+            logger.info(f"The file {pdf} is already decoded")
+        else:
+            _, error, records, counted = self.processes.submit(decode_file, pdf).result()
+            recorder.merge(records)
+            if error is not None:
+                raise RuntimeError(error)
+            with self.lock:
+                store_decoded(pdf, counted, self.cache)
+        # the txt may have just been decoded or restored from the cache
+        with self.lock:
+            self.graphs.catalog.add(txt)
+
+    def count(self, file: str):
+        """
+        Counts the search terms of a txt file, it hashes the file and stores its counts in the cache
+        :param file: The name of the txt file
+        """
+        with self.lock:
+            self.graphs.scan_file(file)
+
+    def generate_csvs(self, company: str):
+        """
+        Generates the results and the CSV files of a company
+        :param company: The name of the company
+        """
+        with self.lock:
+            self.graphs.generate_csvs_for_company(company, True)
+
+    def render(self, company: str):
+        """
+        Renders the graphs of a company in the process pool
+        :param company: The name of the company, or all for the aggregate
+        """
+        with self.lock:
+            jobs = self.graphs.graph_jobs(company, True)
+        list(self.processes.map(render_chart, jobs))
+        with self.lock:
+            self.graphs.record_built_from_results("graphs", company)
+
+    def generate_doc(self, company: str):
+        """
+        Generates the doc of a company, it records the results it was built from in the cache
+        :param company: The name of the company, or all for the aggregate
+        """
+        with self.lock:
+            self.graphs.generate_doc(company, True)
+
+    def aggregate(self):
+        """
+        Generates the CSV files, the graphs and the doc adding the results of all the companies
+        """
+        with self.lock:
+            if self.graphs.export_csvs:
+                self.graphs.export_csvs_for_company("all", self.graphs.read_results("all"))
+        self.render("all")
+        self.generate_doc("all")
+
+    def order(self) -> List[str]:
+        """
+        :return: The names of the nodes, each after all the nodes it depends on
+        """
+        ordered, visited = [], set()
+
+        def visit(name: str):
+            if name in visited:
+                return
+            visited.add(name)
+            for dep in self.nodes[name].deps:
+                visit(dep)
+            ordered.append(name)
+
+        for name in self.nodes:
+            visit(name)
+        return ordered
+
+    def fingerprints(self) -> Dict[str, str]:
+        """
+        Computes the fingerprint of every node, from its configuration, its source files and its dependencies
+        :return: dict of node name -> fingerprint
+        """
+        fingerprints = {}
+        for name in self.order():
+            node = self.nodes[name]
+            fingerprints[name] = self.cache.fingerprint(
+                node.config, {path: self.cache.file_hash(path) for path in node.inputs},
+                {dep: fingerprints[dep] for dep in node.deps})
+        return fingerprints
+
+    def is_fresh(self, name: str, fingerprint: str) -> bool:
+        """
+        Checks if a node was built from the same inputs, and its outputs were not changed or removed since
+        :param name: The name of the node
+        :param fingerprint: The current fingerprint of the node
+        :return: bool, True if the node does not need to be rebuilt
+        """
+        entry = self.state.get(name)
+        if entry is None or entry["fingerprint"] != fingerprint:
+            return False
+        for output in self.nodes[name].outputs:
+            if not os.path.exists(output) or self.cache.file_hash(output) != entry["outputs"].get(output):
+                return False
+        return True
+
+    def stale(self, force: bool = False) -> List[str]:
+        """
+        Finds the nodes that need to be rebuilt: the ones whose fingerprint changed, or whose outputs are missing or
+        were changed, and all the nodes downstream of them
+        :param force: bool, set to True to rebuild all the nodes
+        :return: the names of the stale nodes, in build order
+        """
+        fingerprints = self.fingerprints()
+        stale = set()
+        for name in self.order():
+            node = self.nodes[name]
+            if force or any(dep in stale for dep in node.deps) or not self.is_fresh(name, fingerprints[name]):
+                stale.add(name)
+        return [name for name in self.order() if name in stale]
+
+    def run(self, force: bool = False, dry_run: bool = False) -> Dict[str, List[str]]:
+        """
+        Rebuilds the stale nodes, running the independent ones at the same time
+        :param force: bool, set to True to rebuild all the nodes
+        :param dry_run: bool, set to True to only list the nodes that would be rebuilt
+        :return: dict with the nodes that were built, failed, and skipped because a dependency failed
+        """
+        self.force = force
+        stale = self.stale(force)
+        summary = {"built": [], "failed": [], "skipped": []}
+        if dry_run:
+            for name in stale:
+                logger.info(f"Would rebuild {name}")
+            summary["skipped"] = stale
+            return summary
+        if not stale:
+            logger.info("Everything is up to date")
+            return summary
+
+        fingerprints = self.fingerprints()
+        pending = set(stale)
+        running = {}
+        logger.info(f"Rebuilding {len(stale)} of {len(self.nodes)} nodes with {self.workers} workers")
+        # the work is sent to the processes from the threads of the nodes, which may be importing a library at the
+        # time, a process forked then could inherit a held import lock, so they are started from a fork server
+        processes = ProcessPoolExecutor(max_workers=self.workers, mp_context=multiprocessing.get_context("forkserver"))
+        with processes as self.processes, ThreadPoolExecutor(max_workers=self.workers) as threads:
+            while pending or running:
+                for name in [name for name in stale if name in pending]:
+                    deps = self.nodes[name].deps
+                    if any(dep in summary["failed"] or dep in summary["skipped"] for dep in deps):
+                        logger.error(f"Skipping {name} as one of its dependencies failed")
+                        pending.discard(name)
+                        summary["skipped"].append(name)
+                    elif not any(dep in pending or dep in running.values() for dep in deps):
+                        logger.info(f"Building {name}")
+                        pending.discard(name)
+                        running[threads.submit(self.nodes[name].action)] = name
+                if not running:
+                    continue
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    name = running.pop(future)
+                    try:
+                        future.result()
+                    except Exception as e:
+                        logger.error(f"Failed to build {name}: {type(e).__name__}: {e}")
+                        summary["failed"].append(name)
+                        continue
+                    # hashing the outputs may store their hashes in the cache, that the running nodes change too
+                    with self.lock:
+                        self.state[name] = {"fingerprint": fingerprints[name], "outputs": {
+                            output: self.cache.file_hash(output) for output in self.nodes[name].outputs}}
+                    summary["built"].append(name)
+                    self.save()
+        self.processes = None
+        self.cache.save()
+        logger.info(f"Scheduler summary: {len(summary['built'])} built, {len(summary['failed'])} failed, "
+                    f"{len(summary['skipped'])} skipped")
+        return summary
+
+    def save(self):
+        """
+        Writes the fingerprints of the built nodes to the state file
+        """
+        os.makedirs(os.path.dirname(self.state_file) or ".", exist_ok=True)
+        tmp_path = f"{self.state_file}.tmp"
+        with open(tmp_path, "w", encoding="utf8") as f:
+            json.dump(self.state, f)
+        os.replace(tmp_path, self.state_file)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Rebuilds the outputs that are stale since the last run")
+    parser.add_argument("--dry-run", action="store_true", help="only list the nodes that would be rebuilt")
+    parser.add_argument("--force", action="store_true", help="rebuild all the nodes")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1,
+                        help="the number of nodes built at the same time")
+    args = parser.parse_args()
+
+    index = TermIndex()
+    if not args.dry_run:
+        index.update(pdf_dir)
+    scheduler = Scheduler(pdf_dir, index=index, workers=args.workers)
+    summary = scheduler.run(args.force, args.dry_run)
+    if not args.dry_run:
+        recorder.write_report(f"{ManifestCache.CACHE_DIR}/run_report.json")
+    if summary["failed"]:
+        raise SystemExit(1)
@@ -0,0 +1,262 @@
+from typing import Dict, List, Tuple, Union
+import argparse
+import json
+import logging
+import os
+import zlib
+
+import log_config
+from catalog import CorpusCatalog
+from graph_generator import GenerateGraphs
+from instrumentation import recorder
+from main import check_and_decode_new_files, pdf_dir, txt_path
+from manifest_cache import ManifestCache
+from term_scanner import TermScanner
+
+logger = log_config.setup_logger(__name__, logging.INFO)
+
+SHARDS_DIR = "shards"
+# the partial results of a shard, and its summary, written last so that a shard without it did not finish
+PARTIAL_RESULTS = "results.parquet"
+SHARD_FILE = "shard.json"
+
+
+def shard_of(company: str, year: int, shards: int) -> int:
+    """
+    Finds the shard of a report, from its name only, so that every node agrees without talking to the others
+    :param company: The name of the company, eg. REP
+    :param year: The year of the report
+    :param shards: The number of shards
+    :return: the shard of the report, from 0 to shards - 1
+    """
+    return zlib.crc32(f"{company}-{year}".encode("utf-8")) % shards
+
+
+def shard_dir(shards_dir: str, shard: int, shards: int) -> str:
+    """
+    :param shards_dir: The directory of the shards
+    :param shard: The shard, from 0 to shards - 1
+    :param shards: The number of shards
+    :return: The output directory of the shard, with the number of shards so that partitions never mix
+    """
+    return f"{shards_dir}/shard-{shard}-of-{shards}"
+
+
+class MergedGraphs(GenerateGraphs):
+    """
+    Class that generates the outputs from the merged results of the shards. The txt files are in the directories of
+    the shards, so the companies are the ones in the results instead of the ones with a decoded file in the location.
+    """
+
+    @property
+    def companies(self) -> List:
+        """
+        Property that returns the list of companies in the merged results
+        :return: The list of individual companies
+        """
+        return self.results.companies
+
+
+class Shard:
+    """
+    Class that processes one shard of the corpus. The reports are partitioned on the crc32 of their COMPANY-YEAR name,
+    so the shards can run on several nodes sharing the PDF directory, or as several processes on one machine.
+    Each shard only reads the shared PDF directory, and writes in its own directory: the decoded txt files, its
+    manifest cache, and the partial results with the counts of its reports, that the merge combines.
+    """
+
+    def __init__(self, shard: int, shards: int, location: str = pdf_dir, shards_dir: str = SHARDS_DIR):
+        """
+        Initialize the class
+        :param shard: The shard to process, from 0 to shards - 1
+        :param shards: The number of shards
+        :param location: The shared directory of the PDFs
+        :param shards_dir: The directory of the shards
+        """
+        if not 0 <= shard < shards:
+            raise ValueError(f"The shard must be from 0 to {shards - 1}, not {shard}")
+        self.shard = shard
+        self.shards = shards
+        self.location = location
+        self.output_dir = shard_dir(shards_dir, shard, shards)
+        self.files_dir = f"{self.output_dir}/files"
+        self.cache = ManifestCache(f"{self.output_dir}/{ManifestCache.CACHE_DIR}")
+        self.scanner = TermScanner(GenerateGraphs.REGEX_PATTERNS)
+
+    def reports(self, catalog: Union[CorpusCatalog, None] = None) -> Dict[Tuple[str, int], str]:
+        """
+        Lists the PDFs of the shard
+        :param catalog: The catalog of the shared directory of the PDFs, a new one if None
+        :return: dict of (company, year) -> the path of the PDF
+        """
+        catalog = CorpusCatalog(self.location) if catalog is None else catalog
+        reports = {}
+        for pdf in catalog.pdfs():
+            company, year, _ = CorpusCatalog.parse(pdf)
+            if shard_of(company, year, self.shards) == self.shard:
+                reports[(company, year)] = pdf
+        return reports
+
+    def txt(self, pdf: str) -> str:
+        """
+        :param pdf: The path of the PDF file
+        :return: The path of its txt file, in the directory of the shard
+        """
+        return f"{self.files_dir}/{txt_path(os.path.basename(pdf))}"
+
+    def count(self, txt: str) -> Dict[str, List[int]]:
+        """
+        Counts the search terms of a decoded file, from the cache if it was counted while it was decoded
+        :param txt: The path of the txt file
+        :return: dict of category -> the values of its columns
+        """
+        key = self.cache.counts_key(txt, GenerateGraphs.REGEX_PATTERNS)
+        counts = self.cache.get_counts(key)
+        if counts is None:
+            with recorder.stage("regex_scan", txt, bytes_read=os.path.getsize(txt)):
+                counts = self.scanner.scan_file(txt)
+            self.cache.store_counts(key, counts)
+        return counts
+
+    def run(self, workers: int = 1) -> Dict[str, List[str]]:
+        """
+        Decodes the new or changed PDFs of the shard, then writes the partial results with the counts of all its
+        reports, and the summary of the shard
+        :param workers: The number of processes decoding the PDFs in parallel, 1 decodes them in this process
+        :return: dict with the list of PDFs that were decoded, failed and skipped
+        """
+        os.makedirs(self.files_dir, exist_ok=True)
+        catalog = CorpusCatalog(self.location)
+        reports = self.reports(catalog)
+        logger.info(f"Shard {self.shard} of {self.shards} has {len(reports)} reports")
+        summary = check_and_decode_new_files(workers, self.cache, catalog, list(reports.values()), self.txt)
+
+        self.write_partial_results({key: pdf for key, pdf in reports.items() if pdf not in summary["failed"]},
+                                   summary["failed"])
+        self.cache.save()
+        logger.info(f"Shard {self.shard} of {self.shards}: {len(summary['decoded'])} decoded, "
+                    f"{len(summary['failed'])} failed, {len(summary['skipped'])} skipped")
+        return summary
+
+    def write_partial_results(self, reports: Dict[Tuple[str, int], str], failed: List[str]):
+        """
+        Writes the counts of the reports of the shard, only the years it has, then its summary
+        :param reports: dict of (company, year) -> the path of the PDF, of the reports that were decoded
+        :param failed: The PDFs that failed to decode
+        """
+        from results_store import ResultsStore
+
+        results = ResultsStore(GenerateGraphs.DATAFRAME_COLUMNS, GenerateGraphs.YEARS)
+        for (company, year), pdf in sorted(reports.items()):
+            # the same years as the reports of a single run
+            if year in GenerateGraphs.YEARS:
+                results.add_year(company, year, self.count(self.txt(pdf)))
+        results.save(f"{self.output_dir}/{PARTIAL_RESULTS}")
+        summary = {
+            "shard": self.shard,
+            "shards": self.shards,
+            "reports": [f"{company}-{year}" for company, year in sorted(reports)],
+            "failed": sorted(os.path.basename(pdf) for pdf in failed),
+        }
+        tmp_path = f"{self.output_dir}/{SHARD_FILE}.tmp"
+        with open(tmp_path, "w", encoding="utf8") as f:
+            json.dump(summary, f, indent=1)
+        os.replace(tmp_path, f"{self.output_dir}/{SHARD_FILE}")
+
+
+def read_shards(shards: int, shards_dir: str = SHARDS_DIR) -> List[Dict]:
+    """
+    Reads the summaries of the shards
+    :param shards: The number of shards
+    :param shards_dir: The directory of the shards
+    :return: the summaries, in the order of the shards
+    :raise ValueError: if a shard did not finish
+    """
+    summaries, missing = [], []
+    for shard in range(shards):
+        path = f"{shard_dir(shards_dir, shard, shards)}/{SHARD_FILE}"
+        if not os.path.exists(path):
+            missing.append(str(shard))
+            continue
+        with open(path, encoding="utf8") as f:
+            summaries.append(json.load(f))
+    if missing:
+        raise ValueError(f"The shards {', '.join(missing)} of {shards} did not finish, run them before merging")
+    return summaries
+
+
+def merge_shards(shards: int, location: str = pdf_dir, shards_dir: str = SHARDS_DIR, workers: int = 1,
+                 export_csvs: bool = True) -> MergedGraphs:
+    """
+    Combines the partial results of the shards into the results file, then generates the CSV files, graphs and doc of
+    each company, and of all the companies, as a single run does. The outputs are always generated again, the
+    merge only reads the partial results and does not decode or count anything.
+    :param shards: The number of shards
+    :param location: The shared directory of the PDFs
+    :param shards_dir: The directory of the shards
+    :param workers: The number of processes rendering the graphs
+    :param export_csvs: bool, set to False to only write the results file and not the per company CSV files
+    :return: the graph generator, with the merged results
+    :raise ValueError: if a shard did not finish, or if two shards have the same report
+    """
+    from results_store import ResultsStore
+
+    summaries = read_shards(shards, shards_dir)
+    done = {report for summary in summaries for report in summary["reports"]}
+    failed = {pdf for summary in summaries for pdf in summary["failed"]}
+    for summary in summaries:
+        for pdf in summary["failed"]:
+            logger.warning(f"The file {pdf} failed to decode in shard {summary['shard']}, its counts are left out")
+    # the PDFs added after the shards ran are only in the next run
+    for pdf in CorpusCatalog(location).pdfs():
+        company, year, _ = CorpusCatalog.parse(pdf)
+        if f"{company}-{year}" not in done and os.path.basename(pdf) not in failed:
+            logger.warning(f"The file {pdf} is not in the results of shard {shard_of(company, year, shards)}, run "
+                           f"the shard again to include it")
+
+    with recorder.stage("merge_results", "", shards=shards):
+        results = ResultsStore(GenerateGraphs.DATAFRAME_COLUMNS, GenerateGraphs.YEARS)
+        results.merge([ResultsStore.from_file(f"{shard_dir(shards_dir, summary['shard'], shards)}/{PARTIAL_RESULTS}",
+                                              GenerateGraphs.DATAFRAME_COLUMNS, GenerateGraphs.YEARS)
+                       for summary in summaries])
+    graphs = MergedGraphs(location, export_csvs=export_csvs, render_workers=workers)
+    os.makedirs(graphs.catalog.csv_dir, exist_ok=True)
+    os.makedirs(graphs.catalog.docs_dir, exist_ok=True)
+    graphs.results = results
+    graphs.save_results()
+    companies = graphs.companies
+    logger.info(f"Merged the results of {len(done)} reports of {len(companies)} companies from {shards} shards")
+    if export_csvs:
+        for company in companies:
+            with recorder.stage("write_csvs", company):
+                graphs.export_csvs_for_company(
+                    company, {key: results.company_frame(key, company) for key in GenerateGraphs.DATAFRAME_COLUMNS})
+    graphs.generate_graphs_for_companies({company: True for company in companies})
+    for company in companies:
+        graphs.generate_doc(company, True)
+    graphs.generate_aggregated_doc(True)
+    return graphs
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Processes the corpus in shards, that can run on several nodes "
+                                                 "sharing the PDF directory, then merges their results")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    shard_parser = subparsers.add_parser("shard", help="decode and count the reports of one shard")
+    shard_parser.add_argument("shard", type=int, help="the shard to process, from 0 to shards - 1")
+    merge_parser = subparsers.add_parser("merge", help="combine the results of all the shards and generate the outputs")
+    for subparser in (shard_parser, merge_parser):
+        subparser.add_argument("--shards", type=int, required=True, help="the number of shards")
+        subparser.add_argument("--shards-dir", default=SHARDS_DIR, help="the directory of the outputs of the shards")
+        subparser.add_argument("--workers", type=int, default=1, help="the number of processes")
+    args = parser.parse_args()
+
+    try:
+        if args.command == "shard":
+            summary = Shard(args.shard, args.shards, pdf_dir, args.shards_dir).run(args.workers)
+            if summary["failed"]:
+                raise SystemExit(1)
+        else:
+            merge_shards(args.shards, pdf_dir, args.shards_dir, args.workers)
+    except ValueError as e:
+        raise SystemExit(str(e))
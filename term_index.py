@@ -0,0 +1,369 @@
+from collections import Counter
+from functools import lru_cache
+from typing import Dict, List, Tuple, Union
+import json
+import logging
+import os
+import re
+import shutil
+import time
+
+import numpy as np
+
+try:
+    from re import _parser as sre_parse
+except ImportError:  # before python 3.11
+    import sre_parse
+
+import log_config
+from catalog import CorpusCatalog
+from term_scanner import read_paragraphs
+
+logger = log_config.setup_logger(__name__, logging.INFO)
+
+# the tokens are the maximal runs of word characters, so a pattern match made of word characters is always inside one
+TOKEN_PATTERN = re.compile(r"\w+")
+# the largest character range checked one character at a time, the larger ones are not word characters only
+MAX_CHECKED_RANGE = 1024
+
+
+def _is_word_char(code: int) -> bool:
+    """
+    :param code: The code point of a character
+    :return: bool, True if it is a word character, as matched by TOKEN_PATTERN
+    """
+    return TOKEN_PATTERN.fullmatch(chr(code)) is not None
+
+
+def _matches_words_only(items: "sre_parse.SubPattern") -> bool:
+    """
+    Checks that the parsed items of a pattern only match word characters, and only look at the text around them with
+    word boundaries, which are the same in a token as in the text
+    :param items: The parsed pattern, or a part of it
+    :return: bool, True if every character it matches is a word character
+    """
+    for op, av in items:
+        if op is sre_parse.LITERAL:
+            if not _is_word_char(av):
+                return False
+        elif op is sre_parse.IN:
+            for item_op, item_av in av:
+                if item_op is sre_parse.LITERAL:
+                    if not _is_word_char(item_av):
+                        return False
+                elif item_op is sre_parse.RANGE:
+                    low, high = item_av
+                    if high - low > MAX_CHECKED_RANGE or not all(_is_word_char(c) for c in range(low, high + 1)):
+                        return False
+                elif item_op is not sre_parse.CATEGORY or \
+                        item_av not in (sre_parse.CATEGORY_WORD, sre_parse.CATEGORY_DIGIT):
+                    return False
+        elif op is sre_parse.AT:
+            if av not in (sre_parse.AT_BOUNDARY, sre_parse.AT_NON_BOUNDARY):
+                return False
+        elif op in (sre_parse.MAX_REPEAT, sre_parse.MIN_REPEAT, getattr(sre_parse, "POSSESSIVE_REPEAT", None)):
+            if not _matches_words_only(av[2]):
+                return False
+        elif op is sre_parse.SUBPATTERN:
+            if not _matches_words_only(av[3]):
+                return False
+        elif op is getattr(sre_parse, "ATOMIC_GROUP", None):
+            if not _matches_words_only(av):
+                return False
+        elif op is sre_parse.BRANCH:
+            if not all(_matches_words_only(branch) for branch in av[1]):
+                return False
+        else:
+            # any character, negated sets, lookarounds, back references, line anchors
+            return False
+    return True
+
+
+@lru_cache(maxsize=None)
+def is_word_pattern(pattern: str) -> bool:
+    """
+    Checks if a pattern can be counted from the vocabulary: each of its matches must be made of word characters
+    only, so that it is inside one token, and it must not match the empty string
+    :param pattern: the regex pattern, matched ignoring the case like in TermScanner
+    :return: bool, True if the index gives the same counts as running the pattern on the text
+    """
+    parsed = sre_parse.parse(pattern, re.IGNORECASE)
+    return parsed.getwidth()[0] > 0 and _matches_words_only(parsed)
+
+
+class TermIndex:
+    """
+    Class that keeps an on disk inverted index of the decoded reports, so that new term sets can be counted without
+    scanning the text again.
+    The vocabulary is shared by the whole corpus and is append only. Each indexed file has its own directory with
+    memory-mappable numpy arrays: the sorted ids of the terms present in the file, the offset of the postings of
+    each term, and the postings themselves as paragraph number and number of occurrences in that paragraph.
+    The patterns are matched against the vocabulary only, which gives the same counts as running them on the text as
+    long as each match is made of word characters only, is_word_pattern checks it, the other patterns, eg. matching
+    a space or a hyphen, can not be counted from the index.
+    """
+    INDEX_DIR = "index"
+
+    def __init__(self, index_dir: str = INDEX_DIR):
+        """
+        Initialize the class and load the vocabulary and the list of indexed files
+        :param index_dir: The directory where the index is stored
+        """
+        self.index_dir = index_dir
+        self.vocab_path = f"{self.index_dir}/vocab.txt"
+        self.catalog_path = f"{self.index_dir}/index.json"
+        self.vocab = []
+        self.term_ids = {}
+        self.catalog = {}
+        self._arrays = {}
+        # pattern -> the term ids and weights matching it, and the size of the vocabulary they were matched against
+        self._matched: Dict[str, Tuple[np.ndarray, np.ndarray, int]] = {}
+        if os.path.exists(self.vocab_path):
+            with open(self.vocab_path, encoding="utf8") as f:
+                self.vocab = f.read().split("\n")[:-1]
+            self.term_ids = {term: i for i, term in enumerate(self.vocab)}
+        if os.path.exists(self.catalog_path):
+            with open(self.catalog_path, encoding="utf8") as f:
+                self.catalog = json.load(f)
+
+    @staticmethod
+    def name_of(txt: str) -> str:
+        """
+        :param txt: The path of the decoded txt file
+        :return: the name of the file in the index, eg. REP-2022
+        """
+        return os.path.basename(txt).rsplit(".", 1)[0]
+
+    def is_indexed(self, txt: str) -> bool:
+        """
+        Checks if the txt file was indexed and did not change since
+        :param txt: The path of the decoded txt file
+        :return: bool, True if the index of the file is up to date
+        """
+        entry = self.catalog.get(self.name_of(txt))
+        stat = os.stat(txt)
+        return entry is not None and entry["size"] == stat.st_size and entry["mtime"] == stat.st_mtime_ns
+
+    def add(self, txt: str):
+        """
+        Indexes a decoded txt file, replacing its previous index if any
+        :param txt: The path of the decoded txt file
+        """
+        name = self.name_of(txt)
+        stat = os.stat(txt)
+        postings = {}
+        vocab_size = len(self.vocab)
+        pid = -1
+        for pid, paragraph in enumerate(read_paragraphs(txt)):
+            for term, count in Counter(TOKEN_PATTERN.findall(paragraph)).items():
+                term_id = self.term_ids.get(term)
+                if term_id is None:
+                    term_id = self.term_ids[term] = len(self.vocab)
+                    self.vocab.append(term)
+                postings.setdefault(term_id, []).append((pid, count))
+
+        terms = np.array(sorted(postings), dtype=np.int32)
+        offsets = np.zeros(len(terms) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum([len(postings[t]) for t in terms])
+        pairs = np.array([pair for t in terms for pair in postings[t]], dtype=np.int32).reshape(-1, 2)
+
+        # the vocabulary is append only, so the term ids of the other files stay valid
+        os.makedirs(self.index_dir, exist_ok=True)
+        with open(self.vocab_path, "a", encoding="utf8") as f:
+            f.write("".join(f"{term}\n" for term in self.vocab[vocab_size:]))
+        file_dir = f"{self.index_dir}/{name}"
+        if os.path.exists(file_dir):
+            shutil.rmtree(file_dir)
+        os.makedirs(file_dir)
+        np.save(f"{file_dir}/terms.npy", terms)
+        np.save(f"{file_dir}/offsets.npy", offsets)
+        np.save(f"{file_dir}/paragraphs.npy", np.ascontiguousarray(pairs[:, 0]))
+        np.save(f"{file_dir}/frequencies.npy", np.ascontiguousarray(pairs[:, 1]))
+        self._arrays.pop(name, None)
+        self.catalog[name] = {"size": stat.st_size, "mtime": stat.st_mtime_ns, "paragraphs": pid + 1}
+        self.save()
+
+    def save(self):
+        """
+        Writes the list of indexed files to disk
+        """
+        tmp_path = f"{self.catalog_path}.tmp"
+        with open(tmp_path, "w", encoding="utf8") as f:
+            json.dump(self.catalog, f)
+        os.replace(tmp_path, self.catalog_path)
+
+    def update(self, location: str, catalog: CorpusCatalog = None) -> List[str]:
+        """
+        Indexes the txt files in the location that are new or changed since they were indexed
+        :param location: The location where the pdfs have been decoded into txt
+        :param catalog: The catalog of the location, a new one if None
+        :return: the list of files that were indexed
+        """
+        catalog = CorpusCatalog(location) if catalog is None else catalog
+        indexed = []
+        for txt in catalog.txts():
+            if not self.is_indexed(txt):
+                logger.info(f"Indexing file {txt}")
+                self.add(txt)
+                indexed.append(txt)
+        return indexed
+
+    def _load(self, name: str) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+        """
+        Memory maps the arrays of an indexed file
+        :param name: The name of the file in the index, eg. REP-2022
+        :return: tuple with the terms, offsets, paragraphs and frequencies arrays
+        """
+        if name not in self._arrays:
+            file_dir = f"{self.index_dir}/{name}"
+            self._arrays[name] = tuple(np.load(f"{file_dir}/{array}.npy", mmap_mode="r")
+                                       for array in ("terms", "offsets", "paragraphs", "frequencies"))
+        return self._arrays[name]
+
+    @staticmethod
+    def unsupported_patterns(regex_patterns: Dict[str, List[str]]) -> List[str]:
+        """
+        :param regex_patterns: dict of category -> patterns, in the same format as GenerateGraphs.REGEX_PATTERNS
+        :return: the patterns that can not be counted from the index, as they can match a non word character
+        """
+        return sorted({pattern for patterns in regex_patterns.values() for pattern in patterns
+                       if not is_word_pattern(pattern)})
+
+    def can_count(self, regex_patterns: Dict[str, List[str]]) -> bool:
+        """
+        :param regex_patterns: dict of category -> patterns, in the same format as GenerateGraphs.REGEX_PATTERNS
+        :return: bool, True if all the patterns can be counted from the index
+        """
+        return not self.unsupported_patterns(regex_patterns)
+
+    def match_terms(self, pattern: str) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Finds the terms of the vocabulary matching a pattern. The matches are kept, as the vocabulary is append only
+        the next calls only match the terms added since, so each file counted does not match the whole vocabulary.
+        :param pattern: the regex pattern, matched ignoring the case like in TermScanner
+        :return: tuple with the sorted term ids and the number of matches of the pattern in each of these terms
+        """
+        ids, weights, matched_size = self._matched.get(
+            pattern, (np.empty(0, dtype=np.int32), np.empty(0, dtype=np.int64), 0))
+        if matched_size < len(self.vocab):
+            compiled = re.compile(pattern, re.IGNORECASE)
+            new_ids, new_weights = [], []
+            for term_id in range(matched_size, len(self.vocab)):
+                matches = len(compiled.findall(self.vocab[term_id]))
+                if matches:
+                    new_ids.append(term_id)
+                    new_weights.append(matches)
+            ids = np.concatenate([ids, np.array(new_ids, dtype=np.int32)])
+            weights = np.concatenate([weights, np.array(new_weights, dtype=np.int64)])
+            self._matched[pattern] = ids, weights, len(self.vocab)
+        return ids, weights
+
+    def _positions(self, name: str, term_ids: np.ndarray) -> np.ndarray:
+        """
+        Finds the given terms in an indexed file
+        :param name: The name of the file in the index, eg. REP-2022
+        :param term_ids: The sorted term ids
+        :return: the position of each term in the terms array of the file, only for the terms present in the file
+        """
+        terms = self._load(name)[0]
+        positions = np.searchsorted(terms, term_ids)
+        positions = positions[positions < len(terms)]
+        return positions[np.isin(terms[positions], term_ids)]
+
+    def _paragraphs(self, name: str, term_ids: np.ndarray) -> np.ndarray:
+        """
+        Collects the paragraphs of an indexed file containing any of the given terms
+        :param name: The name of the file in the index, eg. REP-2022
+        :param term_ids: The sorted term ids
+        :return: the sorted unique paragraph numbers
+        """
+        _, offsets, paragraphs, _ = self._load(name)
+        positions = self._positions(name, term_ids)
+        if not len(positions):
+            return np.empty(0, dtype=np.int32)
+        return np.unique(np.concatenate([paragraphs[offsets[p]:offsets[p + 1]] for p in positions]))
+
+    def count_matches(self, name: str, term_ids: np.ndarray, weights: np.ndarray) -> int:
+        """
+        Counts the total number of matches of the terms in an indexed file
+        :param name: The name of the file in the index, eg. REP-2022
+        :param term_ids: The sorted term ids, as returned by match_terms
+        :param weights: The number of matches in each term, as returned by match_terms
+        :return: the number of matches
+        """
+        terms, offsets, _, frequencies = self._load(name)
+        total = 0
+        for position in self._positions(name, term_ids):
+            weight = weights[np.searchsorted(term_ids, terms[position])]
+            total += int(frequencies[offsets[position]:offsets[position + 1]].sum()) * int(weight)
+        return total
+
+    def count(self, name: str, regex_patterns: Dict[str, List[str]],
+              matched: Dict[str, Tuple[np.ndarray, np.ndarray]] = None) -> Dict[str, List[int]]:
+        """
+        Counts the categories in an indexed file, giving the same result as TermScanner.scan on the text
+        :param name: The name of the file in the index, eg. REP-2022
+        :param regex_patterns: dict of category -> patterns, in the same format as GenerateGraphs.REGEX_PATTERNS
+        :param matched: optional dict of pattern -> match_terms result, to match each pattern only once per query
+        :return: dict of category -> [main pattern count, board paragraphs, executive paragraphs]
+        :raise ValueError: if a pattern can match a non word character, the index would not find its matches
+        """
+        unsupported = self.unsupported_patterns(regex_patterns)
+        if unsupported:
+            raise ValueError(f"The patterns {unsupported} can match non word characters, they can not be counted "
+                             f"from the index")
+        matched = {} if matched is None else matched
+        paragraph_sets = {}
+
+        def terms_of(pattern: str) -> Tuple[np.ndarray, np.ndarray]:
+            if pattern not in matched:
+                matched[pattern] = self.match_terms(pattern)
+            return matched[pattern]
+
+        def paragraphs_of(pattern: str) -> np.ndarray:
+            if pattern not in paragraph_sets:
+                paragraph_sets[pattern] = self._paragraphs(name, terms_of(pattern)[0])
+            return paragraph_sets[pattern]
+
+        totals = {}
+        for key, patterns in regex_patterns.items():
+            if len(patterns) == 4:
+                main, secondary, board, executive = patterns
+            else:
+                main, board, executive = patterns
+                secondary = None
+            found = paragraphs_of(main)
+            if secondary is not None:
+                found = np.union1d(found, paragraphs_of(secondary))
+            totals[key] = [
+                self.count_matches(name, *terms_of(main)),
+                len(np.intersect1d(found, paragraphs_of(board), assume_unique=True)),
+                len(np.intersect1d(found, paragraphs_of(executive), assume_unique=True)),
+            ]
+        return totals
+
+    def query(self, regex_patterns: Dict[str, List[str]],
+              names: Union[List[str], None] = None) -> Dict[str, Dict[str, List[int]]]:
+        """
+        Counts the categories in every indexed file, matching each pattern against the vocabulary only once
+        :param regex_patterns: dict of category -> patterns, in the same format as GenerateGraphs.REGEX_PATTERNS
+        :param names: The names of the files to count, eg. REP-2022, all the indexed files if None
+        :return: dict of file name -> category -> [main pattern count, board paragraphs, executive paragraphs]
+        :raise ValueError: if a pattern can match a non word character, the index would not find its matches
+        """
+        matched = {}
+        names = sorted(self.catalog) if names is None else names
+        return {name: self.count(name, regex_patterns, matched) for name in names}
+
+
+if __name__ == '__main__':
+    from graph_generator import GenerateGraphs
+
+    # testing out the index on the decoded files, with the default patterns
+    index = TermIndex()
+    index.update("files")
+    start = time.time()
+    results = index.query(GenerateGraphs.REGEX_PATTERNS)
+    for file_name, counts in results.items():
+        print(file_name, counts)
+    print(f"Counted {len(results)} files in {time.time() - start:.2f} seconds")
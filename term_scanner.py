@@ -0,0 +1,161 @@
+from queue import Queue
+from threading import Thread
+from typing import Dict, Iterable, Iterator, List, Tuple, Union
+import hashlib
+import re
+
+
+def read_paragraphs(filename: str) -> Iterator[str]:
+    """
+    Reads the paragraphs of a decoded txt file lazily, one per line, without loading the whole text
+    :param filename: the path of the txt file
+    :return: generator with the text of each paragraph
+    """
+    with open(filename, encoding="utf8") as f:
+        for line in f:
+            yield line[:-1] if line.endswith("\n") else line
+
+
+class TermScanner:
+    """
+    Class that counts the search terms of every category in a single pass over the paragraphs of a decoded file
+    """
+
+    def __init__(self, regex_patterns: Dict[str, List[str]]):
+        """
+        Initialize the scanner and compile every distinct pattern only once
+        :param regex_patterns: dict of category -> patterns, in the same format as GenerateGraphs.REGEX_PATTERNS:
+        [main, board, executive] or [main, secondary, board, executive]
+        """
+        self._compiled = {}
+        self.categories = {}
+        for key, patterns in regex_patterns.items():
+            if len(patterns) == 4:
+                main, secondary, board, executive = patterns
+            else:
+                main, board, executive = patterns
+                secondary = None
+            self.categories[key] = (
+                self._compile(main),
+                self._compile(secondary) if secondary is not None else None,
+                self._compile(board),
+                self._compile(executive),
+            )
+
+    def _compile(self, pattern: str) -> re.Pattern:
+        """
+        Compile the pattern, re-using the compiled object if another category already uses the same pattern
+        :param pattern: the regex pattern
+        :return: the compiled pattern
+        """
+        if pattern not in self._compiled:
+            self._compiled[pattern] = re.compile(pattern, re.IGNORECASE)
+        return self._compiled[pattern]
+
+    def scan(self, paragraphs: Iterable[str]) -> Dict[str, List[int]]:
+        """
+        Count all the categories in one pass over the paragraphs
+        :param paragraphs: an iterable with the text of each paragraph
+        :return: dict of category -> [main pattern count, board paragraphs, executive paragraphs]
+        """
+        totals = {key: [0, 0, 0] for key in self.categories}
+        for paragraph in paragraphs:
+            # board and executive patterns are shared by the categories, only search them once per paragraph
+            searched = {}
+            for key, (main, secondary, board, executive) in self.categories.items():
+                count = len(main.findall(paragraph))
+                values = totals[key]
+                values[0] += count
+                if not count and (secondary is None or not secondary.search(paragraph)):
+                    continue
+                for idx, pattern in ((1, board), (2, executive)):
+                    if pattern not in searched:
+                        searched[pattern] = pattern.search(paragraph) is not None
+                    if searched[pattern]:
+                        values[idx] += 1
+        return totals
+
+    def scan_file(self, filename: str) -> Dict[str, List[int]]:
+        """
+        Count all the categories in a decoded txt file, reading it only once and one paragraph at a time
+        :param filename: the path of the txt file
+        :return: dict of category -> [main pattern count, board paragraphs, executive paragraphs]
+        """
+        return self.scan(read_paragraphs(filename))
+
+
+class StreamingScanner:
+    """
+    Class that counts the search terms of a file while it is being decoded. The decoder hands over the text of each
+    page through a bounded queue to a thread, that splits it into the same lines as the txt file and scans them, and
+    hashes the text, so the counts and the hash are ready as soon as the decoding ends, without reading the txt back.
+    When the queue is full the decoder waits for the thread, so the pages in flight stay bounded.
+    """
+
+    def __init__(self, scanner: TermScanner, queue_size: int = 8):
+        """
+        Initialize the class and start the thread
+        :param scanner: The scanner counting the paragraphs
+        :param queue_size: The maximum number of pages waiting to be scanned
+        """
+        self.scanner = scanner
+        self.queue = Queue(maxsize=queue_size)
+        self.sha = hashlib.sha256()
+        self.size = 0
+        self.counts = None
+        self.error: Union[BaseException, None] = None
+        self.thread = Thread(target=self.run, name="streaming-scanner", daemon=True)
+        self.thread.start()
+
+    def put(self, text: str):
+        """
+        Hands over a piece of the decoded text, waiting while the queue is full
+        :param text: The text, eg. of a page, the pieces put one after the other make the whole txt file
+        """
+        self.queue.put(text)
+
+    def lines(self) -> Iterator[str]:
+        """
+        Takes the text out of the queue until it is closed
+        :return: generator with the lines of the text, as read_paragraphs returns them from the txt file
+        """
+        rest = ""
+        while True:
+            text = self.queue.get()
+            if text is None:
+                break
+            data = text.encode("utf-8")
+            self.sha.update(data)
+            self.size += len(data)
+            # the newlines are translated like when reading the txt file, a \r at the end may start a \r\n
+            text = rest + text
+            end = len(text) - 1 if text.endswith("\r") else len(text)
+            lines = text[:end].replace("\r\n", "\n").replace("\r", "\n").split("\n")
+            rest = lines.pop() + text[end:]
+            yield from lines
+        if rest:
+            # the text did not end with a newline, or ended with a \r
+            yield rest[:-1] if rest.endswith("\r") else rest
+
+    def run(self):
+        """
+        Scans the text until the queue is closed, an error is kept for close and the rest of the text is discarded so
+        that the decoder never waits on a full queue
+        """
+        try:
+            self.counts = self.scanner.scan(self.lines())
+        except BaseException as e:
+            self.error = e
+            while self.queue.get() is not None:
+                pass
+
+    def close(self) -> Tuple[Dict[str, List[int]], str, int]:
+        """
+        Closes the queue and waits for the thread to scan the rest of the text
+        :return: tuple with the counts, as returned by TermScanner.scan, the sha256 of the utf-8 text and its size
+        """
+        self.queue.put(None)
+        self.thread.join()
+        if self.error is not None:
+            raise self.error
+        return self.counts, self.sha.hexdigest(), self.size
@@ -0,0 +1,207 @@
+from queue import Empty, Full, Queue
+from threading import Event, Thread
+from typing import Dict, List, Tuple
+import argparse
+import logging
+import os
+import time
+
+import log_config
+from catalog import CorpusCatalog
+from graph_generator import GenerateGraphs
+from instrumentation import recorder
+from main import decode_file, is_decoded, pdf_dir, store_decoded, txt_path
+from manifest_cache import ManifestCache
+from term_index import TermIndex
+
+logger = log_config.setup_logger(__name__, logging.INFO)
+
+
+class PdfWatcher:
+    """
+    Class that watches the PDF directory and keeps the reports up to date, in one long running process so that
+    pandas, matplotlib and pdfplumber are only imported once.
+    The directory is polled, a new or changed PDF is only picked up once its size and modification time did not change
+    for the debounce delay, so that a file still being copied is not decoded.
+    The PDFs go through a bounded queue to a single worker thread, that decodes them and refreshes the reports of
+    their companies, and the aggregate once per batch. When the queue is full the polling waits for the worker, so a
+    bulk upload is processed at the pace of the worker.
+    """
+
+    def __init__(self, location: str = pdf_dir, interval: float = 2.0, debounce: float = 5.0, queue_size: int = 8,
+                 cache: ManifestCache = None, index: TermIndex = None):
+        """
+        Initialize the class
+        :param location: The location of the PDFs, where they are decoded into txt
+        :param interval: The number of seconds between two scans of the location
+        :param debounce: The number of seconds a PDF must stay the same before it is processed
+        :param queue_size: The maximum number of PDFs waiting to be processed
+        :param cache: The manifest cache used to find the PDFs already decoded, a new one if None
+        :param index: The term index updated with the decoded files, a new one if None
+        """
+        self.location = location
+        self.interval = interval
+        self.debounce = debounce
+        self.cache = ManifestCache() if cache is None else cache
+        self.index = TermIndex() if index is None else index
+        self.graphs = GenerateGraphs(location, self.cache, self.index)
+        self.queue = Queue(maxsize=queue_size)
+        self.stop_event = Event()
+        # path -> (size, mtime) of the PDFs that were seen, and since when they did not change
+        self.seen: Dict[str, Tuple[int, int]] = {}
+        self.stable_since: Dict[str, float] = {}
+        # path -> (size, mtime) of the PDFs that were queued
+        self.handled: Dict[str, Tuple[int, int]] = {}
+
+    def poll(self) -> List[str]:
+        """
+        Scans the location once
+        :return: the PDFs that are new or changed, and did not change for the debounce delay
+        """
+        now = time.monotonic()
+        ready = []
+        current = {}
+        for f in sorted(os.listdir(self.location)):
+            parsed = CorpusCatalog.parse(f)
+            if parsed is None or parsed[2] != "pdf":
+                continue
+            pdf = f"{self.location}/{f}"
+            try:
+                stat = os.stat(pdf)
+            except FileNotFoundError:
+                continue
+            signature = (stat.st_size, stat.st_mtime_ns)
+            current[pdf] = signature
+            if self.seen.get(pdf) != signature:
+                self.stable_since[pdf] = now
+            elif self.handled.get(pdf) != signature and now - self.stable_since[pdf] >= self.debounce:
+                ready.append(pdf)
+        self.seen = current
+        self.stable_since = {pdf: since for pdf, since in self.stable_since.items() if pdf in current}
+        return ready
+
+    def enqueue(self, pdf: str) -> bool:
+        """
+        Puts a PDF in the queue, waiting while the queue is full
+        :param pdf: The path of the PDF file
+        :return: bool, False if the watcher was stopped while waiting
+        """
+        while not self.stop_event.is_set():
+            try:
+                self.queue.put(pdf, timeout=self.interval)
+            except Full:
+                logger.info(f"The queue is full, waiting to add {pdf}")
+                continue
+            self.handled[pdf] = self.seen[pdf]
+            return True
+        return False
+
+    def next_batch(self) -> List[str]:
+        """
+        Waits for a PDF in the queue, then takes all the others already waiting
+        :return: the PDFs to process, empty if the watcher was stopped
+        """
+        while not self.stop_event.is_set():
+            try:
+                batch = [self.queue.get(timeout=self.interval)]
+            except Empty:
+                continue
+            while True:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except Empty:
+                    return batch
+        return []
+
+    def process(self, pdfs: List[str]):
+        """
+        Decodes the PDFs, then refreshes the reports of their companies and the aggregate
+        :param pdfs: The paths of the PDF files
+        """
+        companies = []
+        for pdf in pdfs:
+            if is_decoded(pdf, self.cache):
+                logger.info(f"The file {pdf} is already decoded")
+            else:
+                logger.info(f"Decoding file {pdf}")
+                _, error, records, counted = decode_file(pdf)
+                recorder.merge(records)
+                if error is not None:
+                    logger.error(f"Failed to decode file {pdf}: {error}")
+                    continue
+                store_decoded(pdf, counted, self.cache)
+            txt = txt_path(pdf)
+            self.graphs.catalog.add(txt)
+            if not self.index.is_indexed(txt):
+                self.index.add(txt)
+            # the counts of this file in memory are from the previous version of the file
+            self.graphs.counts.pop(os.path.basename(txt), None)
+            company, _, _ = CorpusCatalog.parse(pdf)
+            if company not in companies:
+                companies.append(company)
+        if not companies:
+            return
+        for company in companies:
+            self.graphs.analyse_and_plot_data_for_company(company)
+        self.graphs.generate_aggregated_doc()
+        self.cache.save()
+        logger.info(f"Refreshed the reports of {', '.join(companies)} and the aggregate")
+
+    def work(self):
+        """
+        Processes the queued PDFs, until the watcher is stopped
+        """
+        while not self.stop_event.is_set():
+            batch = self.next_batch()
+            if not batch:
+                continue
+            try:
+                self.process(batch)
+            except Exception as e:
+                logger.error(f"Failed to process {batch}: {type(e).__name__}: {e}")
+            finally:
+                for _ in batch:
+                    self.queue.task_done()
+
+    def run(self):
+        """
+        Watches the location until interrupted
+        """
+        logger.info(f"Watching {self.location} for new PDFs every {self.interval} seconds")
+        # the PDFs already decoded are not queued, the others are picked up by the first polls
+        for pdf in self.graphs.catalog.pdfs():
+            if is_decoded(pdf, self.cache):
+                stat = os.stat(pdf)
+                self.handled[pdf] = (stat.st_size, stat.st_mtime_ns)
+        worker = Thread(target=self.work, name="watcher-worker", daemon=True)
+        worker.start()
+        try:
+            while not self.stop_event.is_set():
+                for pdf in self.poll():
+                    logger.info(f"Found new file {pdf}")
+                    if not self.enqueue(pdf):
+                        break
+                self.stop_event.wait(self.interval)
+        except KeyboardInterrupt:
+            logger.info("Stopping the watcher")
+        finally:
+            self.stop_event.set()
+            worker.join()
+            self.cache.save()
+
+    def stop(self):
+        """
+        Stops the watcher, the PDFs being processed are finished first
+        """
+        self.stop_event.set()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Decodes the new PDFs and refreshes their reports as they are added")
+    parser.add_argument("--interval", type=float, default=2.0, help="seconds between two scans of the directory")
+    parser.add_argument("--debounce", type=float, default=5.0,
+                        help="seconds a PDF must stay the same before it is processed")
+    parser.add_argument("--queue-size", type=int, default=8, help="the maximum number of PDFs waiting")
+    args = parser.parse_args()
+
+    PdfWatcher(pdf_dir, args.interval, args.debounce, args.queue_size).run()